@@ -2,11 +2,79 @@ from os import PathLike
 
 import numpy as np
 import pandas as pd
-from cftime import num2pydate
-from netCDF4 import Dataset
+from atl_module.ATL03_preprocessing.granule_backends import open_granule
+from atl_module.ATL03_preprocessing.photon_cache import PhotonCache, granule_fingerprint
 
 beamlist = ["gt1l", "gt1r", "gt2l", "gt2r", "gt3l", "gt3r"]
 
+# fields of the photon array and their dtypes. The dtype of `delta_time` depends on the time format
+PHOTON_FIELDS = {
+    "X": "<f8",
+    "Y": "<f8",
+    "Z_ellip": "<f4",
+    "Z_geoid": "<f4",
+    "geoid_corr": "<f4",
+    "tide_ocean_corr": "<f4",
+    "geof2m_corr": "<f4",
+    "delta_time": None,
+    "oc_sig_conf": "<i1",
+    "land_sig_conf": "<i1",
+    "p_vec_az": "<f4",
+    "p_vec_elev": "<f4",
+    "dac_corr": "<f4",
+    "ph_count": "<i4",
+    "full_sat": "<f4",
+    "dist_along": "<f8",
+}
+# fields that are only read when they are requested. They are not loaded by default and are not
+# stored in the photon cache, so beams that need them are always decoded from the granule
+OPTIONAL_PHOTON_FIELDS = ("dist_along",)
+# fields of the photon array when no columns are requested, these are also the cached fields
+DEFAULT_PHOTON_COLUMNS = [
+    field for field in PHOTON_FIELDS if field not in OPTIONAL_PHOTON_FIELDS
+]
+# photon-rate netcdf variables in the `heights` group, by the field they are stored in
+PHOTON_VARIABLES = {
+    "X": "lon_ph",
+    "Y": "lat_ph",
+    "Z_ellip": "h_ph",
+}
+# segment-rate netcdf variables, by the field they are broadcast to
+SEGMENT_VARIABLES = {
+    "geoid_corr": "geophys_corr/geoid",
+    "tide_ocean_corr": "geophys_corr/tide_ocean",
+    "geof2m_corr": "geophys_corr/geoid_free2mean",
+    "p_vec_az": "geolocation/ref_azimuth",
+    "p_vec_elev": "geolocation/ref_elev",
+    "dac_corr": "geophys_corr/dac",
+    "ph_count": "geolocation/segment_ph_cnt",
+    "full_sat": "geolocation/full_sat_fract",
+}
+# fields of the segment array returned by `GranuleReader.load_beam_segments`, with the netcdf
+# variable in the beam group and the dtype of each
+SEGMENT_FIELDS = {
+    "X": ("geolocation/reference_photon_lon", "<f8"),
+    "Y": ("geolocation/reference_photon_lat", "<f8"),
+    "delta_time": ("geolocation/delta_time", "<f8"),
+    "ph_count": ("geolocation/segment_ph_cnt", "<i4"),
+    "full_sat": ("geolocation/full_sat_fract", "<f4"),
+}
+
+# number of photons of a beam in each chunk of `GranuleReader.iter_beam_chunks`
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+# based on the data documentation, the times are referenced to 2018-01-01
+ATLAS_EPOCH = np.datetime64("2018-01-01T00:00:00", "us")
+# dtype of the `delta_time` field for each of the available time formats
+TIME_FORMATS = {"datetime": "<M8[us]", "seconds": "<f8"}
+
+# layouts of the photon array. In the `compact` layout, the coordinates are float32 offsets from
+# the origin of the segment of each photon, and the segment-rate variables are kept in a table of
+# the segments in the metadata, with the index of the segment of each photon in the `seg_idx` field
+LAYOUTS = ("standard", "compact")
+# fields of the coordinate offsets in the compact layout, by the field they replace
+COMPACT_OFFSET_FIELDS = {"X": "dX", "Y": "dY"}
+
 
 def get_beams(granule_netcdf: str or PathLike) -> list:
     """List the beams available for a given granule
@@ -18,194 +86,885 @@ def get_beams(granule_netcdf: str or PathLike) -> list:
         list: List of beams
     """
     try:
-        with Dataset(granule_netcdf) as netcdfdataset:
-            return [
-                beam
-                for beam in netcdfdataset.groups
-                if (beam in beamlist) and ("heights" in netcdfdataset.groups[beam].groups)
-            ]
+        with GranuleReader(granule_netcdf) as granule:
+            return granule.beams
     # i  know pass in an except block is bad coding but i need to find a better way of handling this
     except AttributeError:
         pass
 
 
-def load_beam_array_ncds(filename: str or PathLike, beam: str) -> np.ndarray:
-    """return an array of photon-level details for a given file and beam name.
+def delta_time_to_datetime(delta_time_s: np.ndarray) -> np.ndarray:
+    """convert ATLAS times in seconds since 2018-01-01 to datetime64 with microsecond precision
 
-    Granule-level metadata is also included with the array
+    The conversion is done with integer array arithmetic, rounding to the nearest microsecond,
+    so no python datetime objects are created.
+
+    Args:
+        delta_time_s (np.ndarray): times in seconds since 2018-01-01
+
+    Returns:
+        np.ndarray: array of `datetime64[us]`
     """
-    # this function is a mess and should probably abstracted into smaller functions
-    # if the pandas df induces too much overhead, could maybe be rewritten in numpy
+    delta_time_us = np.rint(np.asarray(delta_time_s, dtype="<f8") * 1e6).astype("<i8")
+    return ATLAS_EPOCH + delta_time_us.astype("<m8[us]")
+
+
+def segment_index_from_time(
+    delta_time_segment: np.ndarray, delta_time_photon: np.ndarray, segment_is_valid=None
+) -> np.ndarray:
+    """find the index of the segment that applies to each photon, based on the times
+
+    Each photon is matched to the last segment with a time at or before the photon time, in the
+    same way as `pandas.DataFrame.asof`. If `segment_is_valid` is given, segments that are not
+    valid are skipped and the last valid segment before them is used instead.
+
+    Args:
+        delta_time_segment (np.ndarray): time of each segment, in seconds
+        delta_time_photon (np.ndarray): time of each photon, in seconds
+        segment_is_valid (np.ndarray, optional): boolean array, False for segments that should not be matched. Defaults to None.
+
+    Returns:
+        np.ndarray: integer index of the segment of each photon, -1 if there is no segment at or before the photon
+    """
+    # the segments are normally in time order already, but sort them to be sure
+    order = np.argsort(delta_time_segment, kind="stable")
+    # position (in the sorted segments) of the last segment at or before each photon
+    position = np.searchsorted(delta_time_segment[order], delta_time_photon, side="right") - 1
+    if segment_is_valid is not None:
+        # for every position, the last position at or before it that is valid
+        last_valid = np.maximum.accumulate(
+            np.where(segment_is_valid[order], np.arange(len(order)), -1)
+        )
+        position = np.where(position >= 0, last_valid[position], -1)
+    return np.where(position >= 0, order[position], -1)
+
+
+def broadcast_to_photons(
+    segment_values: np.ndarray, segment_index: np.ndarray, fill_value=None
+) -> np.ndarray:
+    """expand a segment-rate variable to photon rate using the segment index of each photon
+
+    Args:
+        segment_values (np.ndarray): value of the variable for each segment
+        segment_index (np.ndarray): the segment index of each photon, -1 if the photon has no segment
+        fill_value (optional): value for photons without a segment. Defaults to None, which is NaN for floats and 0 otherwise.
+
+    Returns:
+        np.ndarray: the variable at photon rate
+    """
+    if fill_value is None:
+        fill_value = np.NaN if np.issubdtype(segment_values.dtype, np.floating) else 0
+    return np.where(segment_index >= 0, segment_values[segment_index], fill_value)
+
+
+def _check_load_arguments(columns, time_format: str, layout="standard") -> list:
+    """validate the column, time format and layout arguments of the loader, and return the list of columns"""
+    if time_format not in TIME_FORMATS:
+        raise ValueError(f"time_format must be one of {list(TIME_FORMATS)}")
+    if layout not in LAYOUTS:
+        raise ValueError(f"layout must be one of {list(LAYOUTS)}")
+    columns = list(DEFAULT_PHOTON_COLUMNS) if columns is None else list(columns)
+    unknown_columns = set(columns) - set(PHOTON_FIELDS)
+    if unknown_columns:
+        raise ValueError(f"unknown photon columns {unknown_columns}")
+    return columns
+
+
+def _photon_dtype(columns: list, time_format: str, metadata: dict) -> np.dtype:
+    """structured dtype of a photon array with the requested columns, in the standard order"""
+    return np.dtype(
+        [
+            (field, TIME_FORMATS[time_format] if field == "delta_time" else fieldtype)
+            for field, fieldtype in PHOTON_FIELDS.items()
+            if field in columns
+        ],
+        metadata=metadata,
+    )
+
+
+def _compact_dtype(columns: list, time_format: str, metadata: dict) -> np.dtype:
+    """structured dtype of a photon array in the compact layout with the requested columns"""
+    fields = []
+    for field, fieldtype in PHOTON_FIELDS.items():
+        # segment-rate fields are kept in the segment table
+        if field not in columns or field in SEGMENT_VARIABLES:
+            continue
+        if field in COMPACT_OFFSET_FIELDS:
+            fields.append((COMPACT_OFFSET_FIELDS[field], "<f4"))
+        elif field == "delta_time":
+            fields.append((field, TIME_FORMATS[time_format]))
+        else:
+            fields.append((field, fieldtype))
+    fields.append(("seg_idx", "<i4"))
+    return np.dtype(fields, metadata=metadata)
+
+
+def expand_photons(photons: np.ndarray or pd.DataFrame, metadata=None):
+    """convert photons in the compact layout to the standard layout
+
+    The coordinates are added to the origin of the segment of each photon, and the segment-rate
+    variables are broadcast from the segment table to the photons. The offsets from the first
+    photon of a 20m segment are rounded to float32 by about 1e-11 degrees (a micrometer), and by
+    less than a millimeter for photons up to a few kilometers from the origin of their segment.
+    This is meant for the photons that are left after filtering, which are far fewer than the
+    photons of the beam.
+
+    Args:
+        photons (np.ndarray or pd.DataFrame): compact photon array, or a dataframe made from one. Other columns of a dataframe are kept after the photon columns.
+        metadata (dict, optional): metadata of the compact photon array. Defaults to None, which uses the metadata of the dtype of `photons`; this is required for a dataframe.
+
+    Returns:
+        np.ndarray or pd.DataFrame: the photons in the standard layout, of the same type as `photons`
+    """
+    if metadata is None:
+        metadata = photons.dtype.metadata
+    segment_table = metadata["segments"]
+    segment_index = np.asarray(photons["seg_idx"])
+    names = list(photons.columns if isinstance(photons, pd.DataFrame) else photons.dtype.names)
+
+    standard_vars = {}
+    for field in PHOTON_FIELDS:
+        if COMPACT_OFFSET_FIELDS.get(field) in names:
+            origin = metadata[f"{field.lower()}_origin"][segment_index]
+            standard_vars[field] = origin + np.asarray(
+                photons[COMPACT_OFFSET_FIELDS[field]], "<f8"
+            )
+        elif field in names:
+            standard_vars[field] = np.asarray(photons[field])
+        elif field in segment_table.dtype.names:
+            standard_vars[field] = broadcast_to_photons(segment_table[field], segment_index)
+
+    if isinstance(photons, pd.DataFrame):
+        other_columns = [
+            name
+            for name in names
+            if name not in standard_vars
+            and name not in ("seg_idx", *COMPACT_OFFSET_FIELDS.values())
+        ]
+        return pd.concat(
+            [pd.DataFrame(standard_vars, index=photons.index), photons[other_columns]], axis=1
+        )
+
+    standard_metadata = {
+        key: value
+        for key, value in metadata.items()
+        if key not in ("layout", "segments", "x_origin", "y_origin")
+    }
+    time_format = "seconds"
+    if "delta_time" in names and photons.dtype["delta_time"].kind == "M":
+        time_format = "datetime"
+    dtype = _photon_dtype(list(standard_vars), time_format, standard_metadata)
+    expanded = np.empty(len(photons), dtype=dtype)
+    for field, values in standard_vars.items():
+        expanded[field] = values
+    return expanded
+
+
+def select_photons(
+    photon_data: np.ndarray,
+    columns=None,
+    time_format="datetime",
+    bbox=None,
+    z_range=None,
+    min_signal_conf=None,
+) -> np.ndarray:
+    """apply the column projection and predicates of the loader to a photon array that is already decoded
+
+    The predicates have the same meaning as in `GranuleReader.load_beam`, and are evaluated on the
+    `X`, `Y`, `oc_sig_conf` and `Z_geoid` fields, so those must be in `photon_data` if the
+    matching predicate is used.
+
+    Args:
+        photon_data (np.ndarray): structured photon array, for example a memory-mapped cached beam
+        columns (list, optional): fields to include in the output. Defaults to None, which includes the `DEFAULT_PHOTON_COLUMNS`.
+        time_format (str, optional): `datetime` or `seconds`. Defaults to "datetime".
+        bbox (tuple, optional): (minx, miny, maxx, maxy) in degrees longitude and latitude. Defaults to None.
+        z_range (tuple, optional): (low, high) geoidal elevation. Defaults to None.
+        min_signal_conf (int, optional): minimum ocean signal confidence. Defaults to None.
+
+    Returns:
+        np.ndarray: new structured array of the selected photons, with the metadata of `photon_data`
+    """
+    columns = _check_load_arguments(columns, time_format)
+    keep = np.ones(len(photon_data), dtype=bool)
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        lon, lat = photon_data["X"], photon_data["Y"]
+        keep &= (lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy)
+    if min_signal_conf is not None:
+        keep &= photon_data["oc_sig_conf"] >= min_signal_conf
+    if z_range is not None:
+        low, high = z_range
+        z_geoid = photon_data["Z_geoid"]
+        keep &= (z_geoid > low) & (z_geoid < high)
+
+    metadata = dict(photon_data.dtype.metadata or {})
+    selected = np.empty(
+        np.count_nonzero(keep), dtype=_photon_dtype(columns, time_format, metadata)
+    )
+    for field in selected.dtype.names:
+        values = photon_data[field][keep]
+        # convert the times if they are not stored in the requested format
+        if field == "delta_time" and values.dtype != selected.dtype[field]:
+            if time_format == "datetime":
+                values = delta_time_to_datetime(values)
+            else:
+                values = (values - ATLAS_EPOCH) / np.timedelta64(1, "s")
+        selected[field] = values
+    return selected
+
+
+class _PhotonSelection:
+    """The photons of a beam that are still selected while the loader predicates are applied
+
+    Photons are selected by a span [start, stop) of the beam, and a boolean array `keep` over that
+    span. Variables are only read for the current span. Every array is cached with the start of
+    the span it was read for, and cut down to the current span when it is used again.
+    """
+
+    def __init__(self, granule, beam: str, start=0, stop=None):
+        self.granule = granule
+        self.beam = beam
+        self.backend = granule.backend
+        self.heights_path = f"{beam}/heights"
+        n_photons = self.backend.shape(f"{self.heights_path}/h_ph")[0]
+        self.start = start
+        self.stop = n_photons if stop is None else min(stop, n_photons)
+        self.keep = np.ones(max(self.stop - self.start, 0), dtype=bool)
+        self._cache = {}
+        self._segments = None
+
+    def is_empty(self) -> bool:
+        return self.stop == self.start
+
+    def _cached(self, key, read_function) -> np.ndarray:
+        if key not in self._cache:
+            self._cache[key] = (self.start, read_function())
+        offset, values = self._cache[key]
+        return values[self.start - offset : self.stop - offset]
+
+    def read(self, varname: str, column=None) -> np.ndarray:
+        """read a photon-rate variable of the `heights` group for the current span"""
+
+        def read_function():
+            span = slice(self.start, self.stop)
+            index = span if column is None else (span, column)
+            return self.backend.read(f"{self.heights_path}/{varname}", index)
+
+        return self._cached((varname, column), read_function)
+
+    def apply(self, mask: np.ndarray):
+        """deselect the photons of the current span where `mask` is False, then shrink the span to the first and last photon that are still selected"""
+        keep = self.keep & mask
+        kept_index = np.flatnonzero(keep)
+        if len(kept_index) == 0:
+            self.stop = self.start
+            self.keep = keep[:0]
+        else:
+            first, last = kept_index[0], kept_index[-1] + 1
+            self.start, self.stop = self.start + first, self.start + last
+            self.keep = keep[first:last]
+
+    def segment_index(self) -> np.ndarray:
+        """the index of the segment of each photon in the current span"""
+        if self._segments is None:
+            self._segments = self.granule._read_segments(self.beam)
+        delta_time_geophys_s, _, segment_is_valid = self._segments
+        return self._cached(
+            "segment_index",
+            lambda: segment_index_from_time(
+                delta_time_geophys_s, self.read("delta_time").astype("<f8"), segment_is_valid
+            ),
+        )
+
+    def broadcast(self, field: str) -> np.ndarray:
+        """a segment-rate variable at photon rate for the current span"""
+        segment_index = self.segment_index()
+        return broadcast_to_photons(self._segments[1][field], segment_index)
+
+    def dist_along(self) -> np.ndarray:
+        """the along-track distance of each photon in the current span, from the equator crossing of the reference ground track"""
+
+        def read_function():
+            segment_dist_x, segment_end = self.granule._read_segment_distances(self.beam)
+            # the photons are stored in the order of their segments, so the segment of a photon
+            # is found from its index in the beam, not from its time
+            photon_segment = np.searchsorted(
+                segment_end, np.arange(self.start, self.stop), side="right"
+            ).clip(max=len(segment_dist_x) - 1)
+            return segment_dist_x[photon_segment] + self.read("dist_ph_along")
+
+        return self._cached("dist_along", read_function)
+
+    def z_geoid(self) -> np.ndarray:
+        """the geoidal elevation of each photon in the current span"""
+        # combine the corrections into one
+        # this must be subtracted from Z ellipsoidal (see page 3 of data comparison manual v005)
+        return self._cached(
+            "Z_geoid",
+            lambda: self.read("h_ph")
+            - (self.broadcast("geoid_corr") + self.broadcast("geof2m_corr")),
+        )
+
+
+class GranuleReader:
+    """Open an ATL03 granule once and read every beam from the same file handle
+
+    The granule-level metadata (everything in `ancillary_data`) is parsed once when the reader is
+    created and shared by all of the beams, so looping over a granule with this object avoids
+    reopening the file and re-reading the metadata groups for every beam.
 
-    with Dataset(filename) as ds:
+    If a `cache_dir` is given, the decoded photons of every beam are stored there the first time
+    the beam is loaded, and on later runs the cached array is opened memory-mapped instead of
+    decoding the granule file again. The column projection and predicates are then applied to the
+    cached array.
 
+    Use as a context manager:
+
+        with GranuleReader(filename) as granule:
+            for beam, beamarray in granule:
+                ...
+    """
+
+    def __init__(
+        self, filename: str or PathLike, cache_dir=None, backend=None, chunk_cache_bytes=None
+    ):
+        """open the granule file and read the granule-level metadata
+
+        Args:
+            filename (str or PathLike): Path to granule NETCDF or native HDF5 file, or `archive.zip::member` for a granule in a zip archive
+            cache_dir (str or PathLike, optional): folder of the decoded photon cache. Defaults to None, which disables the cache.
+            backend (str, optional): `netcdf` or `hdf5`, see `granule_backends.open_granule`. Defaults to None, which chooses from the file extension.
+            chunk_cache_bytes (int, optional): size of the HDF5 chunk cache used to read each variable. Defaults to None, which uses the library default.
+        """
+        self.filename = filename
+        self.cache = None if cache_dir is None else PhotonCache(cache_dir)
+        self._fingerprint = None
+        # segment-rate variables of each beam, kept so they are read once when a beam is loaded in chunks
+        self._segment_cache = {}
+        self._segment_distance_cache = {}
+        self.backend = open_granule(
+            filename, backend=backend, chunk_cache_bytes=chunk_cache_bytes
+        )
         # get the granule-level metadata
-        metadata = {
-            varname: str(values[:])
-            for varname, values in ds.groups["ancillary_data"].variables.items()
+        self.granule_metadata = {
+            varname: str(self.backend.read(f"ancillary_data/{varname}"))
+            for varname in self.backend.variables("ancillary_data")
         }
+        # only beams with photon heights are useful
+        self.beams = [
+            beam
+            for beam in self.backend.groups()
+            if (beam in beamlist) and ("heights" in self.backend.groups(beam))
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self.iter_beams()
+
+    def iter_beams(self, beams=None, **kwargs):
+        """yield a tuple of (beam name, photon array) for every beam in the granule
+
+        Keyword arguments are passed on to `load_beam`
+
+        Args:
+            beams (list, optional): only load these beams, for example the beams selected from a `GranuleCatalog`. Defaults to None, which loads all of them.
+        """
+        for beam in self.beams:
+            if beams is None or beam in beams:
+                yield beam, self.load_beam(beam, **kwargs)
+
+    def close(self):
+        """close the underlying granule file"""
+        self.backend.close()
+
+    @property
+    def fingerprint(self) -> str:
+        """fingerprint of the granule file used as the key of the photon cache"""
+        if self._fingerprint is None:
+            self._fingerprint = granule_fingerprint(self.filename)
+        return self._fingerprint
+
+    def beam_metadata(self, beam: str) -> dict:
+        """get the granule-level and beam-level metadata for one beam, without loading any photons
+
+        Args:
+            beam (str): name of the beam, e.g. `gt1l`
+
+        Returns:
+            dict: metadata of the beam
+        """
+        # start from a copy so the granule-level metadata is not changed between beams
+        metadata = dict(self.granule_metadata)
         metadata["beam"] = beam
-        # add the beam-level metadata by looping over attribute names and getting them from the
-        # netcdf group
-        for attribute_name in ds.groups[beam].ncattrs():
-            metadata[attribute_name] = str(getattr(ds.groups[beam], attribute_name))
+        # add the beam-level metadata from the attributes of the beam group
+        metadata.update(self.backend.attributes(beam))
 
         try:
             metadata["ocean_high_conf_perc"] = float(
-                ds.groups["quality_assessment"]
-                .groups[beam]
-                .variables["qa_perc_signal_conf_ph_high"][:, 1]
+                self.backend.read(
+                    f"quality_assessment/{beam}/qa_perc_signal_conf_ph_high", (slice(None), 1)
+                )
             )
         except KeyError:
             metadata["ocean_high_conf_perc"] = np.NaN
+        return metadata
 
-        # this is in a try block because it raises a keyerror if the beam is missing from the granule
-        try:
-            ds.groups[beam].groups["heights"]
+    def load_beam_segments(self, beam: str) -> np.ndarray:
+        """return an array of the 20m geolocation segments of a beam, without reading any photons
 
-        except KeyError:
-            return None
-        # get array-type data
-        Y = ds.groups[beam].groups["heights"].variables["lat_ph"][:]
-        X = ds.groups[beam].groups["heights"].variables["lon_ph"][:]
-        Z = ds.groups[beam].groups["heights"].variables["h_ph"][:]
+        The segment arrays are roughly a hundred times smaller than the photon arrays, so this is
+        the fast way to get the location and photon counts of a track. The location of a segment
+        is the location of its reference photon, which is NaN for segments without photons. The
+        segment times are kept as seconds since 2018-01-01.
 
-        # based on the data documentation, the dates are referenced to the 2018-01-01 so the
-        # datetimes are shifted accordingly
-        delta_time_s = ds.groups[beam].groups["heights"].variables["delta_time"][:]
-        delta_time = num2pydate(delta_time_s, "seconds since 2018-01-01")
+        Args:
+            beam (str): name of the beam, e.g. `gt1l`
 
-        ocean_sig = ds.groups[beam].groups["heights"].variables["signal_conf_ph"][:, 1]
-        land_sig = ds.groups[beam].groups["heights"].variables["signal_conf_ph"][:, 0]
+        Returns:
+            np.ndarray: structured array of the segments, with the same metadata as `load_beam`, or None if the beam has no photon data
+        """
+        if beam not in self.beams:
+            return None
+        metadata = self.beam_metadata(beam)
+        # only the shape is needed, so no photon data is read
+        metadata["n_photons"] = self.backend.shape(f"{beam}/heights/h_ph")[0]
 
-        # need to deal with geophysical variable time differenently since they're captured at a different rate
-        delta_time_geophys_s = (
-            ds.groups[beam].groups["geophys_corr"].variables["delta_time"][:]
+        dtype = np.dtype(
+            [(field, fieldtype) for field, (_, fieldtype) in SEGMENT_FIELDS.items()],
+            metadata=metadata,
         )
-        delta_time_geophys = num2pydate(delta_time_geophys_s, "seconds since 2018-01-01")
+        segment_vars = {}
+        for field, (varpath, fieldtype) in SEGMENT_FIELDS.items():
+            # missing values of float variables become NaN, and missing counts become 0
+            segment_vars[field] = self.backend.read_filled(
+                f"{beam}/{varpath}", np.NaN if np.dtype(fieldtype).kind == "f" else 0
+            )
+        segment_data = np.empty(len(segment_vars["ph_count"]), dtype=dtype)
+        for field, values in segment_vars.items():
+            segment_data[field] = values
+        return segment_data
 
-        # ----- ASSIGNING SEGMENT-RATE VARIABLES----------- #
+    def segment_solar_elevation(self, beam: str) -> np.ndarray:
+        """read the solar elevation of every 20m segment of a beam, without reading any photons
 
-        # some variables are given per 20m segment, so they need to be interpolated to assign the correct one to each photon.
+        Args:
+            beam (str): name of the beam, e.g. `gt1l`
 
-        # to index these we need to set the first value to the first value of the
-        # photon returns. This is because the photon time values start in the middle of a segment
+        Returns:
+            np.ndarray: solar elevation in degrees, or None if the granule does not have it
+        """
+        try:
+            return self.backend.read_filled(f"{beam}/geolocation/solar_elevation", np.NaN)
+        except KeyError:
+            return None
 
-        delta_time_geophys[0] = delta_time[0]
+    def _read_segments(self, beam: str) -> tuple:
+        """read the segment-rate variables of a beam, or get them from the reader if they were already read
 
-        # this will make diagnosing problems much easier.
+        Args:
+            beam (str): name of the beam, e.g. `gt1l`
 
-        # get the geophysical variables
-        geo_f2m_segment = (
-            ds.groups[beam]
-            .groups["geophys_corr"]
-            .variables["geoid_free2mean"][:]
-            .filled(np.NaN)
-        )
-        geoid_segment = (
-            ds.groups[beam].groups["geophys_corr"].variables["geoid"][:].filled(np.NaN)
+        Returns:
+            tuple: (segment times, dictionary of segment-rate arrays keyed by photon field name, boolean array of the segments without missing values)
+        """
+        if beam in self._segment_cache:
+            return self._segment_cache[beam]
+        # time of the first photon of the beam, in seconds since 2018-01-01
+        first_photon_time = float(self.backend.read(f"{beam}/heights/delta_time", 0))
+        # need to deal with geophysical variable time differenently since they're captured at a different rate
+        # the times are compared as float seconds, so no datetime objects are needed for the matching
+        delta_time_geophys_s = np.array(
+            self.backend.read(f"{beam}/geophys_corr/delta_time"), dtype="<f8"
         )
-        tide_ocean_segment = (
-            ds.groups[beam].groups["geophys_corr"].variables["tide_ocean"][:].filled(np.NaN)
+        # to index these we need to set the first value to the first value of the
+        # photon returns. This is because the photon time values start in the middle of a segment
+        delta_time_geophys_s[0] = first_photon_time
+
+        # all the segment variables are read, even if only some are requested. They are small
+        # compared to the photon variables, and a segment with a missing value in any of them is
+        # skipped, so the values assigned to the photons do not depend on the requested columns
+        segment_vars = {
+            field: self.backend.read_filled(
+                f"{beam}/{varpath}", 0 if field == "ph_count" else np.NaN
+            )
+            for field, varpath in SEGMENT_VARIABLES.items()
+        }
+        # like the pandas asof that was used before, segments with a missing value in any variable are skipped
+        segment_is_valid = ~np.isnan(
+            np.stack([values for field, values in segment_vars.items() if field != "ph_count"])
+        ).any(axis=0)
+        self._segment_cache[beam] = delta_time_geophys_s, segment_vars, segment_is_valid
+        return self._segment_cache[beam]
+
+    def _read_segment_distances(self, beam: str) -> tuple:
+        """read the along-track distance of the start of every segment of a beam, and the index of the photon after its last photon"""
+        if beam not in self._segment_distance_cache:
+            segment_dist_x = self.backend.read_filled(
+                f"{beam}/geolocation/segment_dist_x", np.NaN
+            ).astype("<f8")
+            segment_ph_cnt = self.backend.read_filled(f"{beam}/geolocation/segment_ph_cnt", 0)
+            self._segment_distance_cache[beam] = segment_dist_x, np.cumsum(segment_ph_cnt)
+        return self._segment_distance_cache[beam]
+
+    def load_beam(
+        self,
+        beam: str,
+        columns=None,
+        time_format="datetime",
+        bbox=None,
+        z_range=None,
+        min_signal_conf=None,
+        layout="standard",
+    ) -> np.ndarray:
+        """return an array of photon-level details for a given beam of the granule.
+
+        Granule-level metadata is also included with the array. Only the netcdf variables that are
+        needed for the requested columns are read.
+
+        The predicates (`bbox`, `z_range` and `min_signal_conf`) are evaluated first, on the
+        variables they need, and only the photons that pass all of them are broadcast and stored
+        in the array. Variables are only read for the span of the beam that contains photons that
+        passed the predicates evaluated before them.
+
+        Args:
+            beam (str): name of the beam, e.g. `gt1l`
+            columns (list, optional): fields of `PHOTON_FIELDS` to include in the array. Defaults to None, which includes all of them except the `OPTIONAL_PHOTON_FIELDS`.
+            time_format (str, optional): `datetime` to store the photon times as datetime64[us], or `seconds` to keep the raw float64 seconds since 2018-01-01. Defaults to "datetime".
+            bbox (tuple, optional): (minx, miny, maxx, maxy) in degrees longitude and latitude. Only photons inside the box are kept. Defaults to None.
+            z_range (tuple, optional): (low, high) geoidal elevation. Only photons with low < Z_geoid < high are kept. Defaults to None.
+            min_signal_conf (int, optional): only photons with an ocean signal confidence of at least this value are kept. Defaults to None.
+            layout (str, optional): `standard`, or `compact` for roughly half the memory per photon, see `LAYOUTS` and `expand_photons`. Defaults to "standard".
+
+        Returns:
+            np.ndarray: structured array of the photons, or None if the beam has no photon data
+        """
+        columns = _check_load_arguments(columns, time_format, layout)
+        if not self._use_cache(columns):
+            return self._decode_beam(
+                beam, columns, time_format, bbox, z_range, min_signal_conf, layout=layout
+            )
+
+        photon_data = self._load_cached_beam(beam)
+        if photon_data is None:
+            return None
+        return self._select_cached(
+            beam, photon_data, columns, time_format, bbox, z_range, min_signal_conf, layout
         )
-        pointing_vec_az_segment = (
-            ds.groups[beam].groups["geolocation"].variables["ref_azimuth"][:].filled(np.NaN)
+
+    def iter_beam_chunks(
+        self,
+        beam: str,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        columns=None,
+        time_format="datetime",
+        bbox=None,
+        z_range=None,
+        min_signal_conf=None,
+        layout="standard",
+    ):
+        """yield the photons of a beam in consecutive along-track chunks
+
+        Each chunk is made from `chunk_size` photons of the beam, before the predicates are applied,
+        so the memory that is needed does not depend on the length of the beam. In the standard
+        layout, concatenating the chunks gives the same array as `load_beam` with the same
+        arguments. In the compact layout, each chunk has its own segment table and coordinate
+        origins in its metadata, so the chunks have to be expanded with `expand_photons` one at a
+        time before they are concatenated. That gives the expanded photons of `load_beam`, except
+        for the float32 rounding of the coordinate offsets of segments that are split over two
+        chunks. The chunks do not overlap; processing that needs neighbouring photons should keep
+        them from the previous chunk.
+
+        If the reader has a cache and the beam is not cached yet, every chunk is decoded with the
+        default fields and appended to the cache before the predicates are applied to it, so the
+        cache is filled without holding the whole beam in memory.
+
+        Args:
+            beam (str): name of the beam, e.g. `gt1l`
+            chunk_size (int, optional): number of photons of the beam in each chunk. Defaults to DEFAULT_CHUNK_SIZE.
+
+        The other arguments are the same as for `load_beam`.
+
+        Yields:
+            np.ndarray: structured array of the photons in the chunk, with the metadata of the beam
+        """
+        columns = _check_load_arguments(columns, time_format, layout)
+        if beam not in self.beams:
+            return
+        n_photons = self.backend.shape(f"{beam}/heights/h_ph")[0]
+        use_cache = self._use_cache(columns)
+        photon_data = self.cache.load(self.fingerprint, beam) if use_cache else None
+        if use_cache and photon_data is None:
+            # the cache is filled one chunk at a time, so the whole beam is never in memory
+            decoded_chunks = (
+                self._decode_beam(
+                    beam,
+                    DEFAULT_PHOTON_COLUMNS,
+                    "seconds",
+                    start=start,
+                    stop=min(start + chunk_size, n_photons),
+                )
+                for start in range(0, n_photons, chunk_size)
+            )
+            for chunk in self.cache.store_chunks(
+                self.fingerprint, beam, decoded_chunks, n_photons
+            ):
+                yield self._select_cached(
+                    beam, chunk, columns, time_format, bbox, z_range, min_signal_conf, layout
+                )
+            return
+        for start in range(0, n_photons, chunk_size):
+            stop = min(start + chunk_size, n_photons)
+            if photon_data is None:
+                yield self._decode_beam(
+                    beam,
+                    columns,
+                    time_format,
+                    bbox,
+                    z_range,
+                    min_signal_conf,
+                    start=start,
+                    stop=stop,
+                    layout=layout,
+                )
+            else:
+                yield self._select_cached(
+                    beam,
+                    photon_data[start:stop],
+                    columns,
+                    time_format,
+                    bbox,
+                    z_range,
+                    min_signal_conf,
+                    layout,
+                )
+
+    def _use_cache(self, columns: list) -> bool:
+        """whether the requested columns can be read from the cache, the optional fields are not cached"""
+        return self.cache is not None and not set(columns) & set(OPTIONAL_PHOTON_FIELDS)
+
+    def _load_cached_beam(self, beam: str) -> np.ndarray:
+        """get the full photon array of a beam from the cache, decoding and storing it first if it is not there yet"""
+        photon_data = self.cache.load(self.fingerprint, beam)
+        if photon_data is None:
+            # the times are cached as seconds so they can be converted to either time format
+            photon_data = self._decode_beam(beam, DEFAULT_PHOTON_COLUMNS, "seconds")
+            if photon_data is None:
+                return None
+            photon_data = self.cache.store(self.fingerprint, beam, photon_data)
+        return photon_data
+
+    def _select_cached(
+        self,
+        beam: str,
+        photon_data: np.ndarray,
+        columns: list,
+        time_format: str,
+        bbox,
+        z_range,
+        min_signal_conf,
+        layout: str,
+    ) -> np.ndarray:
+        """apply the column projection, predicates and layout to (part of) a cached beam"""
+        if layout == "standard":
+            return select_photons(
+                photon_data,
+                columns=columns,
+                time_format=time_format,
+                bbox=bbox,
+                z_range=z_range,
+                min_signal_conf=min_signal_conf,
+            )
+        # the times in seconds are needed to find the segment of each photon
+        photon_fields = [
+            field
+            for field in PHOTON_FIELDS
+            if field not in SEGMENT_VARIABLES and (field in columns or field == "delta_time")
+        ]
+        selected = select_photons(
+            photon_data,
+            columns=photon_fields,
+            time_format="seconds",
+            bbox=bbox,
+            z_range=z_range,
+            min_signal_conf=min_signal_conf,
         )
-        pointing_vec_elev_segment = (
-            ds.groups[beam].groups["geolocation"].variables["ref_elev"][:].filled(np.NaN)
+        delta_time_geophys_s, _, segment_is_valid = self._read_segments(beam)
+        segment_index = segment_index_from_time(
+            delta_time_geophys_s, selected["delta_time"], segment_is_valid
         )
-        dac_correction_segment = (
-            ds.groups[beam].groups["geophys_corr"].variables["dac"][:].filled(np.NaN)
+        photon_vars = {field: selected[field] for field in photon_fields}
+        return self._compact_photons(
+            beam,
+            photon_vars,
+            segment_index,
+            columns,
+            time_format,
+            dict(selected.dtype.metadata),
         )
-        ph_count_segment = (
-            ds.groups[beam].groups["geolocation"].variables["segment_ph_cnt"][:].filled(0)
+
+    def _compact_photons(
+        self,
+        beam: str,
+        photon_vars: dict,
+        segment_index: np.ndarray,
+        columns: list,
+        time_format: str,
+        metadata: dict,
+    ) -> np.ndarray:
+        """make a photon array in the compact layout from the photon-rate values of the selected photons
+
+        Args:
+            beam (str): name of the beam, e.g. `gt1l`
+            photon_vars (dict): photon-rate values of the selected photons, keyed by field of `PHOTON_FIELDS`, with the times as seconds or datetimes
+            segment_index (np.ndarray): the index of the segment of each selected photon
+            columns (list): fields of `PHOTON_FIELDS` requested by the caller
+            time_format (str): `datetime` or `seconds`
+            metadata (dict): metadata of the beam
+
+        Returns:
+            np.ndarray: structured array of the photons in the compact layout
+        """
+        _, segment_vars, _ = self._read_segments(beam)
+        # the table only holds the requested segment-rate fields, with the dtypes of the standard layout
+        segment_fields = [field for field in SEGMENT_VARIABLES if field in columns]
+        segment_table = np.empty(
+            len(segment_vars["ph_count"]),
+            dtype=[(field, PHOTON_FIELDS[field]) for field in segment_fields],
         )
-        full_sat_segment = (
-            ds.groups[beam].groups["geolocation"].variables["full_sat_fract"][:].filled(np.NaN)
+        for field in segment_fields:
+            segment_table[field] = segment_vars[field]
+
+        # the origin of a segment is its first selected photon, so the offsets are only a few
+        # meters and keep the precision of the coordinates in float32. The last origin is used
+        # by the photons without a segment (`seg_idx` of -1)
+        n_segments = len(segment_table)
+        segment_group = np.where(segment_index < 0, n_segments, segment_index)
+        groups, first_photon = np.unique(segment_group, return_index=True)
+        origin = {}
+        for field in COMPACT_OFFSET_FIELDS:
+            if field in photon_vars:
+                origin[field] = np.zeros(n_segments + 1)
+                origin[field][groups] = photon_vars[field][first_photon]
+        metadata.update(
+            layout="compact",
+            x_origin=origin.get("X"),
+            y_origin=origin.get("Y"),
+            segments=segment_table,
         )
-        # combine the corrections into one
-        # this must be subtracted from Z ellipsoidal (see page 3 of data comparison manual v005)
 
-        # to assign the correct correction value, we need to get the correction at a certain time
-        # to do this we can align them using the pandas asof
-
-        # switch into pandas to use as_of function
-        # TODO use scipy.interpolate?
-        # or maybe not: " Calling interp1d with NaNs present in input values results in undefined behaviour." from scipy.interpolate docs
-
-        segment_level_df = pd.DataFrame(
-            {
-                "geoid_correction": geoid_segment,
-                "tide_ocean": tide_ocean_segment,
-                "geo_f2m": geo_f2m_segment,
-                "pointing_vec_az": pointing_vec_az_segment,
-                "pointing_vec_elev": pointing_vec_elev_segment,
-                "dac_correction": dac_correction_segment,
-                "ph_count_segment": ph_count_segment,
-                "full_sat_segment": full_sat_segment,
-            },
-            index=delta_time_geophys,
-        ).sort_index()
-
-        # return segment_level_df,delta_time
-
-        interpolated_df = segment_level_df.asof(delta_time).to_records()
-        # get the value for every single photon
-        geoid_tide_free = interpolated_df["geoid_correction"]
-        tide_ocean = interpolated_df["tide_ocean"]
-        geof2m = interpolated_df["geo_f2m"]
-        p_vec_az = interpolated_df["pointing_vec_az"]
-        p_vec_elev = interpolated_df["pointing_vec_elev"]
-        dac_corr = interpolated_df["dac_correction"]
-        ph_count_photon_interp = interpolated_df["ph_count_segment"]
-        full_sat = interpolated_df["full_sat_segment"]
-
-        correction = geoid_tide_free + geof2m
-
-        # get the corrected Z vals
-        Z_corrected = Z - correction
-
-        # creating a structured array
-        dtype = np.dtype(
-            [
-                ("X", "<f8"),
-                ("Y", "<f8"),
-                ("Z_ellip", "<f4"),
-                ("Z_geoid", "<f4"),
-                ("geoid_corr", "<f4"),
-                ("tide_ocean_corr", "<f4"),
-                ("geof2m_corr", "<f4"),
-                # TODO there is still a rounding error on the times here
-                ("delta_time", "<M8[us]"),
-                ("oc_sig_conf", "<i1"),
-                ("land_sig_conf", "<i1"),
-                ("p_vec_az", "<f4"),
-                ("p_vec_elev", "<f4"),
-                ("dac_corr", "<f4"),
-                ("ph_count", "<i4"),
-                ("full_sat", "<f4"),
-            ],
-            metadata=metadata,
-        )
+        dtype = _compact_dtype(columns, time_format, metadata)
+        photon_data = np.empty(len(segment_index), dtype=dtype)
+        for field, values in photon_vars.items():
+            if field in COMPACT_OFFSET_FIELDS:
+                photon_data[COMPACT_OFFSET_FIELDS[field]] = (
+                    values - origin[field][segment_group]
+                )
+            elif field == "delta_time" and values.dtype != dtype["delta_time"]:
+                photon_data[field] = delta_time_to_datetime(values)
+            elif field in dtype.names:
+                photon_data[field] = values
+        photon_data["seg_idx"] = segment_index
+        return photon_data
+
+    def _decode_beam(
+        self,
+        beam: str,
+        columns: list,
+        time_format: str,
+        bbox=None,
+        z_range=None,
+        min_signal_conf=None,
+        start=0,
+        stop=None,
+        layout="standard",
+    ) -> np.ndarray:
+        """read the photons of a beam from the granule file, see `load_beam` for the arguments
+
+        Only the photons in [start, stop) of the beam are considered.
+        """
+        # the beam can be missing from the granule, or have no photon heights
+        if beam not in self.beams:
+            return None
+        metadata = self.beam_metadata(beam)
+        # the number of photons in the beam before any predicates are applied
+        metadata["n_photons"] = self.backend.shape(f"{beam}/heights/h_ph")[0]
+
+        selection = _PhotonSelection(self, beam, start, stop)
+
+        # ----- PREDICATES ----------- #
+        # the cheapest and most selective predicates are evaluated first
+        if bbox is not None:
+            minx, miny, maxx, maxy = bbox
+            lon, lat = selection.read("lon_ph"), selection.read("lat_ph")
+            selection.apply((lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy))
+        # the signal confidence has a column for each surface type, land is 0 and ocean is 1
+        if min_signal_conf is not None:
+            selection.apply(selection.read("signal_conf_ph", 1) >= min_signal_conf)
+        if z_range is not None:
+            low, high = z_range
+            z_geoid = selection.z_geoid()
+            selection.apply((z_geoid > low) & (z_geoid < high))
+
+        # ----- ASSIGNING VARIABLES----------- #
+        # some variables are given per 20m segment, so they need to be interpolated to assign the
+        # correct one to each photon. They are only broadcast for the photons that are kept
+        photon_vars = {}
+        for field in columns:
+            if selection.is_empty():
+                break
+            # in the compact layout, the segment-rate variables are not broadcast to the photons
+            if layout == "compact" and field in SEGMENT_VARIABLES:
+                continue
+            if field in PHOTON_VARIABLES:
+                values = selection.read(PHOTON_VARIABLES[field])
+            elif field == "oc_sig_conf":
+                values = selection.read("signal_conf_ph", 1)
+            elif field == "land_sig_conf":
+                values = selection.read("signal_conf_ph", 0)
+            elif field == "delta_time":
+                # based on the data documentation, the dates are referenced to the 2018-01-01
+                values = selection.read("delta_time").astype("<f8")
+                if time_format == "datetime":
+                    values = delta_time_to_datetime(values)
+            elif field == "Z_geoid":
+                values = selection.z_geoid()
+            elif field == "dist_along":
+                values = selection.dist_along()
+            else:
+                values = selection.broadcast(field)
+            photon_vars[field] = values[selection.keep]
+
+        if layout == "compact":
+            if selection.is_empty():
+                segment_index = np.empty(0, dtype="<i4")
+            else:
+                segment_index = selection.segment_index()[selection.keep]
+            return self._compact_photons(
+                beam, photon_vars, segment_index, columns, time_format, metadata
+            )
+
+        # creating a structured array, with the fields in the standard order
+        dtype = _photon_dtype(columns, time_format, metadata)
         # then we assign each 1darray to the structured array
-        photon_data = np.empty(len(X), dtype=dtype)
-        photon_data["X"] = X
-        photon_data["Y"] = Y
-        photon_data["Z_ellip"] = Z
-        photon_data["geoid_corr"] = geoid_tide_free
-        photon_data["tide_ocean_corr"] = tide_ocean
-        photon_data["geof2m_corr"] = geof2m
-        photon_data["Z_geoid"] = Z_corrected
-        photon_data["delta_time"] = delta_time
-        photon_data["oc_sig_conf"] = ocean_sig
-        photon_data["land_sig_conf"] = land_sig
-        photon_data["p_vec_az"] = p_vec_az
-        photon_data["p_vec_elev"] = p_vec_elev
-        photon_data["dac_corr"] = dac_corr
-        # NANs need to be replaced with integer 0s
-        photon_data["ph_count"] = np.where(
-            np.isnan(ph_count_photon_interp), 0, ph_count_photon_interp
-        )
-        photon_data["full_sat"] = full_sat
+        photon_data = np.empty(np.count_nonzero(selection.keep), dtype=dtype)
+        for field, values in photon_vars.items():
+            photon_data[field] = values
 
         return photon_data
+
+
+def load_beam_array_ncds(filename: str or PathLike, beam: str, **kwargs) -> np.ndarray:
+    """return an array of photon-level details for a given file and beam name.
+
+    Granule-level metadata is also included with the array. To read more than one beam from the
+    same granule, use a `GranuleReader` so the file is only opened once. Keyword arguments are
+    passed on to `GranuleReader.load_beam`.
+    """
+    with GranuleReader(filename) as granule:
+        return granule.load_beam(beam, **kwargs)
@@ -291,7 +291,7 @@ def _data_search(product_short_name, bounding_box, temporal, bounds_filepath=Non
     return latest_version, aoi, polygon, geojson, granules
 
 
-def _request_async_func(page_num, session, param_dict, base_url, path):
+def _request_async_func(page_num, session, param_dict, base_url, path, keep_zipped=False):
     param_dict["request_mode"] = "async"
     # Request data service for each page number, and unzip outputs
     # print(page_num,session,param_dict,base_url)
@@ -368,8 +368,13 @@ def _request_async_func(page_num, session, param_dict, base_url, path):
             zip_response = session.get(downloadURL)
             # Raise bad request: Loop will stop for bad response code.
             zip_response.raise_for_status()
-            with zipfile.ZipFile(io.BytesIO(zip_response.content)) as z:
-                z.extractall(path)
+            if keep_zipped:
+                # the granules are read straight from the archive, so it is not extracted
+                with open(os.path.join(path, orderID + ".zip"), "wb") as outfile:
+                    outfile.write(zip_response.content)
+            else:
+                with zipfile.ZipFile(io.BytesIO(zip_response.content)) as z:
+                    z.extractall(path)
             print("Data request", page_val, "is complete.")
         else:
             print("Request failed.")
@@ -420,7 +425,13 @@ def _clean_output_folders(path):
 
 
 def request_data_download(
-    product_short_name, bounding_box, folderpath, vars_, bounds_filepath=None
+    product_short_name,
+    bounding_box,
+    folderpath,
+    vars_,
+    bounds_filepath=None,
+    reformat_netcdf=True,
+    keep_zipped=False,
 ):
     path = folderpath + "/" + product_short_name
     if os.listdir(path):
@@ -460,6 +471,9 @@ def request_data_download(
         aoi=aoi,
         geojson=geojson,
     )
+    # the native HDF5 granules can be read directly, so the reformatting can be skipped
+    if not reformat_netcdf:
+        reformat = ""
     coverage = vars_
     # Set the request mode to asynchronous if the number of granules is over 100, otherwise synchronous is enabled by default
     if len(granules) > 100:
@@ -524,10 +538,12 @@ def request_data_download(
 
     if request_async:
         print("requesting async")
-        _request_async_func(page_num, session, param_dict, BASE_URL, path)
+        _request_async_func(page_num, session, param_dict, BASE_URL, path, keep_zipped)
     else:
         _request_streaming(page_num, session, param_dict, BASE_URL, path)
-        _unzip_output_file(path)
+        # the granules can be read from the zip archives, which saves extracting them
+        if not keep_zipped:
+            _unzip_output_file(path)
 
     _clean_output_folders(path)
 
@@ -542,13 +558,17 @@ def request_segments_only(shapefile_filepath, folderpath):
     )
 
 
-def request_full_data_shapefile(shapefile_filepath, folderpath):
+def request_full_data_shapefile(
+    shapefile_filepath, folderpath, reformat_netcdf=True, keep_zipped=False
+):
     request_data_download(
         "ATL03",
         vars_=atl_03_vars,
         bounds_filepath=shapefile_filepath,
         bounding_box="",
         folderpath=folderpath,
+        reformat_netcdf=reformat_netcdf,
+        keep_zipped=keep_zipped,
     )
 
 
@@ -0,0 +1,270 @@
+"""Backends that read the groups, attributes and variables of an ATL03 granule file
+
+Two file formats are supported with the same interface:
+
+- `NetCDFBackend` reads the NetCDF4-CF files made by the reformatting service of NSIDC
+- `HDF5Backend` reads the native ATL03 HDF5 files with h5py, so the reformat step can be skipped
+
+Everything is addressed by its path in the file, e.g. `gt1l/heights/h_ph`. Values are returned as
+plain numpy arrays with byte strings decoded, so the loader does not depend on the format.
+
+Granules can also be read straight from the zip archives delivered by NSIDC, without extracting
+them, using a path of the form `archive.zip::member`, e.g.
+`ATL03/5000003064418.zip::5000003064418/processed_ATL03_20201202073402_10560901_005_01.h5`.
+"""
+import io
+import os
+import zipfile
+from os import PathLike
+
+import h5py
+import numpy as np
+from netCDF4 import Dataset
+
+# file extensions of granules, and the backend used for each of them
+GRANULE_EXTENSIONS = {".nc": "netcdf", ".h5": "hdf5"}
+
+# separates the path of a zip archive from the name of the granule inside it
+ARCHIVE_SEPARATOR = "::"
+
+# netcdf4 stores dimensions without a coordinate variable as HDF5 datasets with this name attribute
+_NETCDF_DIMENSION_NAME = b"This is a netCDF dimension but not a netCDF variable"
+
+
+def split_archive_path(filename: str or PathLike) -> tuple:
+    """split a granule path into the archive and the member inside it
+
+    Args:
+        filename (str or PathLike): path of a granule file, or `archive.zip::member` for a granule in a zip archive
+
+    Returns:
+        tuple: the archive path and the member name, or the path and None if the granule is not in an archive
+    """
+    filename = os.fspath(filename)
+    if ARCHIVE_SEPARATOR in filename:
+        archive, member = filename.split(ARCHIVE_SEPARATOR, 1)
+        return archive, member
+    return filename, None
+
+
+def granule_name(filename: str or PathLike) -> str:
+    """name of a granule without its folder, archive or extension"""
+    archive, member = split_archive_path(filename)
+    path = archive if member is None else member
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def archive_members(archive: str or PathLike) -> list:
+    """names of the granules in a zip archive, skipping the other files NSIDC adds to an order"""
+    with zipfile.ZipFile(archive) as zip_file:
+        return [
+            name
+            for name in zip_file.namelist()
+            if os.path.splitext(name)[1].lower() in GRANULE_EXTENSIONS
+        ]
+
+
+def archive_member_info(filename: str or PathLike) -> zipfile.ZipInfo:
+    """zip directory entry of a granule in an archive, with its size and CRC"""
+    archive, member = split_archive_path(filename)
+    with zipfile.ZipFile(archive) as zip_file:
+        return zip_file.getinfo(member)
+
+
+def open_archive_member(archive: str or PathLike, member: str) -> io.IOBase:
+    """open a granule in a zip archive as a seekable file object
+
+    Members that are stored without compression are read straight from the archive. Seeking in a
+    compressed member decompresses it again from the start, which is far too slow for the random
+    access of HDF5, so those members are decompressed into memory once.
+
+    Args:
+        archive (str or PathLike): path of the zip archive
+        member (str): name of the granule inside the archive
+
+    Returns:
+        io.IOBase: binary file object of the granule
+    """
+    with zipfile.ZipFile(archive) as zip_file:
+        if zip_file.getinfo(member).compress_type == zipfile.ZIP_STORED:
+            # the archive stays open until the member is closed
+            return zip_file.open(member)
+        return io.BytesIO(zip_file.read(member))
+
+
+def _is_netcdf_dimension(dataset) -> bool:
+    """check if an HDF5 dataset only stores a netCDF dimension, and is not a variable"""
+    name = dataset.attrs.get("NAME", b"")
+    return isinstance(name, bytes) and name.startswith(_NETCDF_DIMENSION_NAME)
+
+
+def _decode_strings(values: np.ndarray) -> np.ndarray:
+    """decode byte strings in an array to python strings, other arrays are returned unchanged"""
+    if values.dtype.kind == "S":
+        return values.astype(str)
+    if values.dtype.kind == "O":
+        return np.array(
+            [value.decode() if isinstance(value, bytes) else value for value in values.flat],
+            dtype=object,
+        ).reshape(values.shape)
+    return values
+
+
+def _attribute_to_str(value) -> str:
+    """format an attribute value as a string, the same way for both file formats"""
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.ndarray):
+        return str(_decode_strings(value))
+    return str(value)
+
+
+class NetCDFBackend:
+    """Read a NetCDF4 granule with netCDF4-python"""
+
+    def __init__(self, filename: str or PathLike, chunk_cache_bytes=None):
+        """
+        Args:
+            filename (str or PathLike): Path to granule NETCDF file, or `archive.zip::member`
+            chunk_cache_bytes (int, optional): size of the HDF5 chunk cache of each variable that is read. Defaults to None, which uses the netCDF default.
+        """
+        archive, member = split_archive_path(filename)
+        if member is None:
+            self.ds = Dataset(filename)
+        else:
+            # netCDF can only open a file in an archive from memory
+            with zipfile.ZipFile(archive) as zip_file:
+                self.ds = Dataset(member, memory=zip_file.read(member))
+        self.chunk_cache_bytes = chunk_cache_bytes
+
+    def close(self):
+        self.ds.close()
+
+    def _group(self, path: str):
+        try:
+            return self.ds[path] if path else self.ds
+        except IndexError as missing:
+            raise KeyError(path) from missing
+
+    def _variable(self, path: str):
+        variable = self._group(path)
+        if self.chunk_cache_bytes is not None:
+            variable.set_var_chunk_cache(size=self.chunk_cache_bytes)
+        return variable
+
+    def groups(self, path="") -> list:
+        """names of the groups in a group"""
+        return list(self._group(path).groups)
+
+    def variables(self, path="") -> list:
+        """names of the variables in a group"""
+        return list(self._group(path).variables)
+
+    def attributes(self, path="") -> dict:
+        """attributes of a group as strings"""
+        group = self._group(path)
+        return {name: _attribute_to_str(getattr(group, name)) for name in group.ncattrs()}
+
+    def shape(self, path: str) -> tuple:
+        return self._group(path).shape
+
+    def read(self, path: str, index=Ellipsis) -> np.ndarray:
+        """read a variable, or the part of it selected by `index`, without masking missing values"""
+        return _decode_strings(np.asarray(self._variable(path)[index]))
+
+    def read_filled(self, path: str, fill_value) -> np.ndarray:
+        """read a whole variable with the values that netCDF masks as missing replaced by `fill_value`"""
+        return np.ma.filled(self._variable(path)[:], fill_value)
+
+
+class HDF5Backend:
+    """Read a native ATL03 HDF5 granule with h5py
+
+    Variables are read with contiguous slices, which maps directly on to the HDF5 chunks of the
+    native layout. NetCDF4 files can also be read with this backend, as they are HDF5 files.
+    """
+
+    def __init__(self, filename: str or PathLike, chunk_cache_bytes=None):
+        """
+        Args:
+            filename (str or PathLike): Path to granule HDF5 file, or `archive.zip::member`
+            chunk_cache_bytes (int, optional): size of the HDF5 chunk cache of each dataset. Defaults to None, which uses the h5py default of 1MB.
+        """
+        archive, member = split_archive_path(filename)
+        # h5py reads a granule in an archive through a file object
+        self.source = None if member is None else open_archive_member(archive, member)
+        if chunk_cache_bytes is None:
+            self.file = h5py.File(self.source or filename, "r")
+        else:
+            self.file = h5py.File(self.source or filename, "r", rdcc_nbytes=chunk_cache_bytes)
+
+    def close(self):
+        self.file.close()
+        if self.source is not None:
+            self.source.close()
+
+    def _item(self, path: str):
+        return self.file[path] if path else self.file
+
+    def groups(self, path="") -> list:
+        """names of the groups in a group"""
+        return [
+            name for name, item in self._item(path).items() if isinstance(item, h5py.Group)
+        ]
+
+    def variables(self, path="") -> list:
+        """names of the variables in a group"""
+        return [
+            name
+            for name, item in self._item(path).items()
+            if isinstance(item, h5py.Dataset) and not _is_netcdf_dimension(item)
+        ]
+
+    def attributes(self, path="") -> dict:
+        """attributes of a group as strings"""
+        return {
+            name: _attribute_to_str(value) for name, value in self._item(path).attrs.items()
+        }
+
+    def shape(self, path: str) -> tuple:
+        return self._item(path).shape
+
+    def read(self, path: str, index=Ellipsis) -> np.ndarray:
+        """read a variable, or the part of it selected by `index`, without masking missing values"""
+        return _decode_strings(np.asarray(self._item(path)[index]))
+
+    def read_filled(self, path: str, fill_value) -> np.ndarray:
+        """read a whole variable with the values equal to its `_FillValue` attribute replaced by `fill_value`
+
+        h5py does not mask missing values, so the `_FillValue` attribute that ATL03 sets on its
+        variables is applied here, in the same way as netCDF does.
+        """
+        values = self.read(path)
+        missing_value = self._item(path).attrs.get("_FillValue")
+        if missing_value is not None:
+            # attributes are stored as arrays of one value
+            values[values == np.asarray(missing_value).item()] = fill_value
+        return values
+
+
+BACKENDS = {"netcdf": NetCDFBackend, "hdf5": HDF5Backend}
+
+
+def open_granule(filename: str or PathLike, backend=None, chunk_cache_bytes=None):
+    """open a granule file with the backend for its format
+
+    Args:
+        filename (str or PathLike): Path to the granule file, or `archive.zip::member` for a granule in a zip archive
+        backend (str, optional): `netcdf` or `hdf5`. Defaults to None, which chooses from the file extension of the granule, and uses `netcdf` if the extension is not known.
+        chunk_cache_bytes (int, optional): size of the HDF5 chunk cache. Defaults to None.
+
+    Returns:
+        NetCDFBackend or HDF5Backend: the open granule
+    """
+    if backend is None:
+        archive, member = split_archive_path(filename)
+        extension = os.path.splitext(archive if member is None else member)[1].lower()
+        backend = GRANULE_EXTENSIONS.get(extension, "netcdf")
+    if backend not in BACKENDS:
+        raise ValueError(f"backend must be one of {list(BACKENDS)}")
+    return BACKENDS[backend](filename, chunk_cache_bytes=chunk_cache_bytes)
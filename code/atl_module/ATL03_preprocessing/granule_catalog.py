@@ -0,0 +1,254 @@
+"""SQLite catalog of the ATL03 granules in a site folder
+
+The catalog stores a row for every beam of every granule, with its bounding box, date, reference
+ground track, beam type, photon count and the percentage of high confidence ocean photons. It is
+built from the segment-rate geolocation only, so indexing a granule does not read any photons.
+
+The catalog is updated incrementally: a granule is only indexed again if its size or modification
+time changed and its checksum is different from the one in the catalog. Stages that need only some
+of the beams can query the catalog and open just the files with matching beams.
+
+Granules inside zip archives in the folder are cataloged as `archive.zip::member`, so downloads
+can be kept compressed.
+"""
+import glob
+import os
+import sqlite3
+import zipfile
+from os import PathLike
+
+import numpy as np
+import pandas as pd
+from atl_module.ATL03_preprocessing.atl03_netcdf_loading import GranuleReader
+from atl_module.ATL03_preprocessing.granule_backends import (
+    ARCHIVE_SEPARATOR,
+    GRANULE_EXTENSIONS,
+    archive_members,
+    split_archive_path,
+)
+from atl_module.ATL03_preprocessing.photon_cache import granule_fingerprint
+from logzero import setup_logger
+
+detail_logger = setup_logger(name="details")
+
+CATALOG_FILENAME = "granule_catalog.sqlite"
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS granules (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    checksum TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS beams (
+    filename TEXT NOT NULL,
+    beam TEXT NOT NULL,
+    minx REAL,
+    miny REAL,
+    maxx REAL,
+    maxy REAL,
+    date TEXT,
+    rgt TEXT,
+    beam_type TEXT,
+    n_photons INTEGER,
+    ocean_high_conf_perc REAL,
+    PRIMARY KEY (filename, beam)
+);
+"""
+
+
+def _beam_record(filename: str, beam: str, segment_array: np.ndarray) -> tuple:
+    """get the row of the beams table for one beam from its segment array"""
+    metadata = segment_array.dtype.metadata
+    # segments without photons have no reference photon, so they have no location
+    has_location = (
+        (segment_array["ph_count"] > 0)
+        & np.isfinite(segment_array["X"])
+        & np.isfinite(segment_array["Y"])
+    )
+    if has_location.any():
+        x, y = segment_array["X"][has_location], segment_array["Y"][has_location]
+        bbox = (float(x.min()), float(y.min()), float(x.max()), float(y.max()))
+    else:
+        bbox = (None, None, None, None)
+    ocean_high_conf_perc = metadata["ocean_high_conf_perc"]
+    return (
+        filename,
+        beam,
+        *bbox,
+        metadata["data_start_utc"],
+        metadata["start_rgt"],
+        metadata["atlas_beam_type"],
+        int(segment_array["ph_count"].sum()),
+        # NaN is stored as NULL
+        None if np.isnan(ocean_high_conf_perc) else ocean_high_conf_perc,
+    )
+
+
+class GranuleCatalog:
+    """Catalog of the beams of all the granules in a folder, stored in an SQLite database
+
+    Use as a context manager:
+
+        with GranuleCatalog(folderpath + "/ATL03") as catalog:
+            catalog.update()
+            for filename, beams in catalog.beams_by_file(bbox=bbox, min_hconf=50).items():
+                ...
+    """
+
+    def __init__(self, granule_folder: str or PathLike, catalog_path=None):
+        """open the catalog of a folder of granules, creating it if it does not exist yet
+
+        Args:
+            granule_folder (str or PathLike): folder with the granule netcdf or HDF5 files, or zip archives of them
+            catalog_path (str or PathLike, optional): location of the SQLite database. Defaults to None, which puts it in `granule_folder`.
+        """
+        self.granule_folder = granule_folder
+        if catalog_path is None:
+            catalog_path = os.path.join(granule_folder, CATALOG_FILENAME)
+        self.con = sqlite3.connect(catalog_path)
+        with self.con:
+            self.con.executescript(CATALOG_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """close the database connection"""
+        self.con.close()
+
+    def _index_granule(self, filename: str, filepath: str, stat, checksum: str):
+        """replace all the rows of a granule with rows read from the file"""
+        with GranuleReader(filepath) as granule:
+            records = [
+                _beam_record(filename, beam, granule.load_beam_segments(beam))
+                for beam in granule.beams
+            ]
+        with self.con:
+            self.con.execute("DELETE FROM beams WHERE filename = ?", (filename,))
+            self.con.executemany(
+                "INSERT INTO beams VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", records
+            )
+            self.con.execute(
+                "INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?)",
+                (filename, stat.st_size, stat.st_mtime_ns, checksum),
+            )
+
+    def _granules_on_disk(self) -> dict:
+        """find all granule files in the folder, and all granules in the zip archives in it
+
+        Returns:
+            dict: full path of each granule, keyed by its name in the catalog
+        """
+        on_disk = {
+            os.path.basename(filepath): filepath
+            for extension in GRANULE_EXTENSIONS
+            for filepath in glob.glob(os.path.join(self.granule_folder, f"*{extension}"))
+        }
+        for archive_path in glob.glob(os.path.join(self.granule_folder, "*.zip")):
+            try:
+                members = archive_members(archive_path)
+            except zipfile.BadZipFile as err:
+                detail_logger.warning(f"could not read archive {archive_path}: {err}")
+                continue
+            for member in members:
+                filename = f"{os.path.basename(archive_path)}{ARCHIVE_SEPARATOR}{member}"
+                on_disk[filename] = f"{archive_path}{ARCHIVE_SEPARATOR}{member}"
+        return on_disk
+
+    def update(self) -> int:
+        """bring the catalog up to date with the granule files in the folder
+
+        Both NetCDF4 (`.nc`) and native HDF5 (`.h5`) granules are included, also when they are in
+        zip archives. New granules and granules with a different checksum are indexed, and
+        granules that are no longer in the folder are removed. Granules that cannot be opened, or
+        that are missing a group, variable or attribute, are logged and skipped, so they are tried
+        again on the next update.
+
+        Returns:
+            int: the number of granules that were indexed
+        """
+        on_disk = self._granules_on_disk()
+        known = {
+            filename: (size, mtime_ns, checksum)
+            for filename, size, mtime_ns, checksum in self.con.execute(
+                "SELECT filename, size, mtime_ns, checksum FROM granules"
+            )
+        }
+        with self.con:
+            for filename in set(known) - set(on_disk):
+                self.con.execute("DELETE FROM beams WHERE filename = ?", (filename,))
+                self.con.execute("DELETE FROM granules WHERE filename = ?", (filename,))
+
+        n_indexed = 0
+        for filename, filepath in sorted(on_disk.items()):
+            # granules in an archive use the file stats of the archive
+            stat = os.stat(split_archive_path(filepath)[0])
+            if filename in known and known[filename][:2] == (stat.st_size, stat.st_mtime_ns):
+                continue
+            checksum = granule_fingerprint(filepath)
+            if filename in known and known[filename][2] == checksum:
+                # the file was touched but not changed, so only the file stats are updated
+                with self.con:
+                    self.con.execute(
+                        "UPDATE granules SET size = ?, mtime_ns = ? WHERE filename = ?",
+                        (stat.st_size, stat.st_mtime_ns, filename),
+                    )
+                continue
+            try:
+                self._index_granule(filename, filepath, stat, checksum)
+            except (OSError, KeyError, IndexError) as err:
+                # the backends raise a KeyError or IndexError for a missing group or variable
+                detail_logger.warning(f"could not index granule {filename}: {err!r}")
+                continue
+            n_indexed += 1
+        detail_logger.debug(f"granule catalog of {self.granule_folder}: {n_indexed} indexed")
+        return n_indexed
+
+    def query(self, bbox=None, min_hconf=None, beam_type=None) -> pd.DataFrame:
+        """find the beams that match all of the given conditions
+
+        Args:
+            bbox (tuple, optional): (minx, miny, maxx, maxy) in degrees. Only beams with a bounding box that intersects it are returned. Defaults to None.
+            min_hconf (float, optional): minimum percentage of high confidence ocean photons. Beams without a quality assessment are kept. Defaults to None.
+            beam_type (str, optional): `strong` or `weak`. Defaults to None.
+
+        Returns:
+            pd.DataFrame: one row per beam, with the full path of the granule in the `filepath` column
+        """
+        conditions = []
+        params = []
+        if bbox is not None:
+            minx, miny, maxx, maxy = bbox
+            conditions.append("maxx >= ? AND minx <= ? AND maxy >= ? AND miny <= ?")
+            params += [minx, maxx, miny, maxy]
+        if min_hconf is not None:
+            # beams that are missing the quality assessment are not rejected by the extraction either
+            conditions.append("(ocean_high_conf_perc IS NULL OR ocean_high_conf_perc >= ?)")
+            params.append(min_hconf)
+        if beam_type is not None:
+            conditions.append("beam_type = ?")
+            params.append(beam_type)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        beam_df = pd.read_sql_query(
+            f"SELECT * FROM beams{where} ORDER BY filename, beam", self.con, params=params
+        )
+        return beam_df.assign(
+            filepath=[
+                os.path.join(self.granule_folder, filename) for filename in beam_df.filename
+            ]
+        )
+
+    def beams_by_file(self, **kwargs) -> dict:
+        """find the beams that match the conditions, grouped by the granule they are in
+
+        Keyword arguments are passed on to `query`
+
+        Returns:
+            dict: list of beam names, keyed by the full path of the granule
+        """
+        beam_df = self.query(**kwargs)
+        return {filepath: list(group.beam) for filepath, group in beam_df.groupby("filepath")}
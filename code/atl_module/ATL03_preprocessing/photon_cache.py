@@ -0,0 +1,178 @@
+"""On-disk cache of decoded photon arrays, so a granule only needs to be decoded from netcdf once
+
+Each beam is stored as a `.npy` file holding the full structured photon array, next to a `.json`
+file with the metadata of the array. On later runs the array is opened memory-mapped, so only the
+parts that are used are read from disk.
+
+The cache files are named after a fingerprint of the granule file and the loader version, so a
+changed granule or a change to the decoding never reuses a stale cache.
+"""
+import hashlib
+import json
+import os
+from os import PathLike
+from pathlib import Path
+
+import numpy as np
+from atl_module.ATL03_preprocessing.granule_backends import (
+    archive_member_info,
+    split_archive_path,
+)
+
+# increase this whenever the contents of the decoded photon arrays change, so old caches are not reused
+LOADER_VERSION = 1
+# number of bytes from the start and from the end of a granule file that are hashed to fingerprint it
+FINGERPRINT_BLOCK_SIZE = 2**20
+
+
+def granule_fingerprint(filename: str or PathLike) -> str:
+    """get a fingerprint of a granule file and the loader version, without hashing the whole file
+
+    The size of the file and the first and last `FINGERPRINT_BLOCK_SIZE` bytes are hashed. This
+    is much faster than hashing granules of several hundred MB, and any re-download or
+    reprocessing of a granule changes at least the size or the header.
+
+    A granule in a zip archive is fingerprinted from the size and CRC-32 of its uncompressed
+    contents, which are stored in the directory of the archive, so nothing is decompressed.
+
+    Args:
+        filename (str or PathLike): Path to granule NETCDF file, or `archive.zip::member`
+
+    Returns:
+        str: hex digest of the fingerprint
+    """
+    if split_archive_path(filename)[1] is not None:
+        member_info = archive_member_info(filename)
+        fingerprint = f"{LOADER_VERSION}:{member_info.file_size}:{member_info.CRC}"
+        return hashlib.sha1(fingerprint.encode()).hexdigest()
+    filesize = os.path.getsize(filename)
+    sha = hashlib.sha1(f"{LOADER_VERSION}:{filesize}".encode())
+    with open(filename, "rb") as granule_file:
+        sha.update(granule_file.read(FINGERPRINT_BLOCK_SIZE))
+        if filesize > FINGERPRINT_BLOCK_SIZE:
+            # don't hash any bytes twice for files smaller than two blocks
+            granule_file.seek(max(filesize - FINGERPRINT_BLOCK_SIZE, FINGERPRINT_BLOCK_SIZE))
+            sha.update(granule_file.read())
+    return sha.hexdigest()
+
+
+class PhotonCache:
+    """A folder of decoded photon arrays, keyed by granule fingerprint and beam"""
+
+    def __init__(self, cache_dir: str or PathLike):
+        """
+        Args:
+            cache_dir (str or PathLike): folder to store the cache in, created if it does not exist
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _paths(self, fingerprint: str, beam: str) -> tuple:
+        basename = f"{fingerprint}_{beam}"
+        return self.cache_dir / f"{basename}.npy", self.cache_dir / f"{basename}.json"
+
+    def load(self, fingerprint: str, beam: str) -> np.ndarray:
+        """open a cached photon array memory-mapped
+
+        Args:
+            fingerprint (str): fingerprint of the granule, from `granule_fingerprint`
+            beam (str): name of the beam, e.g. `gt1l`
+
+        Returns:
+            np.ndarray: read-only memory-mapped photon array with its metadata, or None if the beam is not in the cache
+        """
+        array_path, metadata_path = self._paths(fingerprint, beam)
+        # the metadata is written last, so if it exists the array is complete
+        if not metadata_path.exists():
+            return None
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+        photon_data = np.load(array_path, mmap_mode="r")
+        # the metadata of the dtype is not saved in the npy format, so it is added back with a view
+        return photon_data.view(np.dtype(photon_data.dtype, metadata=metadata))
+
+    def store(self, fingerprint: str, beam: str, photon_data: np.ndarray) -> np.ndarray:
+        """write a photon array and its metadata to the cache
+
+        The files are written under a temporary name and then moved into place, so parallel
+        workers that decode the same granule never read a partly written file.
+
+        Args:
+            fingerprint (str): fingerprint of the granule, from `granule_fingerprint`
+            beam (str): name of the beam, e.g. `gt1l`
+            photon_data (np.ndarray): structured photon array, with the metadata in its dtype
+
+        Returns:
+            np.ndarray: the stored array, opened memory-mapped from the cache
+        """
+        array_path, metadata_path = self._paths(fingerprint, beam)
+        temp_suffix = f".{os.getpid()}.tmp"
+
+        temp_array_path = array_path.with_name(array_path.name + temp_suffix)
+        with open(temp_array_path, "wb") as array_file:
+            # the metadata is stored separately, so it is removed from the dtype before saving
+            np.save(
+                array_file,
+                photon_data.view(np.dtype(photon_data.dtype.descr)),
+                allow_pickle=False,
+            )
+        os.replace(temp_array_path, array_path)
+
+        temp_metadata_path = metadata_path.with_name(metadata_path.name + temp_suffix)
+        with open(temp_metadata_path, "w") as metadata_file:
+            json.dump(dict(photon_data.dtype.metadata or {}), metadata_file)
+        os.replace(temp_metadata_path, metadata_path)
+
+        return self.load(fingerprint, beam)
+
+    def store_chunks(self, fingerprint: str, beam: str, chunks, n_photons: int):
+        """write a photon array to the cache one chunk at a time, and yield each chunk after it is written
+
+        The array is written into a memory-mapped temporary file, so only one chunk is in memory at
+        a time. The files are moved into place after the last chunk, like in `store`. If the
+        chunks are not all consumed, the temporary file is removed and nothing is cached.
+
+        Args:
+            fingerprint (str): fingerprint of the granule, from `granule_fingerprint`
+            beam (str): name of the beam, e.g. `gt1l`
+            chunks (iterable): consecutive structured photon arrays, with the metadata in their dtype
+            n_photons (int): number of photons of all chunks together
+
+        Yields:
+            np.ndarray: the chunks of `chunks`
+        """
+        array_path, metadata_path = self._paths(fingerprint, beam)
+        temp_suffix = f".{os.getpid()}.tmp"
+        temp_array_path = array_path.with_name(array_path.name + temp_suffix)
+        cached_array = None
+        metadata = {}
+        start = 0
+        try:
+            for chunk in chunks:
+                if cached_array is None:
+                    # the metadata is stored separately, so it is removed from the dtype
+                    cached_array = np.lib.format.open_memmap(
+                        temp_array_path,
+                        mode="w+",
+                        dtype=np.dtype(chunk.dtype.descr),
+                        shape=(n_photons,),
+                    )
+                    metadata = dict(chunk.dtype.metadata or {})
+                cached_array[start : start + len(chunk)] = chunk
+                start += len(chunk)
+                yield chunk
+            if cached_array is None or start != n_photons:
+                return
+            cached_array.flush()
+            # the file can only be moved when no array refers to it
+            cached_array = None
+            os.replace(temp_array_path, array_path)
+
+            temp_metadata_path = metadata_path.with_name(metadata_path.name + temp_suffix)
+            with open(temp_metadata_path, "w") as metadata_file:
+                json.dump(metadata, metadata_file)
+            os.replace(temp_metadata_path, metadata_path)
+        finally:
+            cached_array = None
+            if temp_array_path.exists():
+                temp_array_path.unlink()
@@ -13,6 +13,7 @@ varpaths = [
     "geolocation/surf_type",
     "geolocation/full_sat_fract",
     "geolocation/near_sat_fract",
+    "geolocation/solar_elevation",
     "heights/h_ph",
     "heights/lat_ph",
     "heights/lon_ph",
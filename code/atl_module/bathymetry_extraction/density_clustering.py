@@ -0,0 +1,146 @@
+"""Density clustering (DBSCAN) signal finder for the filtered subsurface photons of a beam
+
+The photons are clustered in a plane of the along-track distance divided by `hscale` and the
+elevation, so a round neighbourhood with a radius of a few decimeters in elevation reaches a few
+hundred meters along the track, which follows the shape of the seafloor return. The neighbours of
+the photons are found in along-track chunks of a fixed number of photons, each with its own
+KD-tree, so the cost and memory grow linearly with the length of the beam. Each KD-tree also holds
+the photons within the radius on either side of its chunk, and the clusters are joined over all
+chunks, so the result is the same as clustering the whole beam at once.
+
+The result has the same columns as the rolling KDE, so the same thresholds can be applied:
+`z_kde` is the elevation of the photons in a cluster, and NaN for the noise photons, and
+`kde_val` is the density of the photons around each photon along the elevation, in 1/m, and 0
+for the noise photons.
+"""
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+# label of the photons that are not in any cluster
+NOISE_LABEL = -1
+
+
+def _chunk_neighbours(
+    x: np.ndarray, z: np.ndarray, start: int, stop: int, radius: float
+) -> tuple:
+    """find the neighbours of the points of one chunk, with the points within `radius` around it
+
+    Args:
+        x (np.ndarray): scaled along-track distance of all points, sorted
+        z (np.ndarray): elevation of all points
+        start (int): index of the first point of the chunk
+        stop (int): index after the last point of the chunk
+        radius (float): radius of the neighbourhood of a point
+
+    Returns:
+        tuple: array of the number of points in the neighbourhood of each point of the chunk, and (pairs, 2) array of the indices of the pairs of neighbours whose first point is in the chunk
+    """
+    # any neighbour of a point of the chunk is at most `radius` along the track from the chunk
+    low = np.searchsorted(x, x[start] - radius, side="left")
+    high = np.searchsorted(x, x[stop - 1] + radius, side="right")
+    tree = cKDTree(np.column_stack([x[low:high], z[low:high]]))
+    n_neighbours = tree.query_ball_point(
+        np.column_stack([x[start:stop], z[start:stop]]), r=radius, return_length=True
+    )
+    pairs = tree.query_pairs(radius, output_type="ndarray") + low
+    pairs.sort(axis=1)
+    # every pair is kept by the chunk of its first point only
+    pairs = pairs[(pairs[:, 0] >= start) & (pairs[:, 0] < stop)]
+    return n_neighbours, pairs
+
+
+def dbscan_labels(
+    x: np.ndarray, z: np.ndarray, radius: float, min_points: int, chunk_size: int
+) -> tuple:
+    """cluster points with DBSCAN, finding the neighbours in consecutive overlapping chunks
+
+    Args:
+        x (np.ndarray): scaled along-track distance of the points, sorted
+        z (np.ndarray): elevation of the points
+        radius (float): radius of the neighbourhood of a point
+        min_points (int): number of points in the neighbourhood of a core point, including itself
+        chunk_size (int): number of points whose neighbours are found with one KD-tree
+
+    Returns:
+        tuple: array of the cluster of each point, NOISE_LABEL for noise, and array of the number of points in the neighbourhood of each point
+    """
+    n_neighbours = np.zeros(len(x), dtype=int)
+    chunk_pairs = []
+    for start in range(0, len(x), chunk_size):
+        stop = min(start + chunk_size, len(x))
+        n_neighbours[start:stop], pairs = _chunk_neighbours(x, z, start, stop, radius)
+        chunk_pairs.append(pairs)
+    pairs = np.concatenate(chunk_pairs)
+    is_core = n_neighbours >= min_points
+
+    # the clusters are the connected groups of core points, also over the chunk boundaries
+    core_pairs = pairs[is_core[pairs[:, 0]] & is_core[pairs[:, 1]]]
+    graph = coo_matrix(
+        (np.ones(len(core_pairs)), (core_pairs[:, 0], core_pairs[:, 1])),
+        shape=(len(x), len(x)),
+    )
+    _, labels = connected_components(graph, directed=False)
+    # number the clusters from 0
+    labels = np.where(is_core, labels, NOISE_LABEL)
+    labels[is_core] = np.unique(labels[is_core], return_inverse=True)[1]
+    # a border point joins the cluster of a core point in its neighbourhood
+    border_pairs = pairs[is_core[pairs[:, 0]] != is_core[pairs[:, 1]]]
+    core_point = np.where(is_core[border_pairs[:, 0]], border_pairs[:, 0], border_pairs[:, 1])
+    border_point = np.where(
+        is_core[border_pairs[:, 0]], border_pairs[:, 1], border_pairs[:, 0]
+    )
+    labels[border_point] = labels[core_point]
+    return labels, n_neighbours
+
+
+def cluster_signal_dbscan(
+    df: pd.DataFrame,
+    window=None,
+    radius=0.2,
+    min_points=10,
+    hscale=1000,
+    chunk_size=500,
+) -> pd.DataFrame:
+    """find the seafloor photons by density clustering, and add the `z_kde` and `kde_val` columns
+
+    The density in `kde_val` is the number of points in the neighbourhood of a photon, divided by
+    the number of points within the same along-track reach and by the height of the
+    neighbourhood. This is the density of a box kernel along the elevation, in the same units as
+    the rolling KDE.
+
+    Args:
+        df (pd.DataFrame): points with the `Z_refr` and `dist_along` columns
+        window (int, optional): not used, see `SIGNAL_FINDERS`. Defaults to None.
+        radius (float, optional): radius of the neighbourhood of a photon, in meters of elevation. Defaults to 0.2.
+        min_points (int, optional): number of photons in the neighbourhood of a core photon of a cluster, including itself. Defaults to 10.
+        hscale (float, optional): the along-track distance is divided by this, so the neighbourhood reaches `radius * hscale` meters along the track. Defaults to 1000.
+        chunk_size (int, optional): number of photons whose neighbours are found together, see `dbscan_labels`. Defaults to 500.
+
+    Returns:
+        pd.DataFrame: the points with the `z_kde` and `kde_val` columns
+    """
+    if "dist_along" not in df.columns:
+        raise ValueError("the along-track distance (`dist_along`) is needed for clustering")
+    z = df.Z_refr.to_numpy(dtype="<f8")
+    x = df.dist_along.to_numpy(dtype="<f8") / hscale
+    z_kde = np.full(len(df), np.NaN)
+    kde_val = np.zeros(len(df))
+    is_valid = np.isfinite(z) & np.isfinite(x)
+    # the chunks are taken along the track
+    order = np.flatnonzero(is_valid)[np.argsort(x[is_valid], kind="stable")]
+    if len(order) == 0:
+        return df.assign(z_kde=z_kde, kde_val=kde_val)
+    sorted_x, sorted_z = x[order], z[order]
+    labels, n_neighbours = dbscan_labels(sorted_x, sorted_z, radius, min_points, chunk_size)
+
+    # number of points in the along-track reach of each point
+    n_reach = np.searchsorted(sorted_x, sorted_x + radius, side="right") - np.searchsorted(
+        sorted_x, sorted_x - radius, side="left"
+    )
+    in_cluster = labels != NOISE_LABEL
+    z_kde[order[in_cluster]] = sorted_z[in_cluster]
+    kde_val[order[in_cluster]] = n_neighbours[in_cluster] / (n_reach[in_cluster] * 2 * radius)
+    return df.assign(z_kde=z_kde, kde_val=kde_val)
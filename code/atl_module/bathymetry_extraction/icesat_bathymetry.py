@@ -1,19 +1,61 @@
-import itertools
-from glob import iglob
+import os
+from functools import partial
 from multiprocessing import Pool
 
+import numpy as np
 import pandas as pd
 from atl_module.ATL03_preprocessing.atl03_netcdf_loading import (
-    get_beams,
-    load_beam_array_ncds,
+    DEFAULT_CHUNK_SIZE,
+    GranuleReader,
+    expand_photons,
 )
+from atl_module.ATL03_preprocessing.granule_catalog import GranuleCatalog
 from atl_module.bathymetry_extraction import point_dataframe_filters as dfilt
-from atl_module.bathymetry_extraction.kde_peaks_method import AccumulateKDEs
+from atl_module.bathymetry_extraction.density_clustering import cluster_signal_dbscan
+from atl_module.bathymetry_extraction.kde_peaks_method import (
+    DEFAULT_GRID_SPACING,
+    KDE_METHODS,
+    KDE_OUTPUTS,
+    STRIDE_FILLS,
+    distance_rolling_kde,
+    report_stride_drift,
+    rolling_kde,
+    validate_rolling_kde,
+)
+from atl_module.utility_functions import gebco
 from atl_module.utility_functions import geospatial_functions as geofn
+from atl_module.utility_functions.shared_frames import (
+    gather_frames,
+    release_frames,
+    share_frame,
+    start_tracker,
+)
 from logzero import setup_logger
 
 detail_logger = setup_logger(name="details")
 
+# photon columns that are used by the filtering, the KDE and the later processing of the bathymetry
+# points. The other columns of the photon array are not read from the granule
+BATHY_COLUMNS = [
+    "X",
+    "Y",
+    "Z_geoid",
+    "tide_ocean_corr",
+    "delta_time",
+    "oc_sig_conf",
+    "p_vec_az",
+    "p_vec_elev",
+    "dac_corr",
+    "ph_count",
+]
+
+
+def _bathy_columns(kde_options=None, signal_finder="kde") -> list:
+    """photon columns to load, with the along-track distance if the signal finder needs it"""
+    if signal_finder == "dbscan" or (kde_options or {}).get("window_meters") is not None:
+        return BATHY_COLUMNS + ["dist_along"]
+    return BATHY_COLUMNS
+
 
 def add_along_track_dist(pointdata):
     if isinstance(pointdata, pd.DataFrame):
@@ -21,6 +63,18 @@ def add_along_track_dist(pointdata):
     return geofn.add_track_dist_meters(pointdata)
 
 
+def _photon_coordinates(photon_df: pd.DataFrame, metadata: dict) -> pd.DataFrame:
+    """longitude and latitude of photons in the compact layout, from the offsets and the origin of the segment of each photon"""
+    segment_index = photon_df.seg_idx.to_numpy()
+    return pd.DataFrame(
+        {
+            "X": metadata["x_origin"][segment_index] + photon_df.dX.to_numpy("<f8"),
+            "Y": metadata["y_origin"][segment_index] + photon_df.dY.to_numpy("<f8"),
+        },
+        index=photon_df.index,
+    )
+
+
 def _filter_points(
     raw_photon_df: pd.DataFrame,
     low_limit_gebco,
@@ -30,67 +84,676 @@ def _filter_points(
     filter_below_depth,
     n,
     max_geoid_high_z,
+    sea_surface=None,
+    metadata=None,
+    attrition=None,
 ) -> pd.DataFrame:
     """Remove points outside of the gebco nearshore zone, points that are invalied, or too high. Also calculate refraction corrections and add them to the dataframe
 
+    The filters of `point_dataframe_filters` are evaluated as boolean masks on the columns of the
+    photons, one after the other, and the points that pass all of them are copied out of the
+    dataframe once at the end. The result is the same as piping the dataframe through the filters.
+
+    Photons in the compact layout are filtered as they are, and only the points that are left are
+    expanded to the standard layout, so the returned dataframe is the same for both layouts.
+
     Args:
         beamdata (np.ndarray): structed ndarray recieved from the beam parsing function
+        sea_surface (tuple, optional): median and standard deviation of the sea surface of the whole beam, for when only part of the beam is filtered. Defaults to None, which calculates it from the points.
+        metadata (dict, optional): metadata of the photon array. Defaults to None, which is only allowed for photons in the standard layout.
+        attrition (dict, optional): if given, the number of points that were loaded and that are left after each filter are added to the counts in it, keyed by the name of the filter, so the counts of the chunks of a beam add up. Defaults to None.
 
     Returns:
         pd.DataFrame: pandas dataframe including the along-track distance
     """
-    filtered_photon_df = (
-        raw_photon_df.pipe(dfilt.add_gebco)
+    compact = metadata is not None and metadata.get("layout") == "compact"
+    z_geoid = raw_photon_df.Z_geoid
+    gebco_elev = dfilt.gebco_elevation(
+        raw_photon_df,
+        coordinates=_photon_coordinates(raw_photon_df, metadata) if compact else None,
+    )
+    keep = dfilt.gebco_mask(gebco_elev, low_limit_gebco, high_limit_gebco).to_numpy()
+    stage_counts = {"loaded": len(raw_photon_df), "gebco": np.count_nonzero(keep)}
+
+    # the sea surface is found from the points in the gebco nearshore zone
+    if sea_surface is None:
+        sea_surface = dfilt.sea_surface_stats(
+            raw_photon_df.loc[keep, ["Z_geoid", "oc_sig_conf"]]
+        )
+    constant_sealevel, constant_sealevel_std = sea_surface
+    sea_level = pd.Series(constant_sealevel, index=raw_photon_df.index)
+    sea_level_std_dev = pd.Series(constant_sealevel_std, index=raw_photon_df.index)
+    # points with a missing value in any column are dropped, like `dfilt.add_sea_surface_level`
+    keep &= (constant_sealevel < max_sea_surf_elev) & pd.notna(constant_sealevel_std)
+    for column in raw_photon_df.columns:
+        keep &= raw_photon_df[column].notna().to_numpy()
+    keep &= gebco_elev.notna().to_numpy()
+    stage_counts["sea surface"] = np.count_nonzero(keep)
+
+    keep &= dfilt.low_points_mask(z_geoid, filter_below_z).to_numpy()
+    stage_counts["low points"] = np.count_nonzero(keep)
+    keep &= dfilt.depth_mask(z_geoid, sea_level, filter_below_depth).to_numpy()
+    stage_counts["depth"] = np.count_nonzero(keep)
+    # like `dfilt.remove_surface_points`, the distance below the surface is scaled by the mean sea level
+    keep &= dfilt.surface_points_mask(
+        z_geoid, sea_level, sea_level.loc[keep].mean(), n=n
+    ).to_numpy()
+    stage_counts["surface"] = np.count_nonzero(keep)
+    keep &= dfilt.high_returns_mask(z_geoid, max_geoid_high_z).to_numpy()
+    stage_counts["high returns"] = np.count_nonzero(keep)
+    keep &= dfilt.tep_mask(raw_photon_df.oc_sig_conf).to_numpy()
+    stage_counts["TEP"] = np.count_nonzero(keep)
+    if attrition is not None:
+        for stage, count in stage_counts.items():
+            attrition[stage] = attrition.get(stage, 0) + count
+
+    # the points that are left are copied once, the new columns are joined without a copy
+    filtered_photon_df = pd.concat(
+        [
+            raw_photon_df.loc[keep],
+            pd.DataFrame(
+                {
+                    "gebco_elev": gebco_elev.loc[keep],
+                    "sea_level_interp": sea_level.loc[keep],
+                    "sea_level_std_dev": sea_level_std_dev.loc[keep],
+                }
+            ),
+        ],
+        axis=1,
+        copy=False,
+    )
+    if compact:
+        filtered_photon_df = expand_photons(filtered_photon_df, metadata)
+    return filtered_photon_df.pipe(dfilt.correct_for_refraction)
+
+
+def add_rolling_kde(
+    df,
+    window,
+    method="exact",
+    grid_spacing=DEFAULT_GRID_SPACING,
+    tolerance=None,
+    bandwidth=None,
+    stride=1,
+    stride_fill="interpolate",
+    window_meters=None,
+    min_photons=None,
+    outputs=("z_kde", "kde_val"),
+):
+    """add the elevation (`z_kde`) and density (`kde_val`) of the KDE peak of the centred window of each point
+
+    All outputs of every window are computed at once into preallocated arrays, see
+    `kde_peaks_method.rolling_reduce`, and added to the points as new columns.
+
+    Args:
+        df (pd.DataFrame): points in along-track order, with the `Z_refr` column
+        window (int): The length, in *number of points* of the rolling window function
+        method (str, optional): `exact` to build a gaussian_kde for every window, `binned` to evaluate all windows at once on an elevation grid, see `kde_peaks_method.binned_rolling_kde`, or `incremental` to slide a density grid with a fixed bandwidth along the track, see `kde_peaks_method.incremental_rolling_kde`. Defaults to "exact".
+        grid_spacing (float, optional): spacing of the elevation grid of the binned and incremental methods in meters. Defaults to DEFAULT_GRID_SPACING.
+        tolerance (float, optional): if given, a sample of the windows of the binned or incremental method is compared with an exact KDE, see `kde_peaks_method.validate_rolling_kde`, and an error is raised if the elevation of a peak differs by more than this many meters. Defaults to None.
+        bandwidth (float, optional): fixed bandwidth of the incremental method in meters. Defaults to None, which uses the median bandwidth of the windows by Scott's rule.
+        stride (int, optional): only evaluate the window of every `stride`-th point and fill in the points in between, see `kde_peaks_method.rolling_kde`. The difference with full evaluation for a sample of the skipped points is logged. When the beam is processed in chunks, the evaluated points depend on where the chunks start. Defaults to 1.
+        stride_fill (str, optional): `interpolate` or `nearest`, how the points between the evaluated windows are filled in. Defaults to "interpolate".
+        window_meters (float, optional): if given, the window of each point covers this along-track distance instead of `window` points, see `kde_peaks_method.distance_rolling_kde`. This needs the `dist_along` column. Defaults to None.
+        min_photons (int, optional): windows in meters with fewer points are left as NaN. Defaults to None.
+        outputs (tuple, optional): names of the columns to add, from `kde_peaks_method.KDE_OUTPUTS`. Defaults to ("z_kde", "kde_val").
+
+    Returns:
+        pd.DataFrame: the points with the output columns, NaN for the points without a complete window
+    """
+    if method not in KDE_METHODS:
+        raise ValueError(f"method must be one of {list(KDE_METHODS)}")
+    if stride_fill not in STRIDE_FILLS:
+        raise ValueError(f"stride_fill must be one of {list(STRIDE_FILLS)}")
+    if stride < 1:
+        raise ValueError("stride must be at least 1")
+    if not set(outputs) <= set(KDE_OUTPUTS):
+        raise ValueError(f"outputs must be in {list(KDE_OUTPUTS)}")
+    z_refr = df.Z_refr.to_numpy()
+    # the secondary peak needs the points of every window sorted, so it is only found if it is used
+    secondary_peak = bool({"z_kde_secondary", "kde_val_secondary"} & set(outputs))
+    if window_meters is not None:
+        if "dist_along" not in df.columns:
+            raise ValueError(
+                "the along-track distance (`dist_along`) is needed for windows in meters"
+            )
+        if stride > 1 or tolerance is not None:
+            raise ValueError(
+                "stride and tolerance are only supported for windows of a number of points"
+            )
+        kde_outputs = distance_rolling_kde(
+            z_refr,
+            df.dist_along.to_numpy(),
+            window_meters,
+            min_photons=min_photons,
+            method=method,
+            grid_spacing=grid_spacing,
+            bandwidth=bandwidth,
+            secondary_peak=secondary_peak,
+        )
+    else:
+        kde_outputs = rolling_kde(
+            z_refr,
+            window,
+            method=method,
+            stride=stride,
+            fill=stride_fill,
+            grid_spacing=grid_spacing,
+            bandwidth=bandwidth,
+            secondary_peak=secondary_peak,
+        )
+        z_kde, kde_val = kde_outputs[:2]
+        if stride > 1:
+            report_stride_drift(
+                z_refr, window, z_kde, kde_val, stride, method, grid_spacing, bandwidth
+            )
+        if tolerance is not None and (method != "exact" or stride > 1):
+            validate_rolling_kde(
+                z_refr, window, z_kde, kde_val, tolerance, method=method, bandwidth=bandwidth
+            )
+    return df.assign(**{name: kde_outputs[KDE_OUTPUTS.index(name)] for name in outputs})
+
+
+# functions that find the signal photons of the filtered points of a beam. Each one takes the points
+# and the window in number of points, and keyword arguments of its own, and adds the `z_kde` and
+# `kde_val` columns. Signal finders that do not work in windows, like DBSCAN, ignore the window
+SIGNAL_FINDERS = {
+    "kde": add_rolling_kde,
+    "dbscan": cluster_signal_dbscan,
+}
+
+
+def find_signal(df: pd.DataFrame, window, signal_finder="kde", **kwargs) -> pd.DataFrame:
+    """add the `z_kde` and `kde_val` columns to the filtered points with one of the `SIGNAL_FINDERS`
+
+    Args:
+        df (pd.DataFrame): filtered subsurface points of a beam
+        window (int): The length, in *number of points* of the rolling window function
+        signal_finder (str, optional): name of the signal finder. Defaults to "kde".
+        kwargs: keyword arguments of the signal finder
+
+    Returns:
+        pd.DataFrame: the points with the `z_kde` and `kde_val` columns
+    """
+    if signal_finder not in SIGNAL_FINDERS:
+        raise ValueError(
+            f"Unknown signal finder {signal_finder!r}, use one of {list(SIGNAL_FINDERS)}"
+        )
+    return SIGNAL_FINDERS[signal_finder](df, window=window, **kwargs)
+
+
+def _log_attrition(beam: str, attrition: dict) -> None:
+    """log the number of points of a beam that are left after each filter of `_filter_points`"""
+    stages = ", ".join(f"{stage}: {count}" for stage, count in attrition.items())
+    detail_logger.debug(f"points of beam {beam} left after each filter: {stages}")
+
+
+def get_bathy_from_beam(
+    beamarray,
+    window,
+    req_perc_hconf,
+    min_kde,
+    low_limit_gebco,
+    high_limit_gebco,
+    max_sea_surf_elev,
+    filter_below_z,
+    filter_below_depth,
+    n,
+    max_geoid_high_z,
+    kde_options=None,
+    signal_finder="kde",
+    sea_surface=None,
+):
+    """For the photon array of a single beam, determine if it contains useful bathymetry signal, and return a dataframe just of the bathymetric points
+
+    Args:
+        beamarray (np.ndarray): structured array of the photons of one beam, as returned by the `GranuleReader`, in either layout
+        window (int): The length, in *number of points* of the rolling window function
+        req_perc_hconf (float): Minimum percentage of high confidence ocean photons in a beam for the beam to be included
+        kde_options (dict, optional): keyword arguments of the signal finder, such as the KDE method. Defaults to None.
+        signal_finder (str, optional): name of the function in `SIGNAL_FINDERS` that finds the signal photons. Defaults to "kde".
+        sea_surface (tuple, optional): median and standard deviation of the sea surface of the beam, see `beam_sea_surface`. Needed when the photons were loaded with a bounding box or elevation window. Defaults to None, which calculates it from the photons in the array.
+
+    Returns:
+        pd.DataFrame: Pandas Dataframe of bathymetric points, or None if there is no signal in the beam
+    """
+    # get the metadata dictionary
+    metadata_dict = beamarray.dtype.metadata
+    # the percentage of high confidence ocean photons is a proxy for the overall quality of the signal
+    if metadata_dict["ocean_high_conf_perc"] < req_perc_hconf:
+        # go to the next one of the quality isn't high enough
+        return None
+    # catch the case where no photons passed the predicates of the loader
+    if len(beamarray) == 0:
+        return None
+    # convert numpy array to a geodataframe with the along-track distance
+    # point_df = geofn.add_track_dist_meters(beamarray)
+    point_df = pd.DataFrame(beamarray)
+    # get df of points in the subsurface region (ie. filter out points could not be bathymetry)
+    attrition = {}
+    subsurface_return_pts = _filter_points(
+        point_df,
+        low_limit_gebco,
+        high_limit_gebco,
+        max_sea_surf_elev,
+        filter_below_z,
+        filter_below_depth,
+        n,
+        max_geoid_high_z,
+        sea_surface=sea_surface,
+        metadata=metadata_dict,
+        attrition=attrition,
+    )
+    _log_attrition(metadata_dict["beam"], attrition)
+    # find the bathymetry points using the signal finder
+    bathy_pts = find_signal(
+        subsurface_return_pts, window, signal_finder=signal_finder, **(kde_options or {})
+    )
+    # find the minimum KDE strength
+    thresholdval = bathy_pts.kde_val.mean()
+    # find the
+    bathy_pts = bathy_pts.loc[bathy_pts.kde_val > max(thresholdval, min_kde)]
+    return _add_beam_details(bathy_pts, metadata_dict, len(subsurface_return_pts))
+
+
+def _add_beam_details(bathy_pts, metadata_dict, n_subsurf_points):
+    """add the details of the beam to its bathymetry points, or return None if there are no points"""
+    # TODO could this be assigned to another function? not directly related to this function
+    bathy_pts = bathy_pts.assign(
+        beam=metadata_dict["beam"],
+        atm_profile=metadata_dict["atmosphere_profile"],
+        beamtype=metadata_dict["atlas_beam_type"],
+        oc_hconf_perc=metadata_dict["ocean_high_conf_perc"],
+        n_subsurf_points=n_subsurf_points,
+        # the number of photons in the beam before the loader predicates were applied
+        n_total_points=metadata_dict["n_photons"],
+    )
+    # catch the case where there is no signal in one beam
+    if len(bathy_pts) > 0:
+        return bathy_pts
+
+
+def _complete_windows(buffer: pd.DataFrame, window, window_meters=None) -> tuple:
+    """find the points at the start of the buffer whose whole window is in it
+
+    Args:
+        buffer (pd.DataFrame): consecutive filtered points of a beam, in along-track order
+        window (int): The length, in *number of points* of the rolling window function
+        window_meters (float, optional): along-track length of the window, if it is given in meters. Defaults to None.
+
+    Returns:
+        tuple: the number of points with a complete window, and the first point that is needed for the windows of the points after them
+    """
+    if window_meters is None:
+        n_final = len(buffer) - (window - 1) // 2
+        return n_final, max(n_final - window // 2, 0)
+    dist = buffer.dist_along.to_numpy()
+    # the window of a point is complete once a point beyond the end of the window is read
+    n_final = int(np.searchsorted(dist, dist[-1] - window_meters / 2, side="left"))
+    return n_final, int(np.searchsorted(dist, dist[n_final] - window_meters / 2, side="left"))
+
+
+def _stream_rolling_kde(filtered_chunks, window, kde_options=None):
+    """add the rolling KDE to consecutive chunks of the filtered points of a beam
+
+    The window of a point reaches `window // 2` points back and `(window - 1) // 2` points
+    forward, so `window - 1` points of overlap are carried over from one chunk to the next. With
+    `window_meters` in `kde_options`, the points within half a window of the first point that is
+    not complete yet are carried over instead, which relies on the along-track order of the
+    photons in the granule. Each point is yielded once, when its whole window
+    is available, and gets exactly the same values as when the whole beam is processed at once.
+    For the incremental KDE this needs a fixed `bandwidth` in `kde_options`, otherwise the
+    bandwidth is estimated from each buffer, and the densities are then the same up to floating
+    point rounding. The binned KDE gives the same peak elevations, and the same densities up to
+    floating point rounding, because the length of its FFT depends on the windows of a batch.
+
+    Args:
+        filtered_chunks (iterable): dataframes of consecutive filtered points of one beam
+        window (int): The length, in *number of points* of the rolling window function
+        kde_options (dict, optional): keyword arguments of `add_rolling_kde`. Defaults to None.
+
+    Yields:
+        pd.DataFrame: the points with the `z_kde` and `kde_val` columns
+    """
+    kde_options = kde_options or {}
+    window_meters = kde_options.get("window_meters")
+    buffer = None
+    # number of points at the start of the buffer that were already yielded
+    n_done = 0
+    for chunk_df in filtered_chunks:
+        buffer = chunk_df if buffer is None else pd.concat([buffer, chunk_df])
+        # the points that have all the points they need ahead of them, and the first point
+        # that is needed for the windows of the points that are left
+        n_final, keep_from = _complete_windows(buffer, window, window_meters)
+        # wait for more points if there is not a single complete window yet
+        if n_final <= n_done or (window_meters is None and len(buffer) < window):
+            continue
+        yield add_rolling_kde(buffer, window=window, **kde_options).iloc[n_done:n_final]
+        buffer = buffer.iloc[keep_from:]
+        n_done = n_final - keep_from
+    # at the end of the beam, the last points don't have a complete window
+    if buffer is not None and len(buffer) > n_done:
+        yield add_rolling_kde(buffer, window=window, **kde_options).iloc[n_done:]
+
+
+def beam_sea_surface(
+    granule, beam, low_limit_gebco, high_limit_gebco, chunk_size=DEFAULT_CHUNK_SIZE
+):
+    """find the sea surface of a whole beam from its high confidence photons in the gebco nearshore zone
+
+    The photons are read without a bounding box or elevation window, so the sea surface is the same
+    as when all photons of the beam are loaded and filtered at once. Only the high confidence
+    photons are read, in along-track chunks.
+
+    Args:
+        granule (GranuleReader): the open granule
+        beam (str): name of the beam, e.g. `gt1l`
+        low_limit_gebco (float): lowest GEBCO elevation of the nearshore zone
+        high_limit_gebco (float): highest GEBCO elevation of the nearshore zone
+        chunk_size (int, optional): number of photons of the beam in each chunk. Defaults to DEFAULT_CHUNK_SIZE.
+
+    Returns:
+        tuple: median and standard deviation of the sea surface, NaN if there are no high confidence photons in the nearshore zone
+    """
+    high_conf_chunks = [
+        pd.DataFrame(chunk)
+        .pipe(dfilt.add_gebco)
         .pipe(
             dfilt.filter_gebco,
             low_limit_gebco=low_limit_gebco,
             high_limit_gebco=high_limit_gebco,
+        )[["Z_geoid", "oc_sig_conf"]]
+        for chunk in granule.iter_beam_chunks(
+            beam,
+            chunk_size=chunk_size,
+            columns=["X", "Y", "Z_geoid", "oc_sig_conf"],
+            min_signal_conf=4,
         )
-        .pipe(
-            dfilt.add_sea_surface_level,
-            max_sea_surf_elev=max_sea_surf_elev,
+        if len(chunk) > 0
+    ]
+    if len(high_conf_chunks) == 0:
+        return np.NaN, np.NaN
+    return dfilt.sea_surface_stats(pd.concat(high_conf_chunks))
+
+
+def get_bathy_from_beam_chunks(
+    granule,
+    beam,
+    chunk_size,
+    window,
+    req_perc_hconf,
+    min_kde,
+    low_limit_gebco,
+    high_limit_gebco,
+    max_sea_surf_elev,
+    filter_below_z,
+    filter_below_depth,
+    n,
+    max_geoid_high_z,
+    bbox=None,
+    layout="standard",
+    kde_options=None,
+    signal_finder="kde",
+):
+    """Find the bathymetric points of a single beam, reading and processing it in along-track chunks
+
+    The result is identical to `get_bathy_from_beam` on the whole beam, but the memory that is
+    needed is bounded by the chunk size instead of the length of the beam. The beam is read twice:
+
+    1. the high confidence photons are read to find the sea surface of the whole beam
+    2. all photons are read, filtered with that sea surface, and the rolling KDE is stitched
+       together over the chunks
+
+    Only the KDE value of every filtered point and the points that could pass the KDE threshold
+    are kept until the end of the beam, because the threshold depends on the mean KDE value.
+    Only the rolling KDE signal finder can be stitched together over the chunks.
+
+    Args:
+        granule (GranuleReader): the open granule
+        beam (str): name of the beam, e.g. `gt1l`
+        chunk_size (int): number of photons of the beam in each chunk
+        layout (str, optional): layout of the photon arrays of the second pass, see `GranuleReader.load_beam`. Defaults to "standard".
+
+    The other arguments are the same as for `get_bathy_from_beam`.
+
+    Returns:
+        pd.DataFrame: Pandas Dataframe of bathymetric points, or None if there is no signal in the beam
+    """
+    if signal_finder != "kde":
+        raise ValueError(
+            f"The {signal_finder!r} signal finder cannot be run in chunks, set chunk_size=None"
         )
-        .pipe(dfilt.filter_low_points, filter_below_z=filter_below_z)
-        .pipe(dfilt.filter_depth, filter_below_depth=filter_below_depth)
-        .pipe(dfilt.remove_surface_points, n=n)
-        .pipe(dfilt.filter_high_returns, max_geoid_high_z=max_geoid_high_z)
-        .pipe(dfilt.filter_TEP_and_nonassoc)
-        .pipe(dfilt.correct_for_refraction)
+    # the percentage of high confidence ocean photons is a proxy for the overall quality of the signal
+    if granule.beam_metadata(beam)["ocean_high_conf_perc"] < req_perc_hconf:
+        return None
+    z_range = (filter_below_z, max_geoid_high_z)
+
+    # first pass: the sea surface, from the high confidence photons in the gebco nearshore zone
+    sea_surface = beam_sea_surface(
+        granule, beam, low_limit_gebco, high_limit_gebco, chunk_size=chunk_size
     )
-    return filtered_photon_df
 
+    # second pass: filter each chunk, and find the KDE over the chunks
+    metadata_dict = None
+    n_subsurf_points = 0
+    # the number of points left after each filter, summed over the chunks
+    attrition = {}
 
-def add_rolling_kde(
-    df,
-    window,
+    def filtered_chunks():
+        nonlocal metadata_dict, n_subsurf_points
+        # the index continues over the chunks, like the index of the whole beam
+        n_loaded = 0
+        for chunk in granule.iter_beam_chunks(
+            beam,
+            chunk_size=chunk_size,
+            columns=_bathy_columns(kde_options),
+            bbox=bbox,
+            z_range=z_range,
+            # transmitter echo path photons have a negative confidence
+            min_signal_conf=0,
+            layout=layout,
+        ):
+            metadata_dict = chunk.dtype.metadata
+            if len(chunk) == 0:
+                continue
+            chunk_df = pd.DataFrame(
+                chunk, index=pd.RangeIndex(n_loaded, n_loaded + len(chunk))
+            )
+            n_loaded += len(chunk)
+            subsurface_return_pts = _filter_points(
+                chunk_df,
+                low_limit_gebco,
+                high_limit_gebco,
+                max_sea_surf_elev,
+                filter_below_z,
+                filter_below_depth,
+                n,
+                max_geoid_high_z,
+                sea_surface=sea_surface,
+                metadata=metadata_dict,
+                attrition=attrition,
+            )
+            n_subsurf_points += len(subsurface_return_pts)
+            yield subsurface_return_pts
+
+    kde_vals = []
+    candidate_pts = []
+    for bathy_pts in _stream_rolling_kde(filtered_chunks(), window, kde_options):
+        kde_vals.append(bathy_pts.kde_val.to_numpy())
+        # points at or below the minimum KDE can never pass the threshold
+        candidate_pts.append(bathy_pts.loc[bathy_pts.kde_val > min_kde])
+    _log_attrition(beam, attrition)
+    if len(candidate_pts) == 0:
+        return None
+
+    # find the minimum KDE strength
+    thresholdval = pd.Series(np.concatenate(kde_vals)).mean()
+    bathy_pts = pd.concat(candidate_pts)
+    bathy_pts = bathy_pts.loc[bathy_pts.kde_val > max(thresholdval, min_kde)]
+    return _add_beam_details(bathy_pts, metadata_dict, n_subsurf_points)
+
+
+def prescreen_beam(
+    granule,
+    beam,
+    req_perc_hconf,
+    low_limit_gebco,
+    high_limit_gebco,
+    bbox=None,
+    beam_type=None,
+    max_solar_elevation=None,
 ):
-    # set up the object to keep all the return values
-    accumulator = AccumulateKDEs()
-    # this series is a key to matching the KDE value and the Z elevation of the Max KDE to the points in original df
-    # this is a complicated series of joins but it should support matching any arbitrary indexes
-    series_out = (
-        # apply the function from the object
-        df.Z_refr.rolling(window=window, center=True)
-        .apply(
-            accumulator.calc_kdeval_and_zval,
+    """check if a beam could have bathymetry from its metadata and segments, without loading any photons
+
+    The checks are done from the cheapest to the most expensive one:
+
+    1. the percentage of high confidence ocean photons from the quality assessment
+    2. the beam strength, `strong` or `weak`
+    3. day or night, from the median solar elevation of the segments
+    4. the GEBCO depth at every located 20m segment of the track, at least one has to be in the
+       nearshore zone. The segments are much shorter than a GEBCO cell, so every cell that the
+       track crosses is sampled
+
+    Args:
+        granule (GranuleReader): the open granule
+        beam (str): name of the beam, e.g. `gt1l`
+        req_perc_hconf (float): Minimum percentage of high confidence ocean photons in a beam for the beam to be included
+        low_limit_gebco (float): lowest GEBCO elevation of the nearshore zone
+        high_limit_gebco (float): highest GEBCO elevation of the nearshore zone
+        bbox (tuple, optional): (minx, miny, maxx, maxy) of the area of interest in degrees. Defaults to None.
+        beam_type (str, optional): only keep `strong` or `weak` beams. Defaults to None, which keeps both.
+        max_solar_elevation (float, optional): highest median solar elevation in degrees, 0 keeps only the beams at night. Defaults to None, which keeps both.
+
+    Returns:
+        str: the reason to skip the beam, or None if the beam should be loaded
+    """
+    metadata = granule.beam_metadata(beam)
+    # beams that are missing the quality assessment are not rejected, like in the catalog
+    if metadata["ocean_high_conf_perc"] < req_perc_hconf:
+        return f"{metadata['ocean_high_conf_perc']:.1f}% high confidence ocean photons"
+    if beam_type is not None and metadata.get("atlas_beam_type") != beam_type:
+        return f"{metadata.get('atlas_beam_type')} beam"
+    if max_solar_elevation is not None:
+        solar_elevation = granule.segment_solar_elevation(beam)
+        if solar_elevation is not None and np.nanmedian(solar_elevation) > max_solar_elevation:
+            return f"solar elevation of {np.nanmedian(solar_elevation):.1f} degrees"
+
+    segments = pd.DataFrame(granule.load_beam_segments(beam))
+    # segments without photons have no location
+    segments = segments.loc[
+        (segments.ph_count > 0) & np.isfinite(segments.X) & np.isfinite(segments.Y)
+    ]
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        segments = segments.loc[
+            segments.X.between(minx, maxx) & segments.Y.between(miny, maxy)
+        ]
+    if len(segments) == 0:
+        return "no located segments in the area of interest"
+    segment_gebco = dfilt.gebco_elevation(segments)
+    if not dfilt.gebco_mask(segment_gebco, low_limit_gebco, high_limit_gebco).any():
+        return "no GEBCO depth in the nearshore zone along the track"
+    return None
+
+
+def _prescreened_beams(
+    granule,
+    req_perc_hconf,
+    low_limit_gebco,
+    high_limit_gebco,
+    beams=None,
+    bbox=None,
+    beam_type=None,
+    max_solar_elevation=None,
+) -> list:
+    """names of the beams of an open granule that pass `prescreen_beam`, the reason to skip the other beams is logged
+
+    Args:
+        granule (GranuleReader): the open granule
+        beams (list, optional): only check these beams. Defaults to None, which checks all beams of the granule.
+
+    The other arguments are the same as for `prescreen_beam`.
+
+    Returns:
+        list: names of the beams that should be loaded, in the order of the granule
+    """
+    selected_beams = []
+    for beam in granule.beams:
+        if beams is not None and beam not in beams:
+            continue
+        reason = prescreen_beam(
+            granule,
+            beam,
+            req_perc_hconf,
+            low_limit_gebco,
+            high_limit_gebco,
+            bbox=bbox,
+            beam_type=beam_type,
+            max_solar_elevation=max_solar_elevation,
         )
-        .dropna()
-        .astype("int")
+        if reason is None:
+            selected_beams.append(beam)
+        else:
+            detail_logger.info(f"skipping beam {beam} of {granule.filename}: {reason}")
+    return selected_beams
+
+
+def _bathy_from_granule_beam(
+    granule,
+    beam,
+    window,
+    req_perc_hconf,
+    min_kde,
+    low_limit_gebco,
+    high_limit_gebco,
+    max_sea_surf_elev,
+    filter_below_z,
+    filter_below_depth,
+    n,
+    max_geoid_high_z,
+    bbox=None,
+    chunk_size=None,
+    layout="standard",
+    kde_options=None,
+    signal_finder="kde",
+):
+    """find the bathymetric points of one beam of an open granule, for a beam that passed the prescreen
+
+    The arguments are the same as for `get_all_bathy_from_granule`.
+
+    Returns:
+        pd.DataFrame: Pandas Dataframe of bathymetric points, or None if there is no signal in the beam
+    """
+    beam_params = dict(
+        window=window,
+        req_perc_hconf=req_perc_hconf,
+        min_kde=min_kde,
+        low_limit_gebco=low_limit_gebco,
+        high_limit_gebco=high_limit_gebco,
+        max_sea_surf_elev=max_sea_surf_elev,
+        filter_below_z=filter_below_z,
+        filter_below_depth=filter_below_depth,
+        n=n,
+        max_geoid_high_z=max_geoid_high_z,
+        kde_options=kde_options,
+        signal_finder=signal_finder,
     )
-    # rename the series so the merge works
-    series_out.name = "matchup"
-    kdevals_df = pd.DataFrame(accumulator.returndict).set_index("matchup")
-    merge_df = (
-        pd.DataFrame(series_out)
-        .merge(kdevals_df, left_on="matchup", right_index=True)
-        .drop(columns="matchup")
+    if chunk_size is not None:
+        return get_bathy_from_beam_chunks(
+            granule, beam, chunk_size, bbox=bbox, layout=layout, **beam_params
+        )
+    beamarray = granule.load_beam(
+        beam,
+        columns=_bathy_columns(kde_options, signal_finder),
+        bbox=bbox,
+        z_range=(filter_below_z, max_geoid_high_z),
+        # transmitter echo path photons have a negative confidence
+        min_signal_conf=0,
+        layout=layout,
     )
-    df_w_kde = df.merge(merge_df, right_index=True, left_index=True, how="left")
-    # make sure we didn't lose anything
-    assert (
-        df_w_kde.shape[0] == df.shape[0]
-    ), "rolling KDE was not added correctly for all points"
-    return df_w_kde
+    # the sea surface is found from all photons of the beam, not only the loaded ones
+    sea_surface = beam_sea_surface(granule, beam, low_limit_gebco, high_limit_gebco)
+    return get_bathy_from_beam(beamarray, sea_surface=sea_surface, **beam_params)
 
 
 def get_all_bathy_from_granule(
@@ -105,70 +768,94 @@ def get_all_bathy_from_granule(
     filter_below_depth,
     n,
     max_geoid_high_z,
+    bbox=None,
+    cache_dir=None,
+    beams=None,
+    chunk_size=None,
+    layout="standard",
+    kde_options=None,
+    signal_finder="kde",
+    beam_type=None,
+    max_solar_elevation=None,
 ):
     """For a single granule (stored in a netcdf4 file), loop over ever single beam, determine if it contains useful bathymetry signal, and return a dataframe just of the bathymetric points
 
+    The elevation window, the TEP filter and the optional bounding box are pushed down into the
+    photon loader, so photons that would be removed by `_filter_points` anyway are never broadcast
+    or converted to a dataframe. The sea surface is still found from all high confidence photons of
+    the beam, see `beam_sea_surface`. Before that, beams that cannot have bathymetry are skipped based
+    on their metadata and segments only, see `prescreen_beam`, and the reason is logged.
+
     Args:
         filename (str or PathLike): location of the NetCDF4 file
         window (int): The length, in *number of points* of the rolling window function
         threshold_val (float): cutoff value of kerndel density for a point to be consider a signal point, in  number of standard deviations away from the median kernel density
         req_perc_hconf (float): Minimum percentage of high confidence ocean photons in a granule for the granule to be included
+        bbox (tuple, optional): (minx, miny, maxx, maxy) of the area of interest in degrees. Photons outside it are not loaded. Defaults to None.
+        cache_dir (str or PathLike, optional): folder of the decoded photon cache. Defaults to None, which disables the cache.
+        beams (list, optional): names of the beams to process. Defaults to None, which processes all beams of the granule.
+        chunk_size (int, optional): if given, each beam is read and processed in along-track chunks of this many photons, see `get_bathy_from_beam_chunks`. Defaults to None, which processes each beam at once.
+        layout (str, optional): `standard`, or `compact` to hold the photons with roughly half the memory until they are filtered. The result is the same, except for the float32 rounding of the coordinate offsets from the first photon of each segment, see `expand_photons`. Defaults to "standard".
+        kde_options (dict, optional): keyword arguments of the signal finder, such as `method="binned"` for the KDE. Defaults to None, which uses the exact KDE.
+        signal_finder (str, optional): name of the function in `SIGNAL_FINDERS` that finds the signal photons, `kde` or `dbscan`. Defaults to "kde".
+        beam_type (str, optional): only process `strong` or `weak` beams. Defaults to None, which processes both.
+        max_solar_elevation (float, optional): skip beams with a higher median solar elevation in degrees, 0 processes only the beams at night. Defaults to None.
 
     Returns:
         pd.DataFrame: Pandas Dataframe of bathymetric points
     """
-    # find which beams are available in the netcdf file
-    beamlist = get_beams(filename)
+    beam_params = dict(
+        window=window,
+        req_perc_hconf=req_perc_hconf,
+        min_kde=min_kde,
+        low_limit_gebco=low_limit_gebco,
+        high_limit_gebco=high_limit_gebco,
+        max_sea_surf_elev=max_sea_surf_elev,
+        filter_below_z=filter_below_z,
+        filter_below_depth=filter_below_depth,
+        n=n,
+        max_geoid_high_z=max_geoid_high_z,
+        kde_options=kde_options,
+        signal_finder=signal_finder,
+    )
     granulelist = []
-    for beam in beamlist:
-        # get numpy array of the beam data
-        beamarray = load_beam_array_ncds(filename=filename, beam=beam)
-        # get the metadata dictionary
-        metadata_dict = beamarray.dtype.metadata
-        # the percentage of high confidence ocean photons is a proxy for the overall quality of the signal
-        if metadata_dict["ocean_high_conf_perc"] < req_perc_hconf:
-            # go to the next one of the quality isn't high enough
-            continue
-        # convert numpy array to a geodataframe with the along-track distance
-        # point_df = geofn.add_track_dist_meters(beamarray)
-        point_df = pd.DataFrame(beamarray)
-        # get df of points in the subsurface region (ie. filter out points could not be bathymetry)
-        subsurface_return_pts = _filter_points(
-            point_df,
+    # open the granule once and read all of the beams from the same file handle
+    with GranuleReader(filename, cache_dir=cache_dir) as granule:
+        selected_beams = _prescreened_beams(
+            granule,
+            req_perc_hconf,
             low_limit_gebco,
             high_limit_gebco,
-            max_sea_surf_elev,
-            filter_below_z,
-            filter_below_depth,
-            n,
-            max_geoid_high_z,
-        )
-        # find the bathymetry points using the KDE function
-        bathy_pts = add_rolling_kde(
-            subsurface_return_pts,
-            window=window,
+            beams=beams,
+            bbox=bbox,
+            beam_type=beam_type,
+            max_solar_elevation=max_solar_elevation,
         )
-        # find the minimum KDE strength
-        thresholdval = bathy_pts.kde_val.mean()
-        # find the
-        bathy_pts = bathy_pts.loc[bathy_pts.kde_val > max(thresholdval, min_kde)]
-        # TODO could this be assigned to another function? not directly related to this function
-        bathy_pts = bathy_pts.assign(
-            beam=metadata_dict["beam"],
-            atm_profile=metadata_dict["atmosphere_profile"],
-            beamtype=metadata_dict["atlas_beam_type"],
-            oc_hconf_perc=metadata_dict["ocean_high_conf_perc"],
-            n_subsurf_points=len(subsurface_return_pts),
-            n_total_points=len(point_df),
-        )
-        # catch the case where there is no signal in one beam
-        if len(bathy_pts) > 0:
-            granulelist.append(bathy_pts)
+        for beam in selected_beams:
+            bathy_pts = _bathy_from_granule_beam(
+                granule, beam, bbox=bbox, chunk_size=chunk_size, layout=layout, **beam_params
+            )
+            if bathy_pts is not None:
+                granulelist.append(bathy_pts)
     # catch the case where there is no signal in any beams in the granule
     if len(granulelist) > 0:
         return pd.concat(granulelist)
 
 
+def _run_beam_task(task, cache_dir=None, **beam_params):
+    """find the bathymetric points of one (granule, beam) task, and put them in shared memory
+
+    The beam has already passed the prescreen, so only that beam is read from the granule.
+
+    Returns:
+        tuple: the index of the task, and the handle of the points from `share_frame`
+    """
+    task_index, filename, beam = task
+    with GranuleReader(filename, cache_dir=cache_dir) as granule:
+        bathy_pts = _bathy_from_granule_beam(granule, beam, **beam_params)
+    return task_index, share_frame(bathy_pts)
+
+
 def bathy_from_all_tracks_parallel(
     folderpath,
     window,
@@ -181,43 +868,112 @@ def bathy_from_all_tracks_parallel(
     filter_below_depth,
     n,
     max_geoid_high_z,
+    bbox=None,
+    cache_dir=None,
+    chunk_size=None,
+    layout="standard",
+    kde_options=None,
+    signal_finder="kde",
+    processes=None,
+    task_chunksize=1,
+    beam_type=None,
+    max_solar_elevation=None,
 ):
-    """Run the kde function for every single granule in parallel
+    """Run the kde function for every single beam of every granule in parallel
+
+    Each (granule, beam) pair is a separate task, so the work of a granule with many long beams is
+    spread over the workers, and all workers stay busy until the last beams are done. The beams
+    are prescreened before the tasks are made, see `prescreen_beam`, and each worker only reads the
+    beam of its task. The results
+    are collected as they arrive, and put back in the order of the granules and beams. The workers
+    return their points through shared memory, which the parent copies once into the result. If
+    there is a `bbox`, the GEBCO grid of the area is read once into a memory-mapped file in
+    `folderpath`, which the workers sample instead of the global GEBCO grid.
 
     Args:
         folderpath (str): Path to directory where the netcdf files are stored
         window (int): The number of points to use in the windowing function
         threshold_val (float): the *number of standard deviation* away from the median to include. If 0, only include points greater than the median value
         req_perc_hconf (float): Minimum percent of high confidence ocean points to include the granule in the data at all
+        bbox (tuple, optional): (minx, miny, maxx, maxy) of the area of interest in degrees. Photons outside it are not loaded. Defaults to None.
+        cache_dir (str or PathLike, optional): folder of the decoded photon cache. Defaults to None, which disables the cache.
+        chunk_size (int, optional): number of photons per along-track chunk, to bound the memory used by each worker. Defaults to None, which processes each beam at once.
+        layout (str, optional): `standard`, or `compact` to lower the memory used by each worker. Defaults to "standard".
+        kde_options (dict, optional): keyword arguments of the signal finder, such as `method="binned"` for the KDE. Defaults to None, which uses the exact KDE.
+        signal_finder (str, optional): name of the function in `SIGNAL_FINDERS` that finds the signal photons, `kde` or `dbscan`. Defaults to "kde".
+        processes (int, optional): number of worker processes. Defaults to None, which uses one per CPU.
+        task_chunksize (int, optional): number of beam tasks that are sent to a worker at once. Defaults to 1, which balances the load best.
+        beam_type (str, optional): only process `strong` or `weak` beams. Defaults to None, which processes both.
+        max_solar_elevation (float, optional): skip beams with a higher median solar elevation in degrees, 0 processes only the beams at night. Defaults to None.
 
     Returns:
         GeoDataFrame: Geodataframe of the locations of photons that are bathmetry
     """
+    # only open the granules with beams that are in the AOI and of high enough quality
+    with GranuleCatalog(folderpath + "/ATL03") as catalog:
+        catalog.update()
+        beams_by_file = catalog.beams_by_file(bbox=bbox, min_hconf=req_perc_hconf)
 
-    # to run the algorithm for all granules in parallel, create an iterable of tuples with the function parameters (as required by pool.starmap)
-    # TODO jesus this is unreadable, there must be a better way to make this iterator.
-    # maybe go back to map, and feed map object the a modified function with lambda or functools.partial
-    filenamelist = list(
-        zip(
-            iglob(folderpath + "/ATL03/*.nc"),
-            itertools.repeat(window),
-            itertools.repeat(req_perc_hconf),
-            itertools.repeat(min_kde),
-            itertools.repeat(low_limit_gebco),
-            itertools.repeat(high_limit_gebco),
-            itertools.repeat(max_sea_surf_elev),
-            itertools.repeat(filter_below_z),
-            itertools.repeat(filter_below_depth),
-            itertools.repeat(n),
-            itertools.repeat(max_geoid_high_z),
-        )
+    # the beams are prescreened here, so there are only tasks for the beams that are loaded
+    tasks = []
+    for filename, beams in beams_by_file.items():
+        with GranuleReader(filename) as granule:
+            selected_beams = _prescreened_beams(
+                granule,
+                req_perc_hconf,
+                low_limit_gebco,
+                high_limit_gebco,
+                beams=beams,
+                bbox=bbox,
+                beam_type=beam_type,
+                max_solar_elevation=max_solar_elevation,
+            )
+        tasks.extend((filename, beam) for beam in selected_beams)
+    # the parameters that are the same for every task are bound once
+    run_task = partial(
+        _run_beam_task,
+        window=window,
+        req_perc_hconf=req_perc_hconf,
+        min_kde=min_kde,
+        low_limit_gebco=low_limit_gebco,
+        high_limit_gebco=high_limit_gebco,
+        max_sea_surf_elev=max_sea_surf_elev,
+        filter_below_z=filter_below_z,
+        filter_below_depth=filter_below_depth,
+        n=n,
+        max_geoid_high_z=max_geoid_high_z,
+        bbox=bbox,
+        cache_dir=cache_dir,
+        chunk_size=chunk_size,
+        layout=layout,
+        kde_options=kde_options,
+        signal_finder=signal_finder,
     )
 
-    with Pool() as pool:
-        result = pool.starmap(get_all_bathy_from_granule, filenamelist)
-    # catch the case where there is no bathymetry found in the granule
-    if len(result) > 1:
-        return pd.concat(result)
-    # catch the case where there is only one, so no concatenation is required
-    elif len(result) == 1:
-        return result
+    # the GEBCO cells of the area of interest are read once, and shared by all workers
+    gebco_window = None
+    if bbox is not None:
+        gebco_window = gebco.write_gebco_window(
+            bbox, os.path.join(folderpath, gebco.GEBCO_WINDOW_FILENAME)
+        )
+
+    results = {}
+    # the workers share the resource tracker of this process, see `shared_frames`
+    start_tracker()
+    try:
+        with Pool(
+            processes=processes, initializer=gebco.use_gebco_window, initargs=(gebco_window,)
+        ) as pool:
+            for task_index, handle in pool.imap_unordered(
+                run_task,
+                ((task_index, *task) for task_index, task in enumerate(tasks)),
+                chunksize=task_chunksize,
+            ):
+                detail_logger.debug(f"finished beam task {len(results) + 1} of {len(tasks)}")
+                results[task_index] = handle
+        # keep the order of the granules and beams, beams without bathymetry have no handle.
+        # This is None when there is no bathymetry found in any of the beams
+        return gather_frames([results[task_index] for task_index in sorted(results)])
+    finally:
+        # free the points that were not gathered because of an error, the others are already freed
+        release_frames(results.values())
@@ -1,8 +1,39 @@
+from functools import partial
+
+import numpy as np
+from logzero import setup_logger
+from scipy.fft import irfft, next_fast_len, rfft, rfftfreq
 from scipy.stats import gaussian_kde
 
-# This code is hard to read/maintain,maybe should change to try a numpy rolling window eventually
+detail_logger = setup_logger(name="details")
+
+# methods of the rolling KDE. `exact` builds a gaussian_kde for every window, `binned` evaluates
+# all windows at once on an elevation grid, and `incremental` slides one density grid along the
+# track with a fixed bandwidth
+KDE_METHODS = ("exact", "binned", "incremental")
+# spacing of the elevation grid of the binned KDE, in meters
+DEFAULT_GRID_SPACING = 0.02
+# number of windows that are evaluated together by the binned KDE, which bounds the memory used.
+# The outputs of the windows of the other methods are also found in batches of this size
+BINNED_BATCH_SIZE = 512
+# the grid is padded by this many bandwidths, so the kernels do not wrap around in the FFT
+KERNEL_PADDING = 5
+# maximum number of windows that are compared with the exact KDE when a tolerance is given
+VALIDATION_SAMPLE_SIZE = 100
+# ways to fill in the points between the evaluated windows of a strided rolling KDE
+STRIDE_FILLS = ("interpolate", "nearest")
 
-# This function shouldn't be called directly, only from the AccumluateKDEs class so that both values can be stored
+# outputs of the rolling KDE for every window, in the order of the rows of the output arrays:
+# the elevation and density of the KDE peak, the number of points and the standard deviation of
+# the elevations in the window, and the elevation and density of the second highest peak
+KDE_OUTPUTS = (
+    "z_kde",
+    "kde_val",
+    "window_n_photons",
+    "window_spread",
+    "z_kde_secondary",
+    "kde_val_secondary",
+)
 
 
 def get_elev_at_max_density(point_array):
@@ -19,29 +50,796 @@ def get_elev_at_max_density(point_array):
     return z_at_kdemax, max_density
 
 
-class AccumulateKDEs:
-    # the kde function is expensive to apply, so we can follow these instructions to avoid calling it twice:
-    # https://stackoverflow.com/questions/22218438/returning-two-values-from-pandas-rolling-apply
-    def __init__(
-        self,
-    ):
-        self.index = 0
-        self.index_val_list = []
-        self.z_max_list = []
-        self.kde_val_list = []
-        self.returndict = {
-            "matchup": self.index_val_list,
-            "z_kde": self.z_max_list,
-            "kde_val": self.kde_val_list,
-        }
-
-    def calc_kdeval_and_zval(self, zvals):
-        z_max_kde, kde_val = get_elev_at_max_density(
-            zvals.to_numpy(),
-        )
-        self.kde_val_list.append(kde_val)
-        self.z_max_list.append(z_max_kde)
-        self.index_val_list.append(self.index)
-        self.index = self.index + 1
-        # the series that is returned by the funcion is the key to matching the accumlutor to the original dataframe
-        return self.index - 1
+def _window_outputs(
+    window_z: np.ndarray, point_density: np.ndarray, secondary_peak=True
+) -> np.ndarray:
+    """find all KDE_OUTPUTS of a batch of windows from the density of the KDE at their points
+
+    The peak is the point with the highest density. The secondary peak is the highest of the
+    other local maxima of the density along the sorted elevations, for example a return from the
+    sea surface above the seafloor.
+
+    Args:
+        window_z (np.ndarray): (windows, window size) array of elevations. Windows with fewer points are padded with NaN at the end
+        point_density (np.ndarray): density of the KDE of each window at each of its points, -inf for the padding
+        secondary_peak (bool, optional): also find the secondary peak, which sorts the points of every window. Defaults to True.
+
+    Returns:
+        np.ndarray: (len(KDE_OUTPUTS), windows) array. The secondary peak is NaN for windows with a single peak, and for all windows if it is not found
+    """
+    n_windows = len(window_z)
+    rows = np.arange(n_windows)
+    is_point = ~np.isnan(window_z)
+    n_points = is_point.sum(axis=1)
+    outputs = np.full((len(KDE_OUTPUTS), n_windows), np.NaN)
+    peak = point_density.argmax(axis=1)
+    outputs[0] = window_z[rows, peak]
+    outputs[1] = point_density[rows, peak]
+    outputs[2] = n_points
+    mean = np.where(is_point, window_z, 0).sum(axis=1) / n_points
+    outputs[3] = np.sqrt(
+        (np.where(is_point, window_z - mean[:, None], 0) ** 2).sum(axis=1) / (n_points - 1)
+    )
+    if not secondary_peak:
+        return outputs
+
+    # the padding is sorted to the end, and its density of -inf is never a local maximum
+    order = np.argsort(window_z, axis=1)
+    sorted_z = np.take_along_axis(window_z, order, axis=1)
+    sorted_density = np.take_along_axis(point_density, order, axis=1)
+    neighbours = np.pad(sorted_density, ((0, 0), (1, 1)), constant_values=-np.inf)
+    # of points with the same elevation, only the first one is a local maximum
+    is_local_max = (sorted_density > neighbours[:, :-2]) & (
+        sorted_density >= neighbours[:, 2:]
+    )
+    secondary_density = np.where(is_local_max, sorted_density, -np.inf)
+    secondary_density[rows, sorted_density.argmax(axis=1)] = -np.inf
+    secondary = secondary_density.argmax(axis=1)
+    has_secondary = np.isfinite(secondary_density[rows, secondary])
+    outputs[4] = np.where(has_secondary, sorted_z[rows, secondary], np.NaN)
+    outputs[5] = np.where(has_secondary, secondary_density[rows, secondary], np.NaN)
+    return outputs
+
+
+def _exact_kde_batch(window_z: np.ndarray, secondary_peak=True) -> np.ndarray:
+    """find the KDE_OUTPUTS of a batch of windows with a gaussian_kde for every window"""
+    point_density = np.full(window_z.shape, -np.inf)
+    for row, values in enumerate(window_z):
+        points = values[~np.isnan(values)]
+        point_density[row, : len(points)] = gaussian_kde(points).pdf(points)
+    return _window_outputs(window_z, point_density, secondary_peak)
+
+
+def _window_centers(n_points: int, window: int) -> np.ndarray:
+    """positions of the points with a complete centred window, in the same way as pandas rolling with `center=True`
+
+    The window of the point at position `i` starts at `i - window // 2`.
+    """
+    return np.arange(window // 2, n_points - (window - 1) // 2)
+
+
+def _evaluated_centers(n_points: int, window: int, stride: int) -> np.ndarray:
+    """positions of the points whose windows are evaluated, every `stride` points and always the last one"""
+    centers = _window_centers(n_points, window)
+    if stride > 1 and len(centers) > 0:
+        # the last window is always evaluated, so the points between the windows are never extrapolated
+        centers = np.unique(np.append(centers[::stride], centers[-1]))
+    return centers
+
+
+def _point_window_bounds(centers: np.ndarray, window: int) -> tuple:
+    """first point and the point after the last point of the centred windows of a number of points"""
+    starts = centers - window // 2
+    return starts, starts + window
+
+
+def distance_window_bounds(dist: np.ndarray, window_meters: float) -> tuple:
+    """first point and the point after the last point of the window of each point that covers `window_meters` along the track
+
+    The bounds of consecutive points only move forward, so they are found for all points with a
+    binary search of the sorted distances.
+
+    Args:
+        dist (np.ndarray): sorted along-track distance of the points in meters
+        window_meters (float): along-track length of the window, centred on each point
+
+    Returns:
+        tuple: arrays of the start and the stop of the window of each point
+    """
+    half_window = window_meters / 2
+    starts = np.searchsorted(dist, dist - half_window, side="left")
+    stops = np.searchsorted(dist, dist + half_window, side="right")
+    return starts, stops
+
+
+def _binned_kde_batch(
+    window_z: np.ndarray, grid_spacing: float, bandwidth=None, secondary_peak=True
+) -> np.ndarray:
+    """find the KDE_OUTPUTS of a batch of windows on an elevation grid
+
+    The points of each window are linearly binned on a grid that is shared by the batch. The
+    binned counts are convolved with the gaussian kernel of each window by multiplying their FFT
+    with the Fourier transform of the kernel, so every window can have its own bandwidth. The
+    density at each point of the window is interpolated from the grid, and like the exact method
+    the peak is the point with the highest density.
+
+    Args:
+        window_z (np.ndarray): (windows, window size) array of elevations, with a positive spread in every window. Windows with fewer points are padded with NaN at the end
+        grid_spacing (float): spacing of the elevation grid in meters
+        bandwidth (float, optional): fixed bandwidth for all windows in meters. Defaults to None, which uses Scott's rule for each window.
+        secondary_peak (bool, optional): also find the secondary peak, see `_window_outputs`. Defaults to True.
+
+    Returns:
+        np.ndarray: (len(KDE_OUTPUTS), windows) array, see `_window_outputs`
+    """
+    n_windows = len(window_z)
+    is_point = ~np.isnan(window_z)
+    n_points = is_point.sum(axis=1)
+    if bandwidth is None:
+        # Scott's rule, like scipy.stats.gaussian_kde
+        bandwidth = np.nanstd(window_z, axis=1, ddof=1) * n_points ** (-1 / 5)
+    else:
+        bandwidth = np.full(n_windows, bandwidth)
+
+    padding = KERNEL_PADDING * bandwidth.max()
+    # the grid is aligned to multiples of the grid spacing, so the binned counts of a window do
+    # not depend on the other windows of the batch
+    grid_start = np.floor((np.nanmin(window_z) - padding) / grid_spacing) * grid_spacing
+    n_bins = int(np.ceil((np.nanmax(window_z) + padding - grid_start) / grid_spacing)) + 2
+    n_fft = next_fast_len(n_bins, real=True)
+
+    # linear binning, each point is split over the two grid points around it. The padding is
+    # binned at the start of the grid with a weight of zero
+    position = (np.where(is_point, window_z, grid_start) - grid_start) / grid_spacing
+    lower = np.floor(position).astype(np.intp)
+    upper_weight = position - lower
+    flat_lower = (np.arange(n_windows)[:, None] * n_fft + lower).ravel()
+    counts = np.bincount(
+        flat_lower,
+        weights=((1 - upper_weight) * is_point).ravel(),
+        minlength=n_windows * n_fft,
+    ) + np.bincount(
+        flat_lower + 1, weights=(upper_weight * is_point).ravel(), minlength=n_windows * n_fft
+    )
+
+    # the Fourier transform of a gaussian with standard deviation h is exp(-2 (pi f h)^2)
+    frequency = rfftfreq(n_fft, d=grid_spacing)
+    kernel_ft = np.exp(-2 * (np.pi * frequency[None, :] * bandwidth[:, None]) ** 2)
+    density = irfft(
+        rfft(counts.reshape(n_windows, n_fft), axis=1) * kernel_ft, n=n_fft, axis=1
+    )
+    # scale the smoothed counts to a probability density
+    density /= n_points[:, None] * grid_spacing
+
+    rows = np.arange(n_windows)[:, None]
+    point_density = np.where(
+        is_point,
+        density[rows, lower] * (1 - upper_weight) + density[rows, lower + 1] * upper_weight,
+        -np.inf,
+    )
+    return _window_outputs(window_z, point_density, secondary_peak)
+
+
+def rolling_reduce(
+    z: np.ndarray, starts: np.ndarray, stops: np.ndarray, reducer, batch_size=1
+) -> np.ndarray:
+    """apply a window reducer to every window, and store all of its outputs in one preallocated array
+
+    Each window is given by the positions of its first point and of the point after its last
+    point, so windows of a number of points and windows of a distance are handled the same way.
+    Windows with missing values, fewer than two points or without any spread are skipped, as they
+    have no KDE.
+
+    Args:
+        z (np.ndarray): elevations of the points, in along-track order
+        starts (np.ndarray): first point of each window
+        stops (np.ndarray): point after the last point of each window
+        reducer (callable): function that takes a (windows, window size) array of the elevations of a batch of windows, padded with NaN at the end, and returns a (len(KDE_OUTPUTS), windows) array
+        batch_size (int, optional): number of windows that are passed to the reducer at once. Defaults to 1.
+
+    Returns:
+        np.ndarray: (len(KDE_OUTPUTS), windows) array of the outputs of each window, NaN for the windows that are skipped
+    """
+    outputs = np.full((len(KDE_OUTPUTS), len(starts)), np.NaN)
+    for first in range(0, len(starts), batch_size):
+        batch_starts = starts[first : first + batch_size]
+        window_sizes = stops[first : first + batch_size] - batch_starts
+        if window_sizes.max() < 2:
+            continue
+        offsets = np.arange(window_sizes.max())
+        in_window = offsets < window_sizes[:, None]
+        # shorter windows are padded with NaN
+        window_z = np.where(
+            in_window, z[np.minimum(batch_starts[:, None] + offsets, len(z) - 1)], np.NaN
+        )
+        is_missing = np.isnan(window_z)
+        is_valid = (
+            (np.isfinite(window_z) == in_window).all(axis=1)
+            & (window_sizes >= 2)
+            & (
+                np.where(is_missing, -np.inf, window_z).max(axis=1)
+                > np.where(is_missing, np.inf, window_z).min(axis=1)
+            )
+        )
+        if is_valid.any():
+            outputs[:, np.flatnonzero(is_valid) + first] = reducer(window_z[is_valid])
+    return outputs
+
+
+def _evaluate_windows(
+    z: np.ndarray,
+    starts: np.ndarray,
+    stops: np.ndarray,
+    method: str,
+    grid_spacing=DEFAULT_GRID_SPACING,
+    bandwidth=None,
+    secondary_peak=True,
+) -> np.ndarray:
+    """evaluate the KDE of the given windows, each window on its own
+
+    Args:
+        z (np.ndarray): elevations of the points, in along-track order
+        starts (np.ndarray): first point of each window
+        stops (np.ndarray): point after the last point of each window
+        method (str): `exact`, or `binned`. With a fixed `bandwidth`, `binned` gives the windows of the incremental method
+        grid_spacing (float, optional): spacing of the elevation grid of the binned method in meters. Defaults to DEFAULT_GRID_SPACING.
+        bandwidth (float, optional): fixed bandwidth of the binned method. Defaults to None, which uses Scott's rule for each window.
+        secondary_peak (bool, optional): also find the secondary peak, see `_window_outputs`. Defaults to True.
+
+    Returns:
+        np.ndarray: (len(KDE_OUTPUTS), windows) array, NaN for windows with missing values or without any spread
+    """
+    if method == "exact":
+        return rolling_reduce(
+            z,
+            starts,
+            stops,
+            lambda window_z: _exact_kde_batch(window_z, secondary_peak),
+            batch_size=BINNED_BATCH_SIZE,
+        )
+    return rolling_reduce(
+        z,
+        starts,
+        stops,
+        lambda window_z: _binned_kde_batch(window_z, grid_spacing, bandwidth, secondary_peak),
+        batch_size=BINNED_BATCH_SIZE,
+    )
+
+
+def binned_rolling_kde(
+    z: np.ndarray,
+    window: int,
+    grid_spacing=DEFAULT_GRID_SPACING,
+    stride=1,
+    secondary_peak=True,
+) -> np.ndarray:
+    """find the KDE peak and the other KDE_OUTPUTS of the centred window of every point, with a binned KDE
+
+    This gives nearly the same result as applying `get_elev_at_max_density` to every window, but
+    it is computed in batches of windows with numpy instead of building a gaussian_kde for each of
+    them. The bandwidth of every window is the same as in the exact method. The accuracy depends
+    on the grid spacing compared to the bandwidth, see `validate_rolling_kde`.
+
+    Args:
+        z (np.ndarray): elevations of the points, in along-track order
+        window (int): number of points in the window
+        grid_spacing (float, optional): spacing of the elevation grid in meters. Defaults to DEFAULT_GRID_SPACING.
+        stride (int, optional): only evaluate the window of every `stride`-th point, the other points are left as NaN. Defaults to 1.
+        secondary_peak (bool, optional): also find the secondary peak, see `_window_outputs`. Defaults to True.
+
+    Returns:
+        np.ndarray: (len(KDE_OUTPUTS), points) array. The outputs are NaN for the points at the ends without a complete window, and for windows with missing values or without any spread
+    """
+    z = np.asarray(z, dtype="<f8")
+    outputs = np.full((len(KDE_OUTPUTS), len(z)), np.NaN)
+    centers = _evaluated_centers(len(z), window, stride)
+    outputs[:, centers] = _evaluate_windows(
+        z,
+        *_point_window_bounds(centers, window),
+        "binned",
+        grid_spacing=grid_spacing,
+        secondary_peak=secondary_peak,
+    )
+    return outputs
+
+
+def fixed_bandwidth(z: np.ndarray, window: int) -> float:
+    """a single KDE bandwidth for a whole track: the median of the bandwidths of its windows by Scott's rule
+
+    The standard deviation of every window is found from cumulative sums, so the windows are not
+    copied.
+
+    Args:
+        z (np.ndarray): elevations of the points, in along-track order, without missing values
+        window (int): number of points in the window
+
+    Returns:
+        float: the bandwidth in meters
+    """
+    # shift the elevations to reduce the cancellation in the sums of squares
+    z = z - z.mean()
+    sum_z = np.concatenate([[0], np.cumsum(z)])
+    sum_z2 = np.concatenate([[0], np.cumsum(z**2)])
+    window_sum = sum_z[window:] - sum_z[:-window]
+    window_sum2 = sum_z2[window:] - sum_z2[:-window]
+    variance = np.maximum(window_sum2 - window_sum**2 / window, 0) / (window - 1)
+    return float(np.median(np.sqrt(variance))) * window ** (-1 / 5)
+
+
+def _sliding_kde(
+    z: np.ndarray,
+    starts: np.ndarray,
+    stops: np.ndarray,
+    bandwidth: float,
+    grid_spacing=DEFAULT_GRID_SPACING,
+    evaluate=None,
+    secondary_peak=True,
+) -> np.ndarray:
+    """find the KDE peak and the other KDE_OUTPUTS of consecutive windows with a density grid that slides along the track
+
+    The windows are moved in batches of BINNED_BATCH_SIZE steps. The kernels of the points that
+    enter the window at each step are added to the grid of that step, and the kernels of the points
+    that leave it are subtracted, all at once for the batch. A cumulative sum over the steps then
+    gives the density grid of every window of the batch. Every point is added and subtracted once,
+    so the cost is the number of grid points for every step, whatever the size of the window, plus
+    the number of points of every window that is evaluated.
+
+    Args:
+        z (np.ndarray): elevations of the points, in along-track order
+        starts (np.ndarray): first point of each window, not decreasing
+        stops (np.ndarray): point after the last point of each window, not decreasing
+        bandwidth (float): standard deviation of the gaussian kernel in meters
+        grid_spacing (float, optional): spacing of the elevation grid in meters. Defaults to DEFAULT_GRID_SPACING.
+        evaluate (np.ndarray, optional): boolean array of the windows whose peak is found. Defaults to None, which finds the peak of all windows.
+        secondary_peak (bool, optional): also find the secondary peak, see `_window_outputs`. Defaults to True.
+
+    Returns:
+        np.ndarray: (len(KDE_OUTPUTS), windows) array, NaN for windows with missing values or fewer than two points
+    """
+    outputs = np.full((len(KDE_OUTPUTS), len(starts)), np.NaN)
+    is_finite = np.isfinite(z)
+    if len(starts) == 0 or not is_finite.any():
+        return outputs
+
+    # the grid covers all points of the track, and the kernels of the points at the edges. It is
+    # aligned to multiples of the grid spacing, so parts of a track use the same grid points
+    kernel_radius = int(np.ceil(KERNEL_PADDING * bandwidth / grid_spacing))
+    grid_start = (
+        np.floor(z[is_finite].min() / grid_spacing) - kernel_radius - 1
+    ) * grid_spacing
+    n_bins = int(np.ceil((z[is_finite].max() - grid_start) / grid_spacing)) + kernel_radius + 2
+    density = np.zeros(n_bins)
+    kernel_offsets = np.arange(-kernel_radius, kernel_radius + 1)
+    # missing values are put at the start of the grid, but are never added to the density
+    position = (np.where(is_finite, z, grid_start) - grid_start) / grid_spacing
+    lower = np.floor(position).astype(np.intp)
+    upper_weight = position - lower
+    nearest = np.rint(position).astype(np.intp)
+    norm = 1 / (bandwidth * np.sqrt(2 * np.pi))
+
+    # windows with missing values or fewer than two points are not evaluated
+    n_missing = np.concatenate([[0], np.cumsum(~is_finite)])
+    is_evaluated = (n_missing[stops] == n_missing[starts]) & (stops - starts >= 2)
+    if evaluate is not None:
+        is_evaluated &= evaluate
+
+    def add_kernels(changes: np.ndarray, points: np.ndarray, bounds: np.ndarray, sign: int):
+        """add the kernels of the points that enter or leave the window to the grid of their step"""
+        points = points[is_finite[points]]
+        if len(points) == 0:
+            return
+        # a point enters at the first step with a stop after it, and leaves at the first step
+        # with a start after it
+        step = np.searchsorted(bounds, points, side="right")
+        bins = nearest[points, None] + kernel_offsets
+        distance = (grid_start + bins * grid_spacing - z[points, None]) / bandwidth
+        changes += np.bincount(
+            (step[:, None] * n_bins + bins).ravel(),
+            weights=(sign * norm * np.exp(-0.5 * distance**2)).ravel(),
+            minlength=len(changes),
+        )
+
+    # the points in [back, front) are in the grid
+    back, front = 0, 0
+    for batch_start in range(0, len(starts), BINNED_BATCH_SIZE):
+        batch = slice(batch_start, batch_start + BINNED_BATCH_SIZE)
+        batch_starts, batch_stops = starts[batch], stops[batch]
+        changes = np.zeros(len(batch_starts) * n_bins)
+        add_kernels(changes, np.arange(front, batch_stops[-1]), batch_stops, 1)
+        add_kernels(changes, np.arange(back, batch_starts[-1]), batch_starts, -1)
+        step_density = density + np.cumsum(changes.reshape(-1, n_bins), axis=0)
+        density = step_density[-1]
+        back, front = batch_starts[-1], batch_stops[-1]
+
+        steps = np.flatnonzero(is_evaluated[batch])
+        if len(steps) == 0:
+            continue
+        # the points of the evaluated windows, padding the shorter ones
+        window_sizes = batch_stops[steps] - batch_starts[steps]
+        offsets = np.arange(window_sizes.max())
+        is_point = offsets < window_sizes[:, None]
+        points = np.where(is_point, batch_starts[steps, None] + offsets, 0)
+        window_lower = lower[points]
+        window_weight = upper_weight[points]
+        rows = steps[:, None]
+        point_density = (
+            step_density[rows, window_lower] * (1 - window_weight)
+            + step_density[rows, window_lower + 1] * window_weight
+        ) / window_sizes[:, None]
+        outputs[:, batch_start + steps] = _window_outputs(
+            np.where(is_point, z[points], np.NaN),
+            np.where(is_point, point_density, -np.inf),
+            secondary_peak,
+        )
+    return outputs
+
+
+def incremental_rolling_kde(
+    z: np.ndarray,
+    window: int,
+    bandwidth=None,
+    grid_spacing=DEFAULT_GRID_SPACING,
+    stride=1,
+    secondary_peak=True,
+) -> np.ndarray:
+    """find the KDE peak and the other KDE_OUTPUTS of the centred window of every point, with a density grid that slides along the track
+
+    All windows use the same bandwidth, so the density of the next window is found from the
+    density of the current one by adding the kernel of the point that enters the window and
+    subtracting the kernel of the point that leaves it, see `_sliding_kde`. Updating the grid
+    costs the same for every step whatever the window size, and finding the peak costs the number
+    of points in the window, instead of the square of the window size, so large windows are
+    affordable. The density at each point of the window is interpolated from the grid, and like
+    the exact method the peak is the point with the highest density. The result is compared with
+    an exact KDE of the same fixed bandwidth by `validate_rolling_kde`.
+
+    Args:
+        z (np.ndarray): elevations of the points, in along-track order
+        window (int): number of points in the window
+        bandwidth (float, optional): standard deviation of the gaussian kernel in meters. Defaults to None, which uses `fixed_bandwidth`.
+        grid_spacing (float, optional): spacing of the elevation grid in meters. Defaults to DEFAULT_GRID_SPACING.
+        stride (int, optional): only find the peak for every `stride`-th point, the other points are left as NaN. The grid is still updated for every point. Defaults to 1.
+        secondary_peak (bool, optional): also find the secondary peak, see `_window_outputs`. Defaults to True.
+
+    Returns:
+        np.ndarray: (len(KDE_OUTPUTS), points) array. The outputs are NaN for the points at the ends without a complete window, and for windows with missing values
+    """
+    z = np.asarray(z, dtype="<f8")
+    outputs = np.full((len(KDE_OUTPUTS), len(z)), np.NaN)
+    centers = _window_centers(len(z), window)
+    is_finite = np.isfinite(z)
+    if window < 2 or len(centers) == 0 or not is_finite.any():
+        return outputs
+    if bandwidth is None:
+        bandwidth = fixed_bandwidth(z[is_finite], min(window, is_finite.sum()))
+    if not bandwidth > 0:
+        return outputs
+    evaluate = np.isin(centers, _evaluated_centers(len(z), window, stride))
+    outputs[:, centers] = _sliding_kde(
+        z,
+        *_point_window_bounds(centers, window),
+        bandwidth,
+        grid_spacing,
+        evaluate,
+        secondary_peak,
+    )
+    return outputs
+
+
+def distance_rolling_kde(
+    z: np.ndarray,
+    dist: np.ndarray,
+    window_meters: float,
+    min_photons=None,
+    method="binned",
+    grid_spacing=DEFAULT_GRID_SPACING,
+    bandwidth=None,
+    secondary_peak=True,
+) -> np.ndarray:
+    """find the KDE peak and the other KDE_OUTPUTS of the window of every point that covers a distance along the track
+
+    The number of points in a window follows the photon density, so windows in the parts of the
+    track with few photons are not stretched over hundreds of meters. The points are sorted by
+    their distance, and the bounds of every window are found once with `distance_window_bounds`.
+    With the incremental method the grid then slides along the track with two pointers, so the
+    cost is linear in the number of points.
+
+    Args:
+        z (np.ndarray): elevations of the points
+        dist (np.ndarray): along-track distance of the points in meters
+        window_meters (float): along-track length of the window, centred on each point
+        min_photons (int, optional): windows with fewer points are left as NaN. Defaults to None, which only skips windows of a single point.
+        method (str, optional): one of KDE_METHODS. Defaults to "binned".
+        grid_spacing (float, optional): spacing of the elevation grid of the binned and incremental methods in meters. Defaults to DEFAULT_GRID_SPACING.
+        bandwidth (float, optional): fixed bandwidth of the incremental method in meters. Defaults to None, which uses `fixed_bandwidth` for the median number of points in a window.
+        secondary_peak (bool, optional): also find the secondary peak, see `_window_outputs`. Defaults to True.
+
+    Returns:
+        np.ndarray: (len(KDE_OUTPUTS), points) array. The outputs are NaN for points with too few points in their window, with missing values in it, or without a distance
+    """
+    if method not in KDE_METHODS:
+        raise ValueError(f"method must be one of {list(KDE_METHODS)}")
+    z = np.asarray(z, dtype="<f8")
+    dist = np.asarray(dist, dtype="<f8")
+    outputs = np.full((len(KDE_OUTPUTS), len(z)), np.NaN)
+    # the points are usually in along-track order already, then this keeps them as they are
+    order = np.argsort(dist, kind="stable")
+    sorted_z, sorted_dist = z[order], dist[order]
+    starts, stops = distance_window_bounds(sorted_dist, window_meters)
+    window_sizes = stops - starts
+    centers = np.flatnonzero(
+        np.isfinite(sorted_dist) & (window_sizes >= max(min_photons or 2, 2))
+    )
+    if len(centers) == 0:
+        return outputs
+    if method == "incremental":
+        is_finite = np.isfinite(sorted_z)
+        if bandwidth is None and is_finite.sum() >= 2:
+            median_window = int(np.median(window_sizes[centers]))
+            bandwidth = fixed_bandwidth(
+                sorted_z[is_finite], max(min(median_window, is_finite.sum()), 2)
+            )
+        if bandwidth is None or not bandwidth > 0:
+            return outputs
+        result = _sliding_kde(
+            sorted_z,
+            starts[centers],
+            stops[centers],
+            bandwidth,
+            grid_spacing,
+            secondary_peak=secondary_peak,
+        )
+    else:
+        result = _evaluate_windows(
+            sorted_z,
+            starts[centers],
+            stops[centers],
+            method,
+            grid_spacing,
+            secondary_peak=secondary_peak,
+        )
+    outputs[:, order[centers]] = result
+    return outputs
+
+
+def fill_strided(outputs: np.ndarray, centers: np.ndarray, fill="interpolate") -> np.ndarray:
+    """fill in the points between the windows of a strided rolling KDE
+
+    Args:
+        outputs (np.ndarray): (len(KDE_OUTPUTS), points) array, only set for the evaluated points
+        centers (np.ndarray): sorted positions of the evaluated points
+        fill (str, optional): `interpolate` to interpolate linearly along the track between the evaluated points on either side, or `nearest` to copy the nearest evaluated point. Defaults to "interpolate".
+
+    Returns:
+        np.ndarray: the filled outputs. The evaluated points keep their values, the points between an evaluated window that is NaN and its neighbour are NaN when interpolated, and the points at the ends without a complete window stay NaN
+    """
+    outputs = outputs.copy()
+    if len(centers) == 0:
+        return outputs
+    positions = np.arange(centers[0], centers[-1] + 1)
+    if fill == "interpolate":
+        for values in outputs:
+            center_values = values[centers]
+            values[positions] = np.interp(positions, centers, center_values)
+            # np.interp also returns NaN at an evaluated point next to a NaN one, keep its value
+            values[centers] = center_values
+    else:
+        right = np.searchsorted(centers, positions).clip(max=len(centers) - 1)
+        left = (right - 1).clip(min=0)
+        # ties go to the evaluated point before
+        nearest = np.where(
+            positions - centers[left] <= centers[right] - positions,
+            centers[left],
+            centers[right],
+        )
+        outputs[:, positions] = outputs[:, nearest]
+    return outputs
+
+
+def rolling_kde(
+    z: np.ndarray,
+    window: int,
+    method="binned",
+    stride=1,
+    fill="interpolate",
+    grid_spacing=DEFAULT_GRID_SPACING,
+    bandwidth=None,
+    secondary_peak=True,
+) -> np.ndarray:
+    """find the KDE peak and the other KDE_OUTPUTS of the centred window of every point
+
+    With a `stride` larger than one only the window of every `stride`-th point is evaluated, and
+    the points in between are filled in along the track with `fill_strided`. The windows overlap
+    by all but `stride` points, so the peak changes slowly along the track and most of the cost
+    of the rolling KDE can be skipped, see `report_stride_drift` for the accuracy.
+
+    Args:
+        z (np.ndarray): elevations of the points, in along-track order
+        window (int): number of points in the window
+        method (str, optional): one of KDE_METHODS. Defaults to "binned".
+        stride (int, optional): number of points between the evaluated windows. Defaults to 1, which evaluates every window.
+        fill (str, optional): one of STRIDE_FILLS, see `fill_strided`. Defaults to "interpolate".
+        grid_spacing (float, optional): spacing of the elevation grid of the binned and incremental methods in meters. Defaults to DEFAULT_GRID_SPACING.
+        bandwidth (float, optional): fixed bandwidth of the incremental method in meters. Defaults to None.
+        secondary_peak (bool, optional): also find the secondary peak, see `_window_outputs`. Defaults to True.
+
+    Returns:
+        np.ndarray: (len(KDE_OUTPUTS), points) array, NaN for the points at the ends without a complete window
+    """
+    if method not in KDE_METHODS:
+        raise ValueError(f"method must be one of {list(KDE_METHODS)}")
+    if fill not in STRIDE_FILLS:
+        raise ValueError(f"fill must be one of {list(STRIDE_FILLS)}")
+    if stride < 1:
+        raise ValueError("stride must be at least 1")
+    z = np.asarray(z, dtype="<f8")
+    if method == "binned":
+        outputs = binned_rolling_kde(
+            z, window, grid_spacing=grid_spacing, stride=stride, secondary_peak=secondary_peak
+        )
+    elif method == "incremental":
+        outputs = incremental_rolling_kde(
+            z,
+            window,
+            bandwidth=bandwidth,
+            grid_spacing=grid_spacing,
+            stride=stride,
+            secondary_peak=secondary_peak,
+        )
+    else:
+        outputs = np.full((len(KDE_OUTPUTS), len(z)), np.NaN)
+        centers = _evaluated_centers(len(z), window, stride)
+        outputs[:, centers] = _evaluate_windows(
+            z,
+            *_point_window_bounds(centers, window),
+            "exact",
+            secondary_peak=secondary_peak,
+        )
+    if stride > 1:
+        outputs = fill_strided(outputs, _evaluated_centers(len(z), window, stride), fill)
+    return outputs
+
+
+def report_stride_drift(
+    z: np.ndarray,
+    window: int,
+    z_kde: np.ndarray,
+    kde_val: np.ndarray,
+    stride: int,
+    method="binned",
+    grid_spacing=DEFAULT_GRID_SPACING,
+    bandwidth=None,
+) -> dict:
+    """compare a strided rolling KDE with full evaluation for a sample of the skipped windows
+
+    The sampled windows are evaluated with the same method, so only the error of filling in the
+    skipped points is measured. The windows of the incremental method are evaluated with the
+    binned KDE at the same fixed bandwidth.
+
+    Args:
+        z (np.ndarray): elevations of the points, in along-track order
+        window (int): number of points in the window
+        z_kde (np.ndarray): filled elevation of the KDE peak for every point
+        kde_val (np.ndarray): filled density of the KDE peak for every point
+        stride (int): number of points between the evaluated windows
+        method (str, optional): method of the rolling KDE. Defaults to "binned".
+        grid_spacing (float, optional): spacing of the elevation grid in meters. Defaults to DEFAULT_GRID_SPACING.
+        bandwidth (float, optional): fixed bandwidth of the incremental method. Defaults to None.
+
+    Returns:
+        dict: number of sampled windows, median and maximum difference of the elevation of the peak in meters, and maximum relative difference of the density
+    """
+    z = np.asarray(z, dtype="<f8")
+    skipped = np.setdiff1d(
+        _window_centers(len(z), window), _evaluated_centers(len(z), window, stride)
+    )
+    skipped = skipped[~np.isnan(z_kde[skipped])]
+    drift = {"n_windows": 0, "z_median": np.NaN, "z_max": np.NaN, "kde_val_max": np.NaN}
+    if len(skipped) == 0:
+        return drift
+    # the sample is spread evenly over the track
+    sample = skipped[
+        np.unique(np.linspace(0, len(skipped) - 1, VALIDATION_SAMPLE_SIZE).astype(int))
+    ]
+    if method == "incremental":
+        method, bandwidth = (
+            "binned",
+            fixed_bandwidth(z, window) if bandwidth is None else bandwidth,
+        )
+    else:
+        bandwidth = None
+    full_z, full_val = _evaluate_windows(
+        z,
+        *_point_window_bounds(sample, window),
+        method,
+        grid_spacing,
+        bandwidth,
+        secondary_peak=False,
+    )[:2]
+    is_valid = ~np.isnan(full_z)
+    if not is_valid.any():
+        return drift
+    z_drift = np.abs(z_kde[sample] - full_z)[is_valid]
+    kde_val_drift = (np.abs(kde_val[sample] - full_val) / full_val)[is_valid]
+    drift = {
+        "n_windows": int(is_valid.sum()),
+        "z_median": float(np.median(z_drift)),
+        "z_max": float(z_drift.max()),
+        "kde_val_max": float(kde_val_drift.max()),
+    }
+    detail_logger.debug(
+        f"rolling KDE with a stride of {stride} compared with full evaluation for "
+        f"{drift['n_windows']} windows: the elevation of the peak differs by {drift['z_median']:.4f}m "
+        f"(median) and up to {drift['z_max']:.4f}m, the density by up to {drift['kde_val_max']:.2%}"
+    )
+    return drift
+
+
+def _fixed_bandwidth_peak(points: np.ndarray, bandwidth: float) -> tuple:
+    """elevation and density of the peak of a gaussian KDE with a fixed bandwidth, evaluated exactly at the points"""
+    distance = (points[:, None] - points[None, :]) / bandwidth
+    density = np.exp(-0.5 * distance**2).sum(axis=1) / (
+        len(points) * bandwidth * np.sqrt(2 * np.pi)
+    )
+    return points[density.argmax()], density.max()
+
+
+def validate_rolling_kde(
+    z: np.ndarray,
+    window: int,
+    z_kde: np.ndarray,
+    kde_val: np.ndarray,
+    tolerance: float,
+    method="binned",
+    bandwidth=None,
+):
+    """compare an approximate rolling KDE with the exact KDE for a sample of the windows
+
+    The incremental method uses one fixed bandwidth for all windows, so it is compared with an
+    exact KDE of the same bandwidth. The other methods are compared with a gaussian_kde of every
+    window.
+
+    Args:
+        z (np.ndarray): elevations of the points, in along-track order
+        window (int): number of points in the window
+        z_kde (np.ndarray): approximate elevation of the KDE peak for every point
+        kde_val (np.ndarray): approximate density of the KDE peak for every point
+        tolerance (float): maximum allowed difference of the elevation of the peak, in meters
+        method (str, optional): method of the rolling KDE. Defaults to "binned".
+        bandwidth (float, optional): fixed bandwidth of the incremental method. Defaults to None, which uses `fixed_bandwidth` like `incremental_rolling_kde`.
+
+    Raises:
+        ValueError: if the elevation of the peak of any of the sampled windows differs by more than `tolerance`
+    """
+    z = np.asarray(z, dtype="<f8")
+    centers = _window_centers(len(z), window)
+    centers = centers[~np.isnan(z_kde[centers])]
+    if len(centers) == 0:
+        return
+    # the sample is spread evenly over the track
+    sample = centers[
+        np.unique(np.linspace(0, len(centers) - 1, VALIDATION_SAMPLE_SIZE).astype(int))
+    ]
+    if method == "incremental":
+        if bandwidth is None:
+            is_finite = np.isfinite(z)
+            bandwidth = fixed_bandwidth(z[is_finite], min(window, is_finite.sum()))
+        exact_peak = partial(_fixed_bandwidth_peak, bandwidth=bandwidth)
+    else:
+        exact_peak = get_elev_at_max_density
+    exact = np.array(
+        [
+            exact_peak(z[center - window // 2 : center - window // 2 + window])
+            for center in sample
+        ]
+    )
+    z_drift = np.abs(z_kde[sample] - exact[:, 0]).max()
+    kde_val_drift = (np.abs(kde_val[sample] - exact[:, 1]) / exact[:, 1]).max()
+    detail_logger.debug(
+        f"rolling KDE compared with the exact KDE for {len(sample)} windows: the elevation of "
+        f"the peak differs by up to {z_drift:.4f}m and the density by up to {kde_val_drift:.2%}"
+    )
+    if z_drift > tolerance:
+        raise ValueError(
+            f"the elevation of the KDE peak differs by up to {z_drift:.4f}m from the exact KDE, which is more than the tolerance of {tolerance}m"
+        )
@@ -1,12 +1,8 @@
-from pathlib import Path
-
 import pandas as pd
 
 # from atl_module.geospatial_utils.geospatial_functions import add_track_dist_meters
 from atl_module.bathymetry_extraction.refraction_correction import correct_refr
-from atl_module.utility_functions.raster_interaction import query_raster
-
-p = Path(__file__).parents[3]
+from atl_module.utility_functions import gebco
 
 
 def add_msl_corrected_seafloor_elev(df_in):
@@ -15,6 +11,40 @@ def add_msl_corrected_seafloor_elev(df_in):
     return df_in.assign(sf_elev_MSL=dac_tide)
 
 
+# the masks below are the conditions of the filters, evaluated on columns of the photons. They are
+# used by the filters on this page, and by the fused filter of `icesat_bathymetry._filter_points`
+
+
+def high_returns_mask(z_geoid, max_geoid_high_z):
+    """mask of the points below `max_geoid_high_z`"""
+    return z_geoid < max_geoid_high_z
+
+
+def tep_mask(oc_sig_conf):
+    """mask of the points that are not transmitter echo path photons"""
+    return oc_sig_conf >= 0
+
+
+def low_points_mask(z_geoid, filter_below_z):
+    """mask of the points above `filter_below_z`"""
+    return z_geoid > filter_below_z
+
+
+def depth_mask(z_geoid, sea_level, filter_below_depth):
+    """mask of the points with an uncorrected depth less than `filter_below_depth`"""
+    return (z_geoid - sea_level) > filter_below_depth
+
+
+def surface_points_mask(z_geoid, sea_level, sea_level_std_dev, n=1, min_remove=1):
+    """mask of the points more than `n` standard deviations, and at least `min_remove`, below the sea level"""
+    return z_geoid < sea_level - max(n * sea_level_std_dev, min_remove)
+
+
+def gebco_mask(gebco_elev, low_limit_gebco, high_limit_gebco):
+    """mask of the points in the gebco nearshore zone"""
+    return (gebco_elev > low_limit_gebco) & (gebco_elev < high_limit_gebco)
+
+
 def filter_high_returns(df, max_geoid_high_z):
     """Remove returns above *level* which is an elevation in meters
 
@@ -26,7 +56,7 @@ def filter_high_returns(df, max_geoid_high_z):
         pd.DataFrame: output dataframe
     """
     # remove any points above 5m
-    return df.loc[(df.Z_geoid < max_geoid_high_z)]
+    return df.loc[high_returns_mask(df.Z_geoid, max_geoid_high_z)]
 
 
 def filter_TEP_and_nonassoc(df):
@@ -39,15 +69,29 @@ def filter_TEP_and_nonassoc(df):
         pd.DataFrame: Output dataframe
     """
     # remove any transmitter Echo Path photons
-    return df.loc[df.oc_sig_conf >= 0]
+    return df.loc[tep_mask(df.oc_sig_conf)]
+
+
+def sea_surface_stats(df):
+    """find the constant sea surface level of a beam from its high confidence photons
+
+    Args:
+        df (pd.DataFrame): photons of the beam, with at least `Z_geoid` and `oc_sig_conf`
+
+    Returns:
+        tuple: median and standard deviation of the geoidal elevation of the high confidence photons
+    """
+    high_conf_z = df.loc[df.oc_sig_conf >= 4]["Z_geoid"]
+    # find the median sea level and the std deviation
+    return high_conf_z.median(), high_conf_z.std()
 
 
 # TODO rewrite this to include NAs for non-high-confience photons
-def add_sea_surface_level(df, max_sea_surf_elev):
-    # find the median sea level
-    constant_sealevel = df.loc[df.oc_sig_conf >= 4]["Z_geoid"].median()
-    # find the std deviation
-    constant_sealevel_std = df.loc[df.oc_sig_conf >= 4]["Z_geoid"].std()
+def add_sea_surface_level(df, max_sea_surf_elev, sea_surface=None):
+    # the sea surface can be calculated in advance, when the beam is not processed all at once
+    if sea_surface is None:
+        sea_surface = sea_surface_stats(df)
+    constant_sealevel, constant_sealevel_std = sea_surface
     sealevel_df = df.assign(
         sea_level_interp=constant_sealevel, sea_level_std_dev=constant_sealevel_std
     )
@@ -59,30 +103,42 @@ def add_sea_surface_level(df, max_sea_surf_elev):
 
 def filter_low_points(df, filter_below_z):
     # drop any points with an uncorrected depth greater than a threshold
-    return df.loc[df.Z_geoid > filter_below_z]
+    return df.loc[low_points_mask(df.Z_geoid, filter_below_z)]
 
 
 def filter_depth(df, filter_below_depth):
     # drop any points with an uncorrected depth greater than a threshold
-    depth_series = df.Z_geoid - df.sea_level_interp
-    return df.loc[(depth_series > filter_below_depth)]
+    return df.loc[depth_mask(df.Z_geoid, df.sea_level_interp, filter_below_depth)]
 
 
 def remove_surface_points(df, n=1, min_remove=1):
     # remove all points `n` standard deviations away from the sea level
     # its constant so just grab the first one
     sea_level_std_dev = df.sea_level_interp.mean()
-    return df.loc[df.Z_geoid < df.sea_level_interp - max(n * sea_level_std_dev, min_remove)]
+    return df.loc[
+        surface_points_mask(df.Z_geoid, df.sea_level_interp, sea_level_std_dev, n, min_remove)
+    ]
+
 
+def gebco_elevation(df, coordinates=None):
+    """query the gebco ncdf file, or the GEBCO window of the process, for the GEBCO height at the points
 
-def add_gebco(df):
+    Args:
+        df (pd.DataFrame): points with `X` and `Y` columns
+        coordinates (pd.DataFrame, optional): `X` and `Y` of the points, for photons in the compact layout which only have coordinate offsets. Defaults to None.
+
+    Returns:
+        pd.Series: GEBCO height of each point
+    """
+    gebco_height = gebco.gebco_elevation(df if coordinates is None else coordinates)
+    return pd.Series(gebco_height, index=df.index)
+
+
+def add_gebco(df, coordinates=None):
     # query the gebco ncdf file, add the relevant GEBCO height
-    gebco_height = query_raster(
-        df,
-        p.joinpath("data/GEBCO/GEBCO_2021_sub_ice_topo.nc"),
-    )
+    # photons in the compact layout only have coordinate offsets, so their coordinates are given separately
     # return the dataframe with the new column
-    return df.assign(gebco_elev=gebco_height)
+    return df.assign(gebco_elev=gebco_elevation(df, coordinates))
 
 
 def filter_gebco(df: pd.DataFrame, low_limit_gebco: float, high_limit_gebco: float):
@@ -90,9 +146,7 @@ def filter_gebco(df: pd.DataFrame, low_limit_gebco: float, high_limit_gebco: flo
     if "gebco_elev" not in df.columns:
         raise ValueError("Make sure to add the gebco elevation before running this function")
     # filter points based on gebco
-    df = df[df.gebco_elev > low_limit_gebco]
-    df = df[df.gebco_elev < high_limit_gebco]
-    return df
+    return df.loc[gebco_mask(df.gebco_elev, low_limit_gebco, high_limit_gebco)]
 
 
 def correct_for_refraction(df):
@@ -14,7 +14,7 @@ from atl_module.bathymetry_extraction import icesat_bathymetry
 from atl_module.bathymetry_extraction.point_dataframe_filters import (
     add_msl_corrected_seafloor_elev,
 )
-from atl_module.utility_functions import error_calc, raster_interaction
+from atl_module.utility_functions import error_calc, gebco, raster_interaction
 from atl_module.utility_functions.geospatial_functions import (
     to_refr_corrected_gdf,
     trackline_gdf_from_netcdf,
@@ -57,7 +57,7 @@ class GebcoDownscaler:
         self.site_name = site_name
         # base folderpath to join with others
         self.folderpath = site
-        self.gebco_full_path = "/mnt/c/Users/maxli/OneDrive - Van Oord/Documents/thesis/data/GEBCO/GEBCO_2021_sub_ice_topo.nc"
+        self.gebco_full_path = gebco.gebco_source()
         self.truebathy_path = truebathy
         # set up the paths of the relevant vector files:
         self.trackline_path = os.path.join(self.folderpath, "tracklines")
@@ -67,6 +67,8 @@ class GebcoDownscaler:
         self.bilinear_gebco_raster_path = os.path.join(self.folderpath, "bilinear.tif")
         self.kriged_raster_path = os.path.join(self.folderpath, "kriging_output.tif")
         self.AOI_path = os.path.join(self.folderpath, "AOI.gpkg")
+        # decoded photons of the granules are cached here so they are only read from netcdf once
+        self.photon_cache_path = os.path.join(self.folderpath, "photon_cache")
 
         self.run_params = {}
         self.kriging_subset_points_path = os.path.join(self.folderpath, "kriging_pts")
@@ -90,10 +92,18 @@ class GebcoDownscaler:
             print("should subset gebco")
             # self.subset_gebco()
 
-    def download_ATL03(self):
-        """Request a data download with the extent determined by the AOI.gpkg in the folder"""
+    def download_ATL03(self, reformat_netcdf=True, keep_zipped=False):
+        """Request a data download with the extent determined by the AOI.gpkg in the folder
+
+        Args:
+            reformat_netcdf (bool, optional): have NSIDC reformat the granules to NetCDF4-CF. If False, the native HDF5 granules are downloaded, which skips the reformatting step. Both can be read. Defaults to True.
+            keep_zipped (bool, optional): keep the downloaded zip archives instead of extracting them. The granules are read straight from the archives. Defaults to False.
+        """
         request_full_data_shapefile(
-            folderpath=self.folderpath, shapefile_filepath=self.AOI_path
+            folderpath=self.folderpath,
+            shapefile_filepath=self.AOI_path,
+            reformat_netcdf=reformat_netcdf,
+            keep_zipped=keep_zipped,
         )
         detail_logger.info(f"ATL03 Data downloaded sucessfully to {self.folderpath}/ATL03")
 
@@ -104,7 +114,9 @@ class GebcoDownscaler:
 
     def recalc_tracklines_gdf(self):
         """Recalculate the tracklines from the raw netcdf files in the ATLO3/ folder"""
-        self.tracklines = trackline_gdf_from_netcdf(self.folderpath + "/ATL03/*.nc")
+        self.tracklines = trackline_gdf_from_netcdf(
+            self.folderpath + "/ATL03", bbox=self._aoi_bounds_wgs84()
+        )
         self.crs = self.tracklines.estimate_utm_crs()
         self.tracklines.to_file(self.trackline_path, overwrite=True)
         detail_logger.info(f"Tracklines written to {self.trackline_path}")
@@ -125,10 +137,17 @@ class GebcoDownscaler:
             aoi_data_path=self.bathy_pts_gdf,
             epsg_no=self.epsg,
             hres=hres,
+            gebco_path=self.gebco_full_path,
         )
         # set add the horizontal resoltion to the paramter dict
         self.run_params.update({"Horizontal resolution of upscaled product [m]": hres})
 
+    def _aoi_bounds_wgs84(self):
+        """Get the bounds of the AOI in degrees, or None if there is no AOI file in the folder"""
+        if not file_exists(self.AOI_path):
+            return None
+        return tuple(gpd.read_file(self.AOI_path).to_crs("EPSG:4326").total_bounds)
+
     def find_bathy_from_icesat(
         self,
         window,
@@ -143,6 +162,14 @@ class GebcoDownscaler:
         max_geoid_high_z,
         min_ph_count,
         save_result=True,
+        chunk_size=None,
+        layout="standard",
+        kde_options=None,
+        signal_finder="kde",
+        processes=None,
+        task_chunksize=1,
+        beam_type=None,
+        max_solar_elevation=None,
     ):
         self.run_params.update(
             {
@@ -157,6 +184,10 @@ class GebcoDownscaler:
                 "n": n,
                 "max_geoid_high_z": max_geoid_high_z,
                 "minimum segment photons": min_ph_count,
+                "KDE options": kde_options or {},
+                "signal finder": signal_finder,
+                "beam type": beam_type,
+                "max solar elevation": max_solar_elevation,
             }
         )
         detail_logger.info(
@@ -174,6 +205,16 @@ class GebcoDownscaler:
             filter_below_depth=filter_below_depth,
             n=n,
             max_geoid_high_z=max_geoid_high_z,
+            bbox=self._aoi_bounds_wgs84(),
+            cache_dir=self.photon_cache_path,
+            chunk_size=chunk_size,
+            layout=layout,
+            kde_options=kde_options,
+            signal_finder=signal_finder,
+            processes=processes,
+            task_chunksize=task_chunksize,
+            beam_type=beam_type,
+            max_solar_elevation=max_solar_elevation,
         )
         bathy_gdf = to_refr_corrected_gdf(bathy_pts, crs=self.crs)
         bathy_gdf = add_msl_corrected_seafloor_elev(bathy_gdf)
@@ -0,0 +1,402 @@
+"""Access to the GEBCO grid: a tiled store of the global grid, and memory-mapped windows of it
+
+All GEBCO reads of the package go through this module: `gebco_source` gives the raster to open with
+GDAL or rasterio, and `read_gebco_window` and `gebco_elevation` read the cells of an area or at
+points.
+
+The global GEBCO netCDF is large, and reading an area of it means random reads of a file of tens of
+GB. `build_gebco_tiles` converts it once into compressed GeoTIFF tiles of 1x1 degree, with a JSON
+index and a VRT of all tiles. Once the store exists it is used instead of the netCDF: a window is
+read from the few tiles that cover it, and GDAL only opens the tiles that a warp or a point lookup
+on the VRT needs. The values are the same as the values of the netCDF.
+
+Sampling the grid for every beam still means many small reads of the same area. Instead, the part
+of the grid that covers the area of interest is read once per run and saved as a `.npy` file with a
+small JSON file of its georeferencing. The window is opened memory-mapped, so all worker processes
+share the same pages of it through the OS page cache.
+
+Use `use_gebco_window` as the initializer of a worker pool to make the workers sample the window:
+
+    write_gebco_window(bbox, window_path)
+    with Pool(initializer=use_gebco_window, initargs=(window_path,)) as pool:
+        ...
+
+Points outside the window are sampled from the global grid, so the values are always the same as
+`query_raster` on the global grid.
+"""
+import json
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+import rasterio as rio
+import rasterio.windows as riowindows
+from affine import Affine
+from atl_module.utility_functions.raster_interaction import (
+    GEBCO_PATH,
+    GEBCO_TILE_DIR,
+    TILE_INDEX_FILENAME,
+    TILE_VRT_FILENAME,
+    _assign_na_values,
+    gebco_source,
+    query_raster,
+    wgs84_to_pixels,
+)
+from logzero import setup_logger
+from rasterio.crs import CRS
+
+detail_logger = setup_logger(name="details")
+
+# size of a tile of the store, in degrees
+TILE_DEGREES = 1
+# GDAL names of the data types of the tiles, for the VRT
+GDAL_DATA_TYPES = {
+    "uint8": "Byte",
+    "int16": "Int16",
+    "uint16": "UInt16",
+    "int32": "Int32",
+    "uint32": "UInt32",
+    "float32": "Float32",
+    "float64": "Float64",
+}
+# name of the GEBCO window of a site, in the site folder
+GEBCO_WINDOW_FILENAME = "gebco_window.npy"
+# number of GEBCO cells that are added around the area of interest
+WINDOW_MARGIN = 2
+
+# the window that is sampled by `gebco_elevation` in this process, set by `use_gebco_window`
+_active_window = None
+
+
+def _pixel_window(crs, transform, width: int, height: int, bbox: tuple, margin: int) -> tuple:
+    """rows and columns of a grid that cover a bounding box, with `margin` cells around it
+
+    Returns:
+        tuple: (row_off, col_off, n_rows, n_cols) of the window, clipped to the grid
+    """
+    # the corners of the area, transformed like the points that are sampled
+    minx, miny, maxx, maxy = bbox
+    cols, rows = wgs84_to_pixels(
+        crs,
+        transform,
+        np.array([minx, minx, maxx, maxx], dtype="<f8"),
+        np.array([miny, maxy, miny, maxy], dtype="<f8"),
+    )
+    row_off = max(int(np.floor(rows.min())) - margin, 0)
+    col_off = max(int(np.floor(cols.min())) - margin, 0)
+    row_stop = min(int(np.floor(rows.max())) + margin + 1, height)
+    col_stop = min(int(np.floor(cols.max())) + margin + 1, width)
+    return row_off, col_off, max(row_stop - row_off, 0), max(col_stop - col_off, 0)
+
+
+class GebcoTiles:
+    """Tiled store of the GEBCO grid, written by `build_gebco_tiles`
+
+    The tiles are numbered by their row and column in the grid of tiles, so the tiles of an area
+    are found from its rows and columns in the global grid, without searching.
+    """
+
+    def __init__(self, tile_dir: str or Path):
+        """open the index of a tiled store
+
+        Args:
+            tile_dir (str or Path): folder of the tiles
+        """
+        self.tile_dir = Path(tile_dir)
+        with open(self.tile_dir.joinpath(TILE_INDEX_FILENAME)) as f:
+            index = json.load(f)
+        self.crs = None if index["crs"] is None else CRS.from_wkt(index["crs"])
+        self.transform = Affine(*index["transform"])
+        self.width = index["width"]
+        self.height = index["height"]
+        self.cells_per_tile = index["cells_per_tile"]
+        self.dtype = np.dtype(index["dtype"])
+        self.nodata = index["nodata"]
+
+    @property
+    def vrt_path(self) -> Path:
+        """the VRT of all tiles, which can be opened as one raster"""
+        return self.tile_dir.joinpath(TILE_VRT_FILENAME)
+
+    def tile_path(self, tile_row: int, tile_col: int) -> Path:
+        """location of the tile at a row and column of the grid of tiles"""
+        return self.tile_dir.joinpath(f"{tile_row:03d}_{tile_col:03d}.tif")
+
+    def read(self, row_off: int, col_off: int, n_rows: int, n_cols: int) -> np.ndarray:
+        """read a window of the global grid from the tiles that cover it
+
+        Args:
+            row_off (int): first row of the window in the global grid
+            col_off (int): first column of the window in the global grid
+            n_rows (int): number of rows of the window
+            n_cols (int): number of columns of the window
+
+        Returns:
+            np.ndarray: the cells of the window
+        """
+        values = np.empty((n_rows, n_cols), dtype=self.dtype)
+        if n_rows == 0 or n_cols == 0:
+            return values
+        size = self.cells_per_tile
+        for tile_row in range(row_off // size, (row_off + n_rows - 1) // size + 1):
+            for tile_col in range(col_off // size, (col_off + n_cols - 1) // size + 1):
+                # the part of the window in this tile, in the global grid
+                row_start = max(row_off, tile_row * size)
+                row_stop = min(row_off + n_rows, (tile_row + 1) * size)
+                col_start = max(col_off, tile_col * size)
+                col_stop = min(col_off + n_cols, (tile_col + 1) * size)
+                with rio.open(self.tile_path(tile_row, tile_col)) as tile:
+                    values[
+                        row_start - row_off : row_stop - row_off,
+                        col_start - col_off : col_stop - col_off,
+                    ] = tile.read(
+                        1,
+                        window=riowindows.Window(
+                            col_start - tile_col * size,
+                            row_start - tile_row * size,
+                            col_stop - col_start,
+                            row_stop - row_start,
+                        ),
+                    )
+        return values
+
+
+def _write_tile_vrt(tiles: GebcoTiles) -> None:
+    """write a VRT of all tiles of a store, so the store can be opened as one raster by GDAL"""
+    size = tiles.cells_per_tile
+    a, b, c, d, e, f = list(tiles.transform)[:6]
+    sources = []
+    for tile_row in range(-(-tiles.height // size)):
+        for tile_col in range(-(-tiles.width // size)):
+            n_rows = min(size, tiles.height - tile_row * size)
+            n_cols = min(size, tiles.width - tile_col * size)
+            sources.append(
+                "    <SimpleSource>\n"
+                f'      <SourceFilename relativeToVRT="1">{tiles.tile_path(tile_row, tile_col).name}</SourceFilename>\n'
+                "      <SourceBand>1</SourceBand>\n"
+                f'      <SrcRect xOff="0" yOff="0" xSize="{n_cols}" ySize="{n_rows}"/>\n'
+                f'      <DstRect xOff="{tile_col * size}" yOff="{tile_row * size}" xSize="{n_cols}" ySize="{n_rows}"/>\n'
+                "    </SimpleSource>\n"
+            )
+    nodata = (
+        "" if tiles.nodata is None else f"    <NoDataValue>{tiles.nodata!r}</NoDataValue>\n"
+    )
+    srs = "" if tiles.crs is None else f"  <SRS>{escape(tiles.crs.to_wkt())}</SRS>\n"
+    with open(tiles.vrt_path, "w") as vrt:
+        vrt.write(
+            f'<VRTDataset rasterXSize="{tiles.width}" rasterYSize="{tiles.height}">\n'
+            f"{srs}"
+            f"  <GeoTransform>{c!r}, {a!r}, {b!r}, {f!r}, {d!r}, {e!r}</GeoTransform>\n"
+            f'  <VRTRasterBand dataType="{GDAL_DATA_TYPES[tiles.dtype.name]}" band="1">\n'
+            f"{nodata}"
+            f"{''.join(sources)}"
+            "  </VRTRasterBand>\n"
+            "</VRTDataset>\n"
+        )
+
+
+def build_gebco_tiles(src=None, tile_dir=None, tile_degrees=TILE_DEGREES) -> Path:
+    """convert the global GEBCO grid into a tiled store, this only has to be done once
+
+    The grid is read in strips of one row of tiles, so the memory that is used is that of one strip.
+
+    Args:
+        src (str or Path, optional): the global GEBCO grid. Defaults to None, which uses `GEBCO_PATH`.
+        tile_dir (str or Path, optional): folder of the tiles. Defaults to None, which uses `GEBCO_TILE_DIR`.
+        tile_degrees (float, optional): size of the tiles in degrees. Defaults to TILE_DEGREES.
+
+    Returns:
+        Path: the folder of the tiles
+    """
+    src = GEBCO_PATH if src is None else src
+    tile_dir = Path(GEBCO_TILE_DIR if tile_dir is None else tile_dir)
+    tile_dir.mkdir(parents=True, exist_ok=True)
+    with rio.open(src) as dataset:
+        cells_per_tile = int(round(tile_degrees / dataset.res[0]))
+        dtype = np.dtype(dataset.dtypes[0])
+        index = {
+            "source": str(src),
+            "crs": None if dataset.crs is None else dataset.crs.to_wkt(),
+            "transform": list(dataset.transform)[:6],
+            "width": dataset.width,
+            "height": dataset.height,
+            "cells_per_tile": cells_per_tile,
+            "dtype": dtype.name,
+            "nodata": dataset.nodata,
+        }
+        profile = dict(
+            driver="GTiff",
+            count=1,
+            dtype=dtype.name,
+            crs=dataset.crs,
+            nodata=dataset.nodata,
+            compress="deflate",
+            # horizontal differencing compresses integer grids, and the floating point predictor float grids
+            predictor=2 if dtype.kind in "iu" else 3,
+        )
+        for row_off in range(0, dataset.height, cells_per_tile):
+            strip_window = riowindows.Window(
+                0, row_off, dataset.width, min(cells_per_tile, dataset.height - row_off)
+            )
+            strip = dataset.read(1, window=strip_window)
+            for col_off in range(0, dataset.width, cells_per_tile):
+                tile_values = strip[:, col_off : col_off + cells_per_tile]
+                tile_window = riowindows.Window(
+                    col_off, row_off, tile_values.shape[1], tile_values.shape[0]
+                )
+                tile_path = tile_dir.joinpath(
+                    f"{row_off // cells_per_tile:03d}_{col_off // cells_per_tile:03d}.tif"
+                )
+                with rio.open(
+                    tile_path,
+                    "w",
+                    height=tile_values.shape[0],
+                    width=tile_values.shape[1],
+                    transform=riowindows.transform(tile_window, dataset.transform),
+                    **profile,
+                ) as tile:
+                    tile.write(tile_values, 1)
+            detail_logger.debug(
+                f"GEBCO tiles of rows {row_off} to {row_off + len(strip)} written"
+            )
+    # the index is written last, so an interrupted conversion is not used
+    with open(tile_dir.joinpath(TILE_INDEX_FILENAME), "w") as f:
+        json.dump(index, f)
+    _write_tile_vrt(GebcoTiles(tile_dir))
+    detail_logger.info(f"GEBCO grid {src} converted to tiles in {tile_dir}")
+    return tile_dir
+
+
+def _open_tiles():
+    """the tiled store in `GEBCO_TILE_DIR`, or None if it was not built"""
+    if GEBCO_TILE_DIR.joinpath(TILE_INDEX_FILENAME).exists():
+        return GebcoTiles(GEBCO_TILE_DIR)
+    return None
+
+
+def read_gebco_window(bbox: tuple, margin=WINDOW_MARGIN) -> tuple:
+    """read the cells of the GEBCO grid that cover an area, from the tiled store if it was built
+
+    Args:
+        bbox (tuple): (minx, miny, maxx, maxy) of the area of interest in degrees
+        margin (int, optional): number of cells that are added around the area. Defaults to WINDOW_MARGIN.
+
+    Returns:
+        tuple: the cells of the window, and a dictionary of the georeferencing of the global grid and the offset of the window in it
+    """
+    tiles = _open_tiles()
+    if tiles is not None:
+        row_off, col_off, n_rows, n_cols = _pixel_window(
+            tiles.crs, tiles.transform, tiles.width, tiles.height, bbox, margin
+        )
+        values = tiles.read(row_off, col_off, n_rows, n_cols)
+        crs, transform, source = tiles.crs, tiles.transform, tiles.vrt_path
+    else:
+        with rio.open(GEBCO_PATH) as dataset:
+            row_off, col_off, n_rows, n_cols = _pixel_window(
+                dataset.crs, dataset.transform, dataset.width, dataset.height, bbox, margin
+            )
+            values = dataset.read(
+                1, window=riowindows.Window(col_off, row_off, n_cols, n_rows)
+            )
+            crs, transform, source = dataset.crs, dataset.transform, GEBCO_PATH
+    georeferencing = {
+        "source": str(source),
+        "crs": None if crs is None else crs.to_wkt(),
+        "transform": list(transform)[:6],
+        "row_off": row_off,
+        "col_off": col_off,
+    }
+    return values, georeferencing
+
+
+class GebcoWindow:
+    """Memory-mapped window of the GEBCO grid, with the georeferencing of the grid it was read from"""
+
+    def __init__(self, path: str or Path):
+        """open a window that was written by `write_gebco_window`
+
+        Args:
+            path (str or Path): location of the `.npy` file of the window
+        """
+        self.path = Path(path)
+        self.values = np.load(self.path, mmap_mode="r")
+        with open(self.path.with_suffix(".json")) as f:
+            georeferencing = json.load(f)
+        self.source = georeferencing["source"]
+        self.crs = (
+            None if georeferencing["crs"] is None else CRS.from_wkt(georeferencing["crs"])
+        )
+        self.transform = Affine(*georeferencing["transform"])
+        self.row_off = georeferencing["row_off"]
+        self.col_off = georeferencing["col_off"]
+
+    def sample(self, points: pd.DataFrame) -> np.ndarray:
+        """get the GEBCO elevation of the cell that contains each point, like `query_raster`
+
+        Args:
+            points (pd.DataFrame): points with the longitude in `X` and the latitude in `Y`
+
+        Returns:
+            np.ndarray: GEBCO elevation of each point
+        """
+        lon = points.X.to_numpy(dtype="<f8")
+        lat = points.Y.to_numpy(dtype="<f8")
+        # the cells are found in the global grid, so the cell of a point is the same as in `query_raster`
+        cols, rows = wgs84_to_pixels(self.crs, self.transform, lon, lat)
+        rows = np.floor(rows).astype(int) - self.row_off
+        cols = np.floor(cols).astype(int) - self.col_off
+        height, width = self.values.shape
+        in_window = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+
+        elevation = np.empty(len(points))
+        elevation[in_window] = _assign_na_values(self.values[rows[in_window], cols[in_window]])
+        if not in_window.all():
+            detail_logger.debug(
+                f"{np.count_nonzero(~in_window)} points outside of the GEBCO window {self.path}"
+            )
+            elevation[~in_window] = query_raster(points.loc[~in_window], self.source)
+        return elevation
+
+
+def write_gebco_window(bbox: tuple, path: str or Path) -> Path:
+    """read the part of the GEBCO grid that covers an area, and save it for memory mapping
+
+    Args:
+        bbox (tuple): (minx, miny, maxx, maxy) of the area of interest in degrees
+        path (str or Path): location of the `.npy` file, the georeferencing is written next to it with a `.json` suffix
+
+    Returns:
+        Path: location of the `.npy` file
+    """
+    path = Path(path)
+    values, georeferencing = read_gebco_window(bbox)
+    np.save(path, values)
+    with open(path.with_suffix(".json"), "w") as f:
+        json.dump(georeferencing, f)
+    detail_logger.debug(f"GEBCO window of {bbox} written to {path}")
+    return path
+
+
+def use_gebco_window(path) -> None:
+    """sample the GEBCO window at `path` in this process, or the global grid if `path` is None
+
+    This is meant as the initializer of the worker processes of a pool.
+    """
+    global _active_window
+    _active_window = None if path is None else GebcoWindow(path)
+
+
+def gebco_elevation(points: pd.DataFrame) -> np.ndarray:
+    """get the GEBCO elevation at the points, from the window of this process if there is one
+
+    Args:
+        points (pd.DataFrame): points with the longitude in `X` and the latitude in `Y`
+
+    Returns:
+        np.ndarray: GEBCO elevation of each point
+    """
+    if _active_window is None:
+        return query_raster(points, gebco_source())
+    return _active_window.sample(points)
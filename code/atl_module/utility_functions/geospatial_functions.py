@@ -1,18 +1,19 @@
-import glob
 from os import PathLike
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-from atl_module.ATL03_preprocessing.atl03_netcdf_loading import (
-    get_beams,
-    load_beam_array_ncds,
-)
+from atl_module.ATL03_preprocessing.atl03_netcdf_loading import GranuleReader
+from atl_module.ATL03_preprocessing.granule_backends import granule_name
+from atl_module.ATL03_preprocessing.granule_catalog import GranuleCatalog
 from logzero import setup_logger
 from shapely.geometry import LineString, Point
 
 detail_logger = setup_logger(name="details")
 
+# tolerance of the simplification of the track geometry, in degrees (roughly 10m)
+TRACK_SIMPLIFY_TOLERANCE = 1e-4
+
 
 def to_refr_corrected_gdf(df, crs):
     """Take the original gdf of the bathymetry points, translate them to the local UTM zone, and changes the points based on the calculated refraction
@@ -64,78 +65,94 @@ def _get_single_track_linegeom(beamarray: np.ndarray) -> LineString:
         return LineString(coords)
 
 
-def trackline_gdf_from_netcdf(directory: str or PathLike) -> gpd.GeoDataFrame:
+def _get_segment_track_linegeom(segment_array: np.ndarray) -> LineString:
+    """make a linestring through the reference photons of the segments of a track, simplified to the vertices that are needed to describe its shape"""
+    # segments without photons have no reference photon, so they have no location
+    has_location = (
+        (segment_array["ph_count"] > 0)
+        & np.isfinite(segment_array["X"])
+        & np.isfinite(segment_array["Y"])
+    )
+    coords = np.column_stack(
+        [segment_array["X"][has_location], segment_array["Y"][has_location]]
+    )
+    if len(coords) < 2:
+        return None
+    # the segments are in along-track order, so this follows the track
+    return LineString(coords).simplify(TRACK_SIMPLIFY_TOLERANCE, preserve_topology=False)
+
+
+def _photon_weighted_mean(segment_values: np.ndarray, ph_count: np.ndarray) -> float:
+    """mean of a segment-rate variable over all the photons of a track, where each segment counts once per photon in it"""
+    valid = np.isfinite(segment_values) & (ph_count > 0)
+    if not valid.any():
+        return np.NaN
+    return np.average(segment_values[valid], weights=ph_count[valid])
+
+
+def _trackline_record(filefriendlyname: str, beam: str, segment_array: np.ndarray) -> dict:
+    """summarize one beam of a granule for the trackline geodataframe"""
+    metadata = segment_array.dtype.metadata
+    ph_count = segment_array["ph_count"]
+    return {
+        "file": filefriendlyname,
+        "geometry": _get_segment_track_linegeom(segment_array),
+        "rgt": metadata["start_rgt"],
+        "date": metadata["data_start_utc"],
+        "beam": beam,
+        "beam_type": metadata["atlas_beam_type"],
+        "n_photons": int(ph_count.sum()),
+        "p_hconf": metadata["ocean_high_conf_perc"],
+        # the photon-weighted means are the same as the means over the photons of the beam
+        "avg_ph_count": _photon_weighted_mean(ph_count.astype("<f8"), ph_count),
+        "avg_fsat": _photon_weighted_mean(segment_array["full_sat"], ph_count),
+    }
+
+
+def trackline_gdf_from_netcdf(directory: str or PathLike, bbox=None) -> gpd.GeoDataFrame:
     """Generates a GeoDataFrame of all the tracks in a given folder, with information about the date and the quality
 
+    Only the segment-rate geolocation variables and the metadata are read from the granules, not
+    the photons. The geometry of each track follows the reference photons of its segments. The
+    granule catalog of the folder is updated first, and only the granules with beams in `bbox`
+    are opened.
+
     Args:
-        directory (strorPathLike): Location of the folder to search for netcdf files
+        directory (strorPathLike): Location of the folder with the netcdf files
+        bbox (tuple, optional): (minx, miny, maxx, maxy) in degrees. Only tracks that intersect it are included. Defaults to None.
 
     Returns:
         gpd.GeoDataFrame: Dataframe containing all the tracks of interest, projected in local UTM coodrinate system
     """
-    # TODO: fix this unreadable function
-    # try to decrease the indent level - itertools?
-    beamlist = []
-    datelist = []
-    rgtlist = []
-    filenamelist = []
-    geomlist = []
-    beam_type_list = []
-    number_photons_list = []
-    percent_high_conf_list = []
-    avg_ph_count_list = []
-    avg_full_sat_list = []
+    with GranuleCatalog(directory) as catalog:
+        catalog.update()
+        beams_by_file = catalog.beams_by_file(bbox=bbox)
 
+    records = []
     # loop over netcdf file list
-    for h5file in glob.iglob(directory):
-
-        filefriendlyname = str(h5file.split("/")[-1]).strip(".nc")
-
-        # all list writes need to be inside this loop
-        for beam in get_beams(h5file):
-            # get the point array and make it into a linestring
-            point_array = load_beam_array_ncds(h5file, beam)
-            track_geom = _get_single_track_linegeom(point_array)
-
-            # write to all the lists
-            # we can stack this into a multiindex later
-
-            filenamelist.append(filefriendlyname)
-            beamlist.append(beam)
-            geomlist.append(track_geom)
-            # if there are no valid beams in the array, skip it
-            if point_array is None:
-                rgtlist.append(np.NaN)
-                datelist.append(np.NaN)
-                percent_high_conf_list.append(np.NaN)
-                avg_ph_count_list.append(np.NaN)
-                avg_full_sat_list.append(np.NaN)
-            else:
-                rgt = point_array.dtype.metadata["start_rgt"]
-                date = point_array.dtype.metadata["data_start_utc"]
-                beamtype = point_array.dtype.metadata["atlas_beam_type"]
-                p_oc_h_conf = point_array.dtype.metadata["ocean_high_conf_perc"]
-                rgtlist.append(rgt)
-                datelist.append(date)
-                beam_type_list.append(beamtype)
-                number_photons_list.append(len(point_array))
-                percent_high_conf_list.append(p_oc_h_conf)
-                avg_ph_count_list.append(np.mean(point_array["ph_count"]))
-                avg_full_sat_list.append(np.mean(point_array["full_sat"]))
+    for h5file, beams in beams_by_file.items():
+        filefriendlyname = granule_name(h5file)
+        # the granule is opened once, and each beam is read from the same file handle
+        with GranuleReader(h5file) as granule:
+            for beam in beams:
+                segment_array = granule.load_beam_segments(beam)
+                records.append(_trackline_record(filefriendlyname, beam, segment_array))
+
     # get geodataframe in same CRS as icessat data
     gdf = gpd.GeoDataFrame(
-        {
-            "file": filenamelist,
-            "geometry": geomlist,
-            "rgt": rgtlist,
-            "date": datelist,
-            "beam": beamlist,
-            "beam_type": beam_type_list,
-            "n_photons": number_photons_list,
-            "p_hconf": percent_high_conf_list,
-            "avg_ph_count": avg_ph_count_list,
-            "avg_fsat": avg_full_sat_list,
-        },
+        records,
+        columns=[
+            "file",
+            "geometry",
+            "rgt",
+            "date",
+            "beam",
+            "beam_type",
+            "n_photons",
+            "p_hconf",
+            "avg_ph_count",
+            "avg_fsat",
+        ],
         crs="EPSG:4326",
         geometry="geometry",
     ).set_index(["file", "beam"])
@@ -1,5 +1,6 @@
 import subprocess
-from subprocess import PIPE, Popen
+from functools import lru_cache
+from pathlib import Path
 
 import geopandas as gpd
 import numpy as np
@@ -10,6 +11,7 @@ import rasterio as rio
 import rasterio.windows as riowindows
 from logzero import logger, setup_logger
 from osgeo import gdal
+from pyproj import Transformer
 
 gdal.UseExceptions()
 # TODO this needs to be refactored to use rasterio since import gdal and rasterio can cause issues
@@ -17,6 +19,22 @@ gdal.UseExceptions()
 
 detail_logger = setup_logger(name="details")
 
+# raster values that are treated as missing data
+RASTER_NA_VALUES = (-999999, -9999)
+# ways to find the value of a raster at a point
+SAMPLE_METHODS = ("nearest", "bilinear")
+# the global GEBCO grid, and the folder of the tiled store made from it by
+# `gebco.build_gebco_tiles`. They are defined here so `subset_gebco` can find the raster, the
+# gebco module imports them from this module
+GEBCO_PATH = Path(__file__).parents[3].joinpath("data/GEBCO/GEBCO_2021_sub_ice_topo.nc")
+GEBCO_TILE_DIR = GEBCO_PATH.parent.joinpath("tiles")
+TILE_INDEX_FILENAME = "index.json"
+TILE_VRT_FILENAME = "gebco_tiles.vrt"
+# the raster is read in windows of at most this many rows that cover the points
+SAMPLE_WINDOW_ROWS = 512
+# the windows are split where the columns of consecutive points are further apart than this
+SAMPLE_WINDOW_COLUMN_GAP = 64
+
 
 def write_error_improvement_raster(folder, aoipath):
     # gebco and measurement error rasters should have the same CRS.
@@ -94,22 +112,97 @@ def clip_to_datawindow(rasterpath, aoipath):
             dst.write(src.read(window=finalwindow))
 
 
-def _assign_na_values(inpval):
-    """internal function that just returns a NaN if the value return by gdalrasterquery is the nan value of the raster
+def gebco_source() -> Path:
+    """the GEBCO raster to open with GDAL or rasterio, the VRT of the tiled store if it was built, or else the global netCDF"""
+    if GEBCO_TILE_DIR.joinpath(TILE_INDEX_FILENAME).exists():
+        return GEBCO_TILE_DIR.joinpath(TILE_VRT_FILENAME)
+    return GEBCO_PATH
+
+
+def _assign_na_values(values: np.ndarray) -> np.ndarray:
+    """internal function that replaces the values that are the nan value of the raster with NaN
 
     Args:
-        inpval (float): the elevation from the raster
+        values (np.ndarray): the elevations from the raster
 
     Returns:
-        float: either the float that was entered, or np.NaN if it is a nodata value
+        np.ndarray: the values as floats, with np.NaN for the nodata values
     """
-    # this could be inlined into a lambda function, and made to predict the nodata value
+    values = values.astype("<f8")
+    values[np.isin(values, RASTER_NA_VALUES)] = np.NaN
+    return values
+
+
+@lru_cache(maxsize=None)
+def _wgs84_transformer(crs_wkt: str) -> Transformer:
+    """transformer from longitude and latitude to the CRS of a raster, created once for each CRS"""
+    return Transformer.from_crs("EPSG:4326", crs_wkt, always_xy=True)
+
+
+def wgs84_to_pixels(crs, transform, lon: np.ndarray, lat: np.ndarray) -> tuple:
+    """fractional column and row in a raster of points given in longitude and latitude
+
+    Args:
+        crs (rasterio.crs.CRS): CRS of the raster, rasters without a CRS are assumed to be in longitude and latitude
+        transform (affine.Affine): geotransform of the raster
+        lon (np.ndarray): longitude of the points
+        lat (np.ndarray): latitude of the points
+
+    Returns:
+        tuple: column and row of each point, -1 for the points without coordinates
     """
-    assign the appropriate value to the output of the gdallocationinfo response. '-99999' and an empty string are NaN values
+    if crs is None:
+        x, y = lon, lat
+    else:
+        x, y = _wgs84_transformer(crs.to_wkt()).transform(lon, lat)
+    cols, rows = ~transform * (np.asarray(x), np.asarray(y))
+    is_valid = np.isfinite(cols) & np.isfinite(rows)
+    return np.where(is_valid, cols, -1), np.where(is_valid, rows, -1)
+
+
+def _read_pixels(dataset, band: int, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    """read the values of the pixels at (rows, cols) from an open raster
+
+    Only windows that cover the pixels are read, in bands of at most `SAMPLE_WINDOW_ROWS` rows, so
+    the memory that is used does not depend on the size of the raster. A band is split into
+    several windows where the columns of the pixels are more than `SAMPLE_WINDOW_COLUMN_GAP`
+    apart, so pixels that are spread out, or on both sides of the antimeridian, do not read all
+    the columns between them.
+
+    Args:
+        dataset (rasterio.DatasetReader): the open raster
+        band (int): the raster band number
+        rows (np.ndarray): row of each pixel
+        cols (np.ndarray): column of each pixel
 
-    Anything else will return the input coerced to a float
+    Returns:
+        np.ndarray: value of each pixel, NaN for the pixels outside of the raster
     """
-    return np.NaN if inpval in ["", "-999999", "-9999"] else float(inpval)
+    values = np.full(len(rows), np.NaN)
+    inside = np.flatnonzero(
+        (rows >= 0) & (rows < dataset.height) & (cols >= 0) & (cols < dataset.width)
+    )
+    inside = inside[np.argsort(rows[inside], kind="stable")]
+    row_band = rows[inside] // SAMPLE_WINDOW_ROWS
+    for band_pixels in np.split(inside, np.flatnonzero(np.diff(row_band)) + 1):
+        band_pixels = band_pixels[np.argsort(cols[band_pixels], kind="stable")]
+        column_gaps = np.flatnonzero(np.diff(cols[band_pixels]) > SAMPLE_WINDOW_COLUMN_GAP)
+        for pixels in np.split(band_pixels, column_gaps + 1):
+            if len(pixels) == 0:
+                continue
+            pixel_rows, pixel_cols = rows[pixels], cols[pixels]
+            row_off, col_off = pixel_rows.min(), pixel_cols.min()
+            window = riowindows.Window(
+                col_off,
+                row_off,
+                pixel_cols.max() - col_off + 1,
+                pixel_rows.max() - row_off + 1,
+            )
+            data = dataset.read(band, window=window)
+            values[pixels] = _assign_na_values(
+                data[pixel_rows - row_off, pixel_cols - col_off]
+            )
+    return values
 
 
 def query_from_lines(line, rasterpath, band, npts=200):
@@ -136,39 +229,57 @@ def query_from_lines(line, rasterpath, band, npts=200):
 
 
 # function that gets values from rasters for each lidar photon
-def query_raster(dataframe: pd.DataFrame, src: str, band=1):
+def query_raster(dataframe: pd.DataFrame, src: str, band=1, method="nearest"):
     """Takes a dataframe with a column named X and Y (WITH WGSLATLONGS) and a raster file, and returns the raster value at each point X and Y
 
+    The coordinates are transformed to the CRS of the raster, and the value of the pixel that
+    contains each point is read, like `gdallocationinfo -wgs84`. Points outside of the raster and
+    points on nodata values get NaN.
+
     Args:
         dataframe (pd.DataFrame): Column with X and Y values, in the same CRS as the raster
         src (str): PathLike string that is the path of the raster to query
+        band (int, optional): the raster band number. Defaults to 1.
+        method (str, optional): `nearest` for the value of the pixel that contains the point, or `bilinear` to interpolate between the centers of the four nearest pixels. Defaults to "nearest".
 
     Returns:
         ndarray: 1D Array of values at each point.
     """
     # TODO maybe adjust this to deal with the refraction-corrected locations. Might make a very small difference
     # but any accuracy gain might be offset by the the uncertainty in the transforms when going from easting/norting to geographic coordinates
+    if method not in SAMPLE_METHODS:
+        raise ValueError(f"Unknown sampling method {method!r}, use one of {SAMPLE_METHODS}")
+    lon = dataframe.X.to_numpy(dtype="<f8")
+    lat = dataframe.Y.to_numpy(dtype="<f8")
+    with rio.open(src) as dataset:
+        cols, rows = wgs84_to_pixels(dataset.crs, dataset.transform, lon, lat)
+
+        if method == "nearest":
+            return _read_pixels(
+                dataset, band, np.floor(rows).astype(int), np.floor(cols).astype(int)
+            )
 
-    # takes a dataframe of points, and any GDAL raster as input
-    xylist = dataframe.loc[:, ["X", "Y"]].values
-    # take x,y pairs from dataframe, convert to a big string, then into a bytestring to feed into the pipe ##
-
-    # first we take the coordinates and combine them as strings
-    coordlist = "".join([f"{x} {y} " for x, y in xylist.tolist()])
-
-    # convert string to a bytestring to keep GDAL happy
-    pipeinput = bytes(coordlist, "utf-8")
-
-    # gdal location info command with arguments
-    cmd = ["gdallocationinfo", "-wgs84", "-valonly", "-b", str(band), src]
-    # open a pipe to these commands
-    with Popen(cmd, stdout=PIPE, stdin=PIPE) as p:
-        # feed in our bytestring
-        out, err = p.communicate(input=pipeinput)
-    outlist = out.decode("utf-8").split("\n")
-    # go through and assign NA values as needed. Also discard the extra empty line that the split command induces
-    # TODO this could be changed to use filter() and automatically
-    return [_assign_na_values(inpval) for inpval in outlist[:-1]]
+        # the points are interpolated between the pixel centers, at the edges of the raster the
+        # values of the edge pixels are used
+        is_inside = (
+            (cols >= 0) & (cols < dataset.width) & (rows >= 0) & (rows < dataset.height)
+        )
+        center_cols, center_rows = cols - 0.5, rows - 0.5
+        col0, row0 = np.floor(center_cols).astype(int), np.floor(center_rows).astype(int)
+        col_frac, row_frac = center_cols - col0, center_rows - row0
+        col0, col1 = np.clip(col0, 0, dataset.width - 1), np.clip(
+            col0 + 1, 0, dataset.width - 1
+        )
+        row0, row1 = np.clip(row0, 0, dataset.height - 1), np.clip(
+            row0 + 1, 0, dataset.height - 1
+        )
+        values = (
+            _read_pixels(dataset, band, row0, col0) * (1 - col_frac) * (1 - row_frac)
+            + _read_pixels(dataset, band, row0, col1) * col_frac * (1 - row_frac)
+            + _read_pixels(dataset, band, row1, col0) * (1 - col_frac) * row_frac
+            + _read_pixels(dataset, band, row1, col1) * col_frac * row_frac
+        )
+    return np.where(is_inside, values, np.NaN)
 
 
 # TODO maybe delete, goign to comment this out and see if anything breaks
@@ -183,7 +294,7 @@ def query_raster(dataframe: pd.DataFrame, src: str, band=1):
 
 
 # TODO change this function to take the bounds as in input instead of the dataframe
-def subset_gebco(folderpath: str, aoi_data_path, epsg_no: int, hres: int):
+def subset_gebco(folderpath: str, aoi_data_path, epsg_no: int, hres: int, gebco_path=None):
     """Create a resampled (bilinearly) and reprojected subset of the global GEBCO dataset. Write it to the same input folder
 
     Args:
@@ -191,14 +302,13 @@ def subset_gebco(folderpath: str, aoi_data_path, epsg_no: int, hres: int):
         tracklines (gpd.GeoDataFrame): The tracklines geodataframe object
         epsg_no (int): The integer number of the EPSG code for the desired CRS
         hres (int): The horizontal (x and y) resolution of the resampled image
+        gebco_path (str or Path, optional): The global GEBCO raster. Defaults to None, which uses `gebco_source`.
 
     Returns:
         None
     """
     # TODO mask first, before interpolation
 
-    # constant that defines location of the GEBCO raster
-    GEBCO_LOCATION = "../data/GEBCO/GEBCO_2021_sub_ice_topo.nc"
     # get the trackline GDF
     # before buffering make sure we are not working in degrees
 
@@ -221,7 +331,9 @@ def subset_gebco(folderpath: str, aoi_data_path, epsg_no: int, hres: int):
         # format='GTiff',
         # cropToCutline=aoi_data_path,
     )
-    ds = gdal.Warp(out_raster_path, GEBCO_LOCATION, options=options)
+    if gebco_path is None:
+        gebco_path = gebco_source()
+    ds = gdal.Warp(out_raster_path, str(gebco_path), options=options)
     ds = None
 
     # reopen with rasterio to mask out the values out of range
@@ -0,0 +1,146 @@
+"""Move dataframes from worker processes to the parent process through shared memory
+
+A worker writes the numeric columns of its result into one shared memory block, and only returns
+a small handle with the name of the block and the position of each column. The parent process
+allocates each column of the combined result once, copies the blocks into it, and frees each
+block as soon as it is copied. This avoids pickling the results and the extra copy of `pd.concat`.
+
+Columns of python objects (the beam names, for instance) are small, and are pickled with the
+handle.
+
+The blocks are registered with the resource tracker, which the workers share with the parent
+process if it is started before them, see `start_tracker`. A block that is not freed because of
+an error is then still removed when the parent process exits.
+"""
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+# name of the index in the shared memory block, it can not be the name of a column
+INDEX_KEY = ("index",)
+
+
+def start_tracker() -> None:
+    """start the resource tracker in the parent process, so the worker processes that are started after it share it
+
+    Otherwise every worker starts its own tracker, which removes the blocks of the worker when it
+    exits, before the parent process has read them.
+    """
+    resource_tracker.ensure_running()
+
+
+def _is_shared(array: np.ndarray) -> bool:
+    """only arrays without python objects can be put in shared memory"""
+    return array.dtype.kind != "O"
+
+
+def share_frame(df: pd.DataFrame) -> dict:
+    """copy a dataframe into a new shared memory block, and return a handle to read it back
+
+    The block stays available after the worker process exits, it is freed by `gather_frames` or
+    `release_frames` in the parent process. The parent process has to call `start_tracker`
+    before the workers are started.
+
+    Args:
+        df (pd.DataFrame): dataframe with a single level index and single level columns
+
+    Returns:
+        dict: handle of the dataframe, or None if `df` is None
+    """
+    if df is None:
+        return None
+    arrays = {INDEX_KEY: df.index.to_numpy()}
+    arrays.update({column: df[column].to_numpy() for column in df.columns})
+    layout = []
+    offset = 0
+    for key, array in arrays.items():
+        if _is_shared(array):
+            layout.append((key, array.dtype.str, offset))
+            # align every column, so it can be read in place
+            offset += -(-array.nbytes // 8) * 8
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    try:
+        for key, dtype, column_offset in layout:
+            shared = np.ndarray(len(df), dtype=dtype, buffer=block.buf, offset=column_offset)
+            shared[:] = arrays[key]
+            # the block can only be closed when no array refers to it
+            del shared
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    block.close()
+    return {
+        "name": block.name,
+        "n_rows": len(df),
+        "columns": list(df.columns),
+        "layout": layout,
+        "objects": {key: array for key, array in arrays.items() if not _is_shared(array)},
+    }
+
+
+def release_frames(handles) -> None:
+    """free the shared memory blocks of the handles, without reading them. Blocks that were already freed are skipped"""
+    for handle in handles:
+        if handle is None:
+            continue
+        try:
+            block = shared_memory.SharedMemory(name=handle["name"])
+        except FileNotFoundError:
+            continue
+        block.close()
+        block.unlink()
+
+
+def gather_frames(handles) -> pd.DataFrame:
+    """combine the dataframes of the handles in one dataframe, and free their shared memory
+
+    The result is the same as `pd.concat` of the dataframes. All dataframes need the same columns.
+
+    Args:
+        handles (list): handles from `share_frame`, the ones that are None are skipped
+
+    Returns:
+        pd.DataFrame: the combined dataframe, or None if all handles are None
+    """
+    handles = [handle for handle in handles if handle is not None]
+    if len(handles) == 0:
+        return None
+    columns = handles[0]["columns"]
+    if any(handle["columns"] != columns for handle in handles):
+        release_frames(handles)
+        raise ValueError("The dataframes in shared memory do not have the same columns")
+    n_rows = sum(handle["n_rows"] for handle in handles)
+    # allocate each column of the result once
+    dtypes = {}
+    for handle in handles:
+        for key, dtype, _ in handle["layout"]:
+            dtypes.setdefault(key, []).append(np.dtype(dtype))
+        for key, array in handle["objects"].items():
+            dtypes.setdefault(key, []).append(array.dtype)
+    combined = {
+        key: np.empty(n_rows, dtype=np.result_type(*dtype)) for key, dtype in dtypes.items()
+    }
+
+    start = 0
+    for handle_index, handle in enumerate(handles):
+        stop = start + handle["n_rows"]
+        try:
+            block = shared_memory.SharedMemory(name=handle["name"])
+        except FileNotFoundError:
+            release_frames(handles[handle_index + 1 :])
+            raise
+        for key, dtype, offset in handle["layout"]:
+            combined[key][start:stop] = np.ndarray(
+                handle["n_rows"], dtype=dtype, buffer=block.buf, offset=offset
+            )
+        block.close()
+        block.unlink()
+        for key, array in handle["objects"].items():
+            combined[key][start:stop] = array
+        start = stop
+    index = combined.pop(INDEX_KEY)
+    return pd.DataFrame(
+        {column: combined[column] for column in columns}, index=index, copy=False
+    )
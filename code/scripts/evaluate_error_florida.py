@@ -1,71 +1,100 @@
 """
 This script runs the clusting logic on every available beam from florida, and compares the errors with available DEMS
 """
-from glob import iglob
 from itertools import islice
 from os.path import basename
 
 # %%
-import atl03_utils
-
-
-def test_florida(filename, beam):
+import pandas as pd
+from atl_module.ATL03_preprocessing.atl03_netcdf_loading import GranuleReader
+from atl_module.ATL03_preprocessing.granule_catalog import GranuleCatalog
+from atl_module.bathymetry_extraction.icesat_bathymetry import (
+    BATHY_COLUMNS,
+    _filter_points,
+    find_signal,
+)
+from atl_module.bathymetry_extraction.point_dataframe_filters import (
+    add_msl_corrected_seafloor_elev,
+)
+from atl_module.utility_functions.error_calc import add_true_elevation, icesat_rmse
+
+SITE_PATH = "../data/test_sites/florida_keys"
+DEMS = {
+    "2019_irma": f"{SITE_PATH}/in-situ-DEM/2019_irma.vrt",
+    "fema_2017": f"{SITE_PATH}/in-situ-DEM/fema_2017.tif",
+    "gebco": f"{SITE_PATH}/GEBCO/gebco.tif",
+}
+CRS = "EPSG:32617"
+
+
+def test_florida(filename, beam, beamarray):
     """Run a test of a specific pass and beam, and check the error against ground truth florida DEMs
 
     Args:
         filename (str): path of h5 or netcdf file of a granule
         beam (str): string of a beam name
+        beamarray (np.ndarray): photons of the beam, with the along-track distance
 
     Returns:
         dict: dictionary of RMS error against various florida DEMs.
     """
-    beamdata = atl03_utils.load_beam_array_ncds(filename, beam)
-    if beamdata is None:
-        return "Could not open beam"
-
-    point_dataframe = atl03_utils.add_track_dist_meters(beamdata)
-
-    point_dataframe = point_dataframe.bathy.filter_TEP()
-    point_dataframe = point_dataframe.bathy.add_sea_level()
-    point_dataframe = point_dataframe.bathy.filter_low_points()
-    point_dataframe = point_dataframe.bathy.remove_surface_points()
-    point_dataframe = atl03_utils.add_dem_data(
-        point_dataframe,
-        [
-            "../data/test_sites/florida_keys/in-situ-DEM/2019_irma.vrt",
-            "../data/test_sites/florida_keys/in-situ-DEM/fema_2017.tif",
-            "../data/test_sites/florida_keys/GEBCO/gebco.tif",
-        ],
+    point_dataframe = _filter_points(
+        pd.DataFrame(beamarray),
+        low_limit_gebco=-40,
+        high_limit_gebco=1,
+        max_sea_surf_elev=2,
+        filter_below_z=-40,
+        filter_below_depth=-40,
+        n=1,
+        max_geoid_high_z=5,
+        metadata=beamarray.dtype.metadata,
     )
 
-    point_dataframe = point_dataframe[point_dataframe["gebco"] > -40]
-
     if len(point_dataframe) < 10:
         return "Not enough viable points after filtering"
-    # point_dataframe = atl03_utils.add_track_dist_meters(point_dataframe.drop(columns=['dist_or']).to_records())
 
-    point_dataframe = atl03_utils.cluster_signal_dbscan(
-        point_dataframe, Ra=0.2, minpts=10, hscale=1000, chunksize=500
+    point_dataframe = find_signal(
+        point_dataframe,
+        window=None,
+        signal_finder="dbscan",
+        radius=0.2,
+        min_points=10,
+        hscale=1000,
+        chunk_size=500,
     )
 
-    signal_pts = point_dataframe[point_dataframe.SN == "signal"]
+    # the noise photons have no density
+    signal_pts = point_dataframe[point_dataframe.kde_val > 0]
     if len(signal_pts) == 0:
         return "no signal found"
-    signal_pts = atl03_utils.add_raw_seafloor(signal_pts)
+    signal_pts = add_msl_corrected_seafloor_elev(signal_pts)
 
-    ax = signal_pts.plot.line(x="dist_or", y="sf_refr", title=f"{basename(filename)} - {beam}")
-    point_dataframe.plot.scatter(x="dist_or", y="Z_g", ax=ax, color="black", s=0.1)
-    signal_pts.plot.scatter(x="dist_or", y="Z_g", ax=ax, color="red", s=0.1)
-    point_dataframe.plot.line(x="dist_or", y="2019_irma", ax=ax, color="green")
+    errors = {}
+    for dem_name, dem_path in DEMS.items():
+        dem_pts = add_true_elevation(signal_pts, dem_path, crs=CRS)
+        signal_pts = signal_pts.assign(**{dem_name: dem_pts.true_elevation})
+        errors[dem_name] = icesat_rmse(dem_pts)
+
+    ax = signal_pts.plot.line(
+        x="dist_along", y="sf_elev_MSL", title=f"{basename(filename)} - {beam}"
+    )
+    point_dataframe.plot.scatter(x="dist_along", y="Z_refr", ax=ax, color="black", s=0.1)
+    signal_pts.plot.scatter(x="dist_along", y="Z_refr", ax=ax, color="red", s=0.1)
+    signal_pts.plot.line(x="dist_along", y="2019_irma", ax=ax, color="green")
 
-    return atl03_utils.calc_rms_error(signal_pts, ["gebco", "2019_irma", "fema_2017"])
+    return errors
 
 
 def main():
-    for filename in islice(iglob("../data/test_sites/florida_keys/ATL03/*.nc"), 0, 4):
-        beams = atl03_utils.get_beams(filename)
-        for beam in beams:
-            print(test_florida(filename, beam))
+    with GranuleCatalog(f"{SITE_PATH}/ATL03") as catalog:
+        catalog.update()
+        beams_by_file = catalog.beams_by_file()
+    for filename, beams in islice(beams_by_file.items(), 0, 4):
+        with GranuleReader(filename) as granule:
+            for beam, beamarray in granule.iter_beams(
+                beams=beams, columns=BATHY_COLUMNS + ["dist_along"]
+            ):
+                print(test_florida(filename, beam, beamarray))
 
 
 if __name__ == "__main__":
@@ -42,7 +42,7 @@ from scipy.stats import gaussian_kde
 #     bbox_inches="tight",
 # )
 # %%
-beamdata = icesat_bathymetry.load_beam_array_ncds(
+beamdata = load_beam_array_ncds(
     "../data/test_sites/florida_keys/ATL03/processed_ATL03_20201202073402_10560901_005_01.nc",
     "gt3l",
 )
@@ -136,7 +136,7 @@ beam = "gt3l"
 # going to put it here for conveneince
 kde50val = 0.18
 
-beamdata = icesat_bathymetry.load_beam_array_ncds(atl03_testfile, beam)
+beamdata = load_beam_array_ncds(atl03_testfile, beam)
 
 raw_data = icesat_bathymetry.add_along_track_dist(beamdata)
 point_dataframe = icesat_bathymetry._filter_points(
@@ -16,14 +16,10 @@ def optimize_params(site_name):
 
         site.find_bathy_from_icesat(
             window=win,
-            threshold_val=0.0,
             req_perc_hconf=0,
-            window_meters=None,
-            min_photons=None,
             min_kde=minkde,
             low_limit_gebco=-50,
             high_limit_gebco=3,
-            rolling_window=200,
             max_sea_surf_elev=2,
             filter_below_z=-40,
             filter_below_depth=-40,
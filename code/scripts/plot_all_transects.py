@@ -1,13 +1,11 @@
 import os.path
 import sys
-from glob import glob
 
 import pandas as pd
-from atl_module.ATL03_preprocessing.atl03_netcdf_loading import (
-    get_beams,
-    load_beam_array_ncds,
-)
+from atl_module.ATL03_preprocessing.atl03_netcdf_loading import GranuleReader
+from atl_module.ATL03_preprocessing.granule_catalog import GranuleCatalog
 from atl_module.bathymetry_extraction.icesat_bathymetry import (
+    BATHY_COLUMNS,
     _filter_points,
     add_rolling_kde,
 )
@@ -15,8 +13,7 @@ from atl_module.utility_functions.error_calc import add_true_elevation
 from atl_module.utility_functions.plotting import plot_transect_results
 
 
-def run_kde(filename, beam):
-    beamarray = load_beam_array_ncds(filename=filename, beam=beam)
+def run_kde(beamarray):
     point_df = pd.DataFrame(beamarray)
 
     subsurface_return_pts = _filter_points(
@@ -43,24 +40,32 @@ def run_kde(filename, beam):
 def main():
     site = sys.argv[1]
     print("starting site:", site)
-    for file in glob(f"../data/test_sites/{site}/ATL03/*.nc"):
+    # the catalog lists the granules and beams without opening every file
+    with GranuleCatalog(f"../data/test_sites/{site}/ATL03") as catalog:
+        catalog.update()
+        beams_by_file = catalog.beams_by_file()
+    for file, beams in beams_by_file.items():
         print("starting file: ", file)
         outfilename = os.path.basename(file).strip("005_01.nc").strip("processed_ATL03_")
         print(outfilename)
 
-        beamlist = get_beams(file)
-        for beam in beamlist:
-            print("starting beam", beam)
-            subsurfpts, bathy_pts = run_kde(file, beam)
-            bathy_pts = add_true_elevation(
-                bathy_pts, f"../data/test_sites/{site}/in-situ-DEM/truth.vrt", crs="EPSG:32620"
-            )
-            bathy_pts[bathy_pts.kde_val > 0.15]
-            if len(subsurfpts) == 0 or len(bathy_pts) == 0:
-                continue
-            plot_transect_results(
-                subsurfpts, bathy_pts, f"../data/temp_figs/{site}_{outfilename}-{beam}.jpg"
-            )
+        with GranuleReader(
+            file, cache_dir=f"../data/test_sites/{site}/photon_cache"
+        ) as granule:
+            for beam, beamarray in granule.iter_beams(beams=beams, columns=BATHY_COLUMNS):
+                print("starting beam", beam)
+                subsurfpts, bathy_pts = run_kde(beamarray)
+                bathy_pts = add_true_elevation(
+                    bathy_pts,
+                    f"../data/test_sites/{site}/in-situ-DEM/truth.vrt",
+                    crs="EPSG:32620",
+                )
+                bathy_pts[bathy_pts.kde_val > 0.15]
+                if len(subsurfpts) == 0 or len(bathy_pts) == 0:
+                    continue
+                plot_transect_results(
+                    subsurfpts, bathy_pts, f"../data/temp_figs/{site}_{outfilename}-{beam}.jpg"
+                )
 
 
 if __name__ == "__main__":